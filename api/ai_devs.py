@@ -9,20 +9,21 @@ from zipfile import ZipFile
 from fastapi import APIRouter, Depends, Form, Response, UploadFile
 from fastapi.responses import JSONResponse
 from firecrawl import FirecrawlApp
-from httpx import AsyncClient, HTTPStatusError
+from httpx import HTTPStatusError
 from loguru import logger as LOG
 
 from exceptions import ApiException
 from models.ai_devs import AiDevsAnswer, AiDevsResponse
 from services.ai_devs.storeService import AIDevsStore, API_TASK_KEY
 from services.ai.modelService import ask_about_image, complete_task, generate_image, send_once, transcribe
+from services.ai.scheduler import Priority
 from services.ai_devs.task_api_v3 import send_answer
 from services.data_transformers import chunker
 from services.data_transformers.markdown import MarkdownLink
 from services import graphService
-from services.ingestService import read_files_from_zip
-from services.memory.cache_service import FileCacheService
+from services.ingestService import IngestLedger, ingest_zip, read_files_from_zip
 from services.vectorService import EmbeddingService, VectorService
+from services.web.http_pool import http_pool
 from services.web.web_interaction import get_http_data, send_dict_as_json, send_form, get_page
 from services.prompts import PromptService
 
@@ -43,14 +44,14 @@ async def poligon_task():
     LOG.info('Executing Poligon Task')
     secrets = store.read_task_secrets('poligon')
     task_data_url = secrets.get('data_source', '')
-    async with AsyncClient() as client:
-        raw_data = await client.get(task_data_url)
-        data_array = [t for t in raw_data.text.split('\n') if t]
-        LOG.info('Fetched data and put into array {}', data_array)
-        task_api_response = await send_answer(
-            AiDevsAnswer(task='POLIGON', apikey=API_TASK_KEY, answer=data_array)
-        )
-        return task_api_response
+    # Not through get_page, an error response is read as data instead of raising, as it always was
+    raw_data = await http_pool.request('GET', task_data_url)
+    data_array = [t for t in raw_data.text.split('\n') if t]
+    LOG.info('Fetched data and put into array {}', data_array)
+    task_api_response = await send_answer(
+        AiDevsAnswer(task='POLIGON', apikey=API_TASK_KEY, answer=data_array)
+    )
+    return task_api_response
 
 @router.get('/captcha')
 async def captcha_task():
@@ -147,12 +148,8 @@ async def corrupt_json():
     source_json_url: str = secrets.get('source_json','')
     submit_task_url: str = secrets.get('submit_url','')
     source_json_url: str = source_json_url.replace('<apikey>', environ['AI_DEVS_TASK_KEY'])
-    cache = FileCacheService() 
-    
-    json_file = cache.get(source_json_url)
-    if not json_file:
-        json_file = await get_page(source_json_url)
-        cache.save(source_json_url, json_file)
+    # get_page keeps the file in the HTTP cache and revalidates it
+    json_file = await get_page(source_json_url)
 
     json_data = json.loads(json_file)
     
@@ -162,8 +159,9 @@ async def corrupt_json():
     
     json_data['test-data'] = fixed_test_data
 
+    # Only the entries with an open question need the LLM, pack them up to the model token budget
     test_data_chunker = chunker.BasicChunker(json_data['test-data'])
-    chunks = test_data_chunker.chunk(100)
+    chunks = test_data_chunker.iter_token_chunks(model='gpt-4o-mini', keep=lambda item: 'test' in item)
 
     try:
         system_prompt, lf_prompt = prompt_service.get_prompt('AI_DEVS_CORRUPT_JSON_SYSTEM')
@@ -173,7 +171,7 @@ async def corrupt_json():
     coro = [send_once([
                 {'role': 'system', 'content': system_prompt},
                 {'role': 'user', 'content': json.dumps(chunk)}
-            ], langfuse_prompt=lf_prompt) for chunk in chunks]
+            ], langfuse_prompt=lf_prompt, priority=Priority.BATCH) for chunk in chunks]
     LOG.info('Prepared {} coroutines to execute', len(coro))
     res = await asyncio.gather(*coro)
     json_responses = []
@@ -231,16 +229,12 @@ async def transcript_audio_files(audio_files: list[UploadFile]):
     async def transcribe_audio(file: UploadFile):
         file_name = file.filename if file.filename else ''
         try:
-            transcription = cache.get(file_name)
-            if not transcription:
-                transcription = await transcribe(await file.read())
-                cache.save(file_name, transcription)
-            return transcription
+            # Transcriptions are cached by the file content, not its name
+            return await transcribe(await file.read(), priority=Priority.BATCH)
         except ApiException:
             LOG.error('Unable to process file {}',file_name)
 
 
-    cache = FileCacheService()
     responses: list[str | None] = await asyncio.gather(*[
         transcribe_audio(file) for file in audio_files
     ])
@@ -282,14 +276,15 @@ async def categories_task(archive: UploadFile):
         LOG.info('Processing file {} ', filename)
         match check_filetype(filename):
             case 'audio':
-                return filename, await transcribe(file)
+                return filename, await transcribe(file, priority=Priority.BATCH)
             case 'text':
                 return filename, file.decode()
             case 'image':
                 return filename, await ask_about_image(
                     'I will OCR the text on provided image. I will only return the text that I read on the image and nothing else.',
                     file,
-                    'What is written in the note tell me exactly word by word.')
+                    'What is written in the note tell me exactly word by word.',
+                    priority=Priority.BATCH)
             case 'unknown':
                 return filename, 'Unable to read the file'
 
@@ -328,7 +323,7 @@ async def categories_task(archive: UploadFile):
         except ApiException as err:
             return JSONResponse(content=str(err), status_code=500)
 
-        return filename, await complete_task(system_prompt,data, model='gpt-4o', langfuse_prompt=lf_prompt)
+        return filename, await complete_task(system_prompt,data, model='gpt-4o', langfuse_prompt=lf_prompt, priority=Priority.BATCH)
 
     coroutines = [categorize_information(context, filename) for filename, context in results]
     results: list[tuple[str,str]] = await asyncio.gather(*coroutines)
@@ -485,7 +480,7 @@ async def documents(reports_archive: UploadFile, facts_archive: UploadFile):
     </Example_output>
     '''
 
-    summarization_coroutines = [complete_task(system_prompt, content.decode()) for _, content in [*facts,*reports]]
+    summarization_coroutines = [complete_task(system_prompt, content.decode(), priority=Priority.BATCH) for _, content in [*facts,*reports]]
     summarization_results = await asyncio.gather(*summarization_coroutines)
     LOG.info('Summarization results {}', summarization_results)
 
@@ -559,7 +554,7 @@ async def documents(reports_archive: UploadFile, facts_archive: UploadFile):
     '''
 
     LOG.info('System prompt {}', system_prompt)
-    label_files_coro = [complete_task(system_prompt,file_name + '\n-----' + report_content.decode() + '\n\n') for file_name, report_content in reports]
+    label_files_coro = [complete_task(system_prompt,file_name + '\n-----' + report_content.decode() + '\n\n', priority=Priority.BATCH) for file_name, report_content in reports]
     label_file_names = [file_name for file_name, _ in reports]
     result_labeled_files = await asyncio.gather(*label_files_coro)
 
@@ -575,14 +570,20 @@ async def vectors_task(weapons_zip: UploadFile | None = None, query: str | None
     embedding_service = EmbeddingService('http://localhost:11434/v1', 'bge-m3')
     vectorService = VectorService(embedding_service, 'AI_Devs3')
 
-    vectorService.create_collection(collection_name,1024)
+    ledger = IngestLedger.for_collection('AI_Devs3', collection_name)
+    if await vectorService.create_collection(collection_name,1024):
+        # A new collection holds none of the files indexed into a dropped one
+        ledger.clear()
 
     if weapons_zip is not None:
-        weapon_test_files = read_files_from_zip(weapons_zip.file, file_types=['txt'])
-        LOG.info('Indexing {} files', len(weapon_test_files))
-        index_file_content_coro = [vectorService.insert_into_collection(collection_name, [content.decode()], tags=[name]) for name, content in weapon_test_files]
-        indexed_data = await asyncio.gather(*index_file_content_coro)
-        return Response(f'Inserted {list(indexed_data)} entries')
+        progress = await ingest_zip(
+            vectorService,
+            collection_name,
+            weapons_zip.file,
+            file_types=['txt'],
+            ledger=ledger,
+        )
+        return JSONResponse(progress.as_dict())
 
 
     if query:
@@ -1,6 +1,8 @@
-from typing import Annotated, Optional
+import json
+from typing import Annotated, AsyncIterator, Optional
 
 from fastapi import APIRouter, Depends, Form, UploadFile, File
+from fastapi.responses import StreamingResponse
 from loguru import logger as LOG
 from openai.types import image
 
@@ -24,14 +26,45 @@ def chat(messageBody: CreateMessage):
 def attach_file():
     ...
 
+def sse_event(data: dict, event: str | None = None) -> str:
+    prefix = f'event: {event}\n' if event else ''
+    return f'{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+async def stream_as_sse(deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+    try:
+        async for delta in deltas:
+            yield sse_event({'delta': delta})
+    except Exception as err:
+        LOG.error('Streaming the response failed {}', str(err))
+        yield sse_event({'error': str(err)}, event='error')
+        return
+    yield sse_event({}, event='done')
+
+
 @chat_router.post('/ask_once')
 async def ask_once(
         image: Optional[UploadFile] = File(default=None),
         system_prompt: str = Form(...),
         user_msg: str = Form(...),
+        stream: bool = Form(default=False),
 ):
+    if stream:
+        if image:
+            deltas = ai.stream_about_image(system_prompt, image.file.read(), user_msg)
+        else:
+            deltas = ai.stream_once(messages=[
+                {'role': 'system', 'content': system_prompt},
+                {'role': 'user', 'content': user_msg}
+            ])
+        return StreamingResponse(
+            stream_as_sse(deltas),
+            media_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
+
     if image:
-        return await ai.ask_about_image(system_prompt, image.file.read(), user_msg)
+        return await ai.ask_about_image(system_prompt, image.file.read(), user_msg, bypass_cache=True)
     else:
         return await ai.send_once(messages=[
             {'role': 'system', 'content': system_prompt},
@@ -1,20 +1,91 @@
+import asyncio
+
 from fastapi import APIRouter, Response
 from loguru import logger as LOG
 
+from models.rag import RetrievalMode, RetrieveBatchRequest
+from services.lexicalIndex import BM25Index, lexical_indexes, rank_fusion
+from services.memory.query_cache import query_cache
 from services.vectorService import EmbeddingService, VectorService
 
 router = APIRouter(prefix='/rag', tags=['memory', 'rag'])
 
-@router.get('/retrieve')
-async def retrieve(query_string: str):
+DATABASE = 'NexusRealm'
+COLLECTION = 'knowledge'
+
+def knowledge_service() -> VectorService:
     embedding_service = EmbeddingService('http://localhost:11434/v1', 'nomic-embed-text')
-    vector_service = VectorService(embedding_service, 'NexusRealm')
-    return await vector_service.search_in_collection('knowledge', [query_string], output_fields=['text'])
+    return VectorService(embedding_service, DATABASE)
+
+async def rebuild_lexical_index(replace: bool = True) -> BM25Index:
+    '''Index the documents of the knowledge collection, without `replace` only when no worker has built the index yet'''
+    vector_service = VectorService(None, DATABASE)
+    documents = await vector_service.documents(COLLECTION) if await vector_service.backend.has_collection(COLLECTION) else []
+    index = lexical_indexes.get(DATABASE, COLLECTION)
+    ids, texts, tags = [doc['id'] for doc in documents], [doc['text'] or '' for doc in documents], [doc['tags'] or [] for doc in documents]
+    await asyncio.to_thread(index.rebuild, ids, texts, tags, replace)
+    return index
+
+async def lexical_index() -> BM25Index:
+    '''Lexical index of the knowledge collection, built from the vector store on first use'''
+    index = lexical_indexes.get(DATABASE, COLLECTION)
+    if not index.built:
+        index = await rebuild_lexical_index(replace=False)
+    return index
+
+async def _search(queries: list[str], mode: RetrievalMode, limit: int) -> list[list[dict]]:
+    lexical = []
+    if mode != 'dense':
+        index = await lexical_index()
+        lexical = [index.search(query, limit=limit * 2, output_fields=['text']) for query in queries]
+        if mode == 'lexical':
+            return [hits[:limit] for hits in lexical]
+    dense = await knowledge_service().search_in_collection(COLLECTION, queries, limit=limit * 2 if lexical else limit, output_fields=['text'])
+    if mode == 'dense':
+        return dense
+    return [rank_fusion([dense_hits, lexical_hits], limit=limit) for dense_hits, lexical_hits in zip(dense, lexical)]
+
+async def search_knowledge(queries: list[str], mode: RetrievalMode = 'dense', limit: int = 5) -> list[list[dict]]:
+    '''Dense, lexical (BM25) or rank fused hybrid search of the knowledge collection.
+    The distance of dense hits is the cosine similarity, of lexical ones the BM25 score
+    and of hybrid ones the fused reciprocal rank score.
+    Queries without a cached result are embedded in one call and searched in one request,
+    lexical search does not need an embedding call
+    '''
+    generation = query_cache.generation(COLLECTION)
+    results = [query_cache.get(COLLECTION, (mode, limit, query)) for query in queries]
+    missing = list(dict.fromkeys(query for query, result in zip(queries, results) if result is None))
+    if missing:
+        found = dict(zip(missing, await _search(missing, mode, limit)))
+        for query, hits in found.items():
+            query_cache.put(COLLECTION, (mode, limit, query), hits, generation)
+        results = [found[query] if result is None else result for query, result in zip(queries, results)]
+    return results #type: ignore
+
+@router.get('/retrieve')
+async def retrieve(query_string: str, mode: RetrievalMode = 'dense', limit: int = 5):
+    return await search_knowledge([query_string], mode, limit)
+
+@router.post('/retrieve_batch')
+async def retrieve_batch(request: RetrieveBatchRequest):
+    '''Results of several queries, in the order of the queries'''
+    return await search_knowledge(request.queries, request.mode, request.limit)
 
 @router.post('/remember')
 async def remember(information: str):
-    embedding_service = EmbeddingService('http://localhost:11434/v1', 'nomic-embed-text')
-    vector_service = VectorService(embedding_service, 'NexusRealm')
-    response = await vector_service.insert_into_collection('knowledge',[information])
+    vector_service = knowledge_service()
+    await vector_service.create_collection(COLLECTION, 768)
+    # Built before the insert, the rebuild would index the new document as well
+    index = await lexical_index()
+    response = await vector_service.insert_into_collection(COLLECTION, [information])
+    index.add(response['ids'], [information])
+    query_cache.invalidate(COLLECTION)
     LOG.info('Remember response {}',response)
     return Response('Remembered')
+
+@router.post('/reindex')
+async def reindex():
+    '''Rebuild the lexical index from the documents in the knowledge collection'''
+    index = await rebuild_lexical_index()
+    query_cache.invalidate(COLLECTION)
+    return index.stats()
@@ -0,0 +1,62 @@
+from fastapi import APIRouter
+
+from services.ai.clientRegistry import client_registry
+from services.ai.scheduler import scheduler
+from services.ai.singleflight import SingleFlight
+from services import coordination
+from services.memory import cache_service, embedding_cache
+from services.memory.query_cache import query_cache
+from services.memory.response_cache import response_cache
+from services.lexicalIndex import lexical_indexes
+from services.vectorBackends import vector_backends
+from services.web.http_cache import http_cache
+from services.web.http_pool import http_pool
+
+router = APIRouter(prefix='/telemetry', tags=['telemetry'])
+
+@router.get('/llm_clients')
+async def llm_clients():
+    '''Connection reuse statistics of the pooled LLM clients, per provider'''
+    return client_registry.stats()
+
+@router.get('/http_clients')
+async def http_clients():
+    '''Connection reuse statistics of the pooled web and task API clients, per host,
+    with the hit and revalidation counters of the HTTP cache in front of them
+    '''
+    return {**http_pool.stats(), 'cache': http_cache.stats.as_dict()}
+
+@router.get('/llm_cache')
+async def llm_cache():
+    '''Hit and miss counters of the LLM response cache'''
+    return {'enabled': response_cache.enabled, **response_cache.stats.as_dict()}
+
+@router.get('/embedding_cache')
+async def embedding_cache_stats():
+    '''Size and hit counters of the embedding cache, per base url and model'''
+    return embedding_cache.all_stats()
+
+@router.get('/file_cache')
+async def file_cache():
+    '''Memory tier usage with hit, miss and eviction counters and latencies of the file cache, per namespace'''
+    return cache_service.all_stats()
+
+@router.get('/llm_scheduler')
+async def llm_scheduler():
+    '''Throughput, retries and queue depth of every provider/model lane'''
+    return scheduler.stats()
+
+@router.get('/coalescing')
+async def coalescing():
+    '''Number of model and embedding calls collapsed into an in-flight duplicate'''
+    return SingleFlight.all_stats()
+
+@router.get('/coordination')
+async def coordination_stats():
+    '''Cross process lock contention and values computed or reused by this worker'''
+    return coordination.all_stats()
+
+@router.get('/vector_store')
+async def vector_store():
+    '''Configured vector backend with the state of every open database and lexical index'''
+    return {**vector_backends.stats(), 'lexical': lexical_indexes.stats(), 'query_cache': query_cache.stats.as_dict()}
@@ -0,0 +1,69 @@
+'''Small entry throughput of the file cache disk tiers, one file per key
+versus a single append-only log.
+
+Writes, then reads back in random order, entries shaped like cached pages
+and transcriptions, with the memory tier disabled so every read hits the disk tier:
+
+    python benchmarks/file_cache_layout.py --entries 20000 --size 512 --reads 50000
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=20_000)
+    parser.add_argument('--size', type=int, default=512, help='Bytes per entry')
+    parser.add_argument('--reads', type=int, default=50_000)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def directory_stats(path: str) -> tuple[int, int]:
+    files, size = 0, 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def main(args) -> None:
+    from services.memory.cache_service import STORES, FileCacheService, close_stores
+
+    rng = random.Random(args.seed)
+    keys = [f'https://centrala.ag3nts.org/data/{i}/page.txt' for i in range(args.entries)]
+    values = [rng.randbytes(args.size) for _ in keys]
+    reads = [rng.randrange(args.entries) for _ in range(args.reads)]
+
+    print(f'{args.entries} entries of {args.size} bytes, {args.reads} random reads')
+    for backend in STORES:
+        with tempfile.TemporaryDirectory(prefix='file-cache-') as directory:
+            cache = FileCacheService('bench', cache_dir=directory, memory=None, backend=backend, max_bytes=2 ** 40)
+            started = time.perf_counter()
+            for key, value in zip(keys, values):
+                cache.save_bytes(key, value)
+            write_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for index in reads:
+                assert cache.get_bytes(keys[index]) == values[index]
+            read_seconds = time.perf_counter() - started
+
+            close_stores()
+            files, size = directory_stats(directory)
+            print(
+                f'{backend:<6} write={args.entries / write_seconds:>9.0f}/s  '
+                f'read={args.reads / read_seconds:>9.0f}/s  '
+                f'files={files:>6}  disk={size / 2 ** 20:>7.1f}MiB'
+            )
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    main(arguments)
@@ -0,0 +1,99 @@
+'''Offline load test of modelService, EmbeddingService and send_answer.
+
+Runs against the in-process replay transport, so no API keys or local models are needed:
+
+    python benchmarks/llm_offline.py --requests 200 --latency 0.05 --error-rate 0.05
+'''
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Awaitable, Callable
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100, help='Calls per scenario')
+    parser.add_argument('--latency', type=float, default=0.05, help='Simulated upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Random extra latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of calls answered with an injected error')
+    parser.add_argument('--recordings', default='', help='JSONL file with recorded responses to replay')
+    parser.add_argument('--no-limits', action='store_true', help='Lift the provider rate limits, measures the client overhead only')
+    return parser.parse_args()
+
+
+def configure(args) -> None:
+    # The services read their configuration on import
+    os.environ['LLM_TRANSPORT_MODE'] = 'replay'
+    os.environ['LLM_REPLAY_FILE'] = args.recordings
+    os.environ['LLM_REPLAY_LATENCY'] = str(args.latency)
+    os.environ['LLM_REPLAY_JITTER'] = str(args.jitter)
+    os.environ['LLM_REPLAY_ERROR_RATE'] = str(args.error_rate)
+    os.environ['LLM_RETRY_BASE_DELAY'] = '0.01'
+    if args.no_limits:
+        os.environ['LLM_RATE_LIMITS'] = json.dumps({
+            provider: {'max_concurrency': 64} for provider in ('openai', 'groq', 'ollama')
+        })
+    os.environ.setdefault('OPENAI_API_KEY', 'offline')
+    os.environ.setdefault('GROQ_API_KEY', 'offline')
+    os.environ.setdefault('LANGFUSE_ENABLED', 'false')
+
+
+async def measure(name: str, requests: int, call: Callable[[int], Awaitable]) -> None:
+    latencies: list[float] = []
+    failures = 0
+
+    async def timed(i: int):
+        nonlocal failures
+        started = time.perf_counter()
+        try:
+            await call(i)
+        except Exception:
+            failures += 1
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[timed(i) for i in range(requests)])
+    elapsed = time.perf_counter() - started
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    print(
+        f'{name:<22} {requests / elapsed:>9.1f} req/s  '
+        f'p50={quantiles[49] * 1000:>7.1f}ms  p95={quantiles[94] * 1000:>7.1f}ms  failures={failures}'
+    )
+
+
+async def main(args) -> None:
+    from models.ai_devs import AiDevsAnswer
+    from services.ai import modelService
+    from services.ai.clientRegistry import client_registry
+    from services.ai.scheduler import scheduler
+    from services.ai_devs.task_api_v3 import send_answer
+    from services.vectorService import EmbeddingService
+    from services.web.http_pool import http_pool
+
+    embedding_service = EmbeddingService('http://localhost:11434/v1', 'nomic-embed-text')
+
+    await measure('send_once', args.requests, lambda i: modelService.send_once(
+        [{'role': 'user', 'content': f'Question {i}'}], bypass_cache=True))
+    await measure('complete_task', args.requests, lambda i: modelService.complete_task(
+        'You are a benchmark', f'Question {i}', bypass_cache=True))
+    await measure('generate_embedding', args.requests, lambda i: embedding_service.generate_embedding(f'Document {i}'))
+    await measure('transcribe', args.requests, lambda i: modelService.transcribe(f'audio {i}'.encode()))
+    await measure('send_answer', args.requests, lambda i: send_answer(
+        AiDevsAnswer(task='benchmark', apikey='offline', answer=str(i)), 'http://centrala.local/report'))
+
+    print('\nScheduler lanes:')
+    for lane, stats in scheduler.stats().items():
+        print(f'  {lane:<32} {stats}')
+    await client_registry.aclose()
+    await http_pool.aclose()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    configure(arguments)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    asyncio.run(main(arguments))
@@ -0,0 +1,104 @@
+'''Event loop lag while searching Milvus, calling the blocking MilvusClient
+directly from coroutines versus through the AsyncMilvusClient thread pool.
+
+Uses a simulated client with a fixed search latency by default,
+pass --uri to search a real collection instead:
+
+    python benchmarks/milvus_event_loop.py --searches 200 --latency 0.02
+    python benchmarks/milvus_event_loop.py --uri http://localhost:19530 --database AI_Devs3 --collection wektory_bge --dimension 1024
+'''
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--searches', type=int, default=200, help='Searches per scenario')
+    parser.add_argument('--concurrency', type=int, default=32, help='Searches in flight at once')
+    parser.add_argument('--threads', type=int, default=8, help='Size of the Milvus thread pool')
+    parser.add_argument('--latency', type=float, default=0.02, help='Latency of a simulated search in seconds')
+    parser.add_argument('--interval', type=float, default=0.005, help='Tick interval used to measure event loop lag')
+    parser.add_argument('--uri', default='', help='Search a real Milvus server instead of the simulated one')
+    parser.add_argument('--token', default='root:Milvus')
+    parser.add_argument('--database', default='default')
+    parser.add_argument('--collection', default='knowledge')
+    parser.add_argument('--dimension', type=int, default=768)
+    return parser.parse_args()
+
+
+class SimulatedClient:
+    '''Blocks the calling thread for the duration of a search, like MilvusClient does'''
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    def search(self, collection_name: str, data: list, **kwargs) -> list:
+        time.sleep(self.latency)
+        return [[] for _ in data]
+
+    def close(self) -> None:
+        pass
+
+
+async def measure(name: str, args, search) -> None:
+    lags: list[float] = []
+    running = True
+
+    async def ticker():
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(args.interval)
+            lags.append(time.perf_counter() - started - args.interval)
+
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def one():
+        vector = [random.random() for _ in range(args.dimension)]
+        async with limit:
+            await search(vector)
+
+    ticking = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(args.searches)])
+    elapsed = time.perf_counter() - started
+    running = False
+    await ticking
+    quantiles = statistics.quantiles(lags, n=100, method='inclusive') if len(lags) > 1 else lags * 99
+    print(
+        f'{name:<10} {args.searches / elapsed:>8.1f} searches/s  loop lag '
+        f'p50={quantiles[49] * 1000:>7.1f}ms  p99={quantiles[98] * 1000:>7.1f}ms  max={max(lags) * 1000:>7.1f}ms'
+    )
+
+
+async def main(args) -> None:
+    from services.milvusRegistry import AsyncMilvusClient
+
+    if args.uri:
+        from pymilvus import MilvusClient
+        client = MilvusClient(uri=args.uri, token=args.token, db_name=args.database)
+    else:
+        client = SimulatedClient(args.latency)
+
+    async def blocking(vector):
+        return client.search(args.collection, [vector], limit=5)
+
+    with ThreadPoolExecutor(max_workers=args.threads, thread_name_prefix='milvus') as executor:
+        facade = AsyncMilvusClient(client, executor) #type: ignore
+
+        async def pooled(vector):
+            return await facade.search(args.collection, [vector], limit=5)
+
+        await measure('blocking', args, blocking)
+        await measure('pooled', args, pooled)
+    client.close()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    asyncio.run(main(arguments))
@@ -0,0 +1,81 @@
+'''Recall, latency and memory of the local vector backend storage modes.
+
+Indexes a synthetic clustered dataset, shaped like sentence embeddings, in
+float32, int8 and binary collections and compares their top-k hits against
+exact float search:
+
+    python benchmarks/vector_quantization.py --rows 50000 --dimension 1024 --queries 200
+'''
+import argparse
+import os
+import pathlib as p
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50_000)
+    parser.add_argument('--dimension', type=int, default=1024, help='bge-m3 embeddings have 1024 dimensions')
+    parser.add_argument('--clusters', type=int, default=200, help='Topics the synthetic documents are drawn around')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=10, help='Hits per query, recall is measured at this depth')
+    parser.add_argument('--rerank-factor', type=int, default=10, help='Candidates re-ranked per requested hit')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def dataset(args) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(args.seed)
+    centers = rng.normal(size=(args.clusters, args.dimension)).astype(np.float32)
+    rows = centers[rng.integers(args.clusters, size=args.rows)] + rng.normal(scale=0.8, size=(args.rows, args.dimension)).astype(np.float32)
+    picked = rows[rng.integers(args.rows, size=args.queries)]
+    queries = picked + rng.normal(scale=0.5, size=picked.shape).astype(np.float32)
+    return rows, queries
+
+
+def main(args) -> None:
+    from services import vectorBackends
+    from services.vectorBackends import LocalCollection, STORAGE_MODES
+
+    vectorBackends.VECTOR_RERANK_FACTOR = args.rerank_factor
+    # Measure the storage modes themselves, not the approximate index
+    vectorBackends.VECTOR_IVF_THRESHOLD = args.rows + 1
+    rows, queries = dataset(args)
+    data = [{'vector': vector} for vector in rows]
+
+    normalized = rows / np.linalg.norm(rows, axis=1, keepdims=True)
+    exact = [set(np.argsort(-(normalized @ (q / np.linalg.norm(q))))[:args.limit] + 1) for q in queries]
+
+    print(f'{args.rows} rows x {args.dimension} dimensions, {args.queries} queries, recall@{args.limit}')
+    with tempfile.TemporaryDirectory(prefix='vectors-') as directory:
+        for storage in STORAGE_MODES:
+            collection = LocalCollection.create(p.Path(directory) / storage, args.dimension, storage) #type: ignore
+            started = time.perf_counter()
+            for start in range(0, len(data), 4096):
+                collection.insert(data[start:start + 4096])
+            insert_seconds = time.perf_counter() - started
+
+            latencies, recalls = [], []
+            for query, truth in zip(queries, exact):
+                started = time.perf_counter()
+                hits = collection.search(query[None, :], args.limit, [], None)[0]
+                latencies.append(time.perf_counter() - started)
+                recalls.append(len(truth & {hit['id'] for hit in hits}) / args.limit)
+            print(
+                f'{storage:<8} scanned={collection.scanned_bytes / 2 ** 20:>8.1f}MiB  '
+                f'recall={statistics.mean(recalls):.3f}  '
+                f'p50={statistics.median(latencies) * 1000:>6.1f}ms  '
+                f'p95={statistics.quantiles(latencies, n=20)[18] * 1000:>6.1f}ms  '
+                f'insert={args.rows / insert_seconds:>8.0f} rows/s'
+            )
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    main(arguments)
@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from dotenv import load_dotenv
 
@@ -7,14 +9,30 @@ from api import ai_devs
 from api import agents
 from api import rag
 from api import chat
+from api import telemetry
+from services.ai.clientRegistry import client_registry
 from services.db import create_db_and_tables
+from services.memory.cache_service import close_stores
+from services.vectorBackends import vector_backends
+from services.web.http_pool import http_pool
 
 create_db_and_tables()
 
-app = FastAPI(title='NexusRealm API', description='Optional API for extended NexusRealm features')
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await client_registry.aclose()
+    await http_pool.aclose()
+    vector_backends.close()
+    close_stores()
+
+app = FastAPI(title='NexusRealm API', description='Optional API for extended NexusRealm features', lifespan=lifespan)
 
 app.include_router(ai_devs.router)
 app.include_router(agents.router)
+app.include_router(chat.chat_router)
+app.include_router(rag.router)
+app.include_router(telemetry.router)
 
 @app.get('/')
 def main():
@@ -0,0 +1,9 @@
+from typing import Literal
+from pydantic import BaseModel
+
+RetrievalMode = Literal['hybrid', 'dense', 'lexical']
+
+class RetrieveBatchRequest(BaseModel):
+    queries: list[str]
+    mode: RetrievalMode = 'dense'
+    limit: int = 5
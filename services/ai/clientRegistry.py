@@ -0,0 +1,186 @@
+import os
+from dataclasses import dataclass, field
+
+import httpx
+import pytest
+from langfuse.openai import AsyncOpenAI
+from loguru import logger as LOG
+
+from services.ai.replayTransport import offline_transport
+
+# Pool limits shared by every provider, can be tuned per deployment
+POOL_MAX_CONNECTIONS = int(os.environ.get('LLM_POOL_MAX_CONNECTIONS', 100))
+POOL_MAX_KEEPALIVE = int(os.environ.get('LLM_POOL_MAX_KEEPALIVE', 20))
+POOL_KEEPALIVE_EXPIRY = float(os.environ.get('LLM_POOL_KEEPALIVE_EXPIRY', 60))
+POOL_TIMEOUT = float(os.environ.get('LLM_POOL_TIMEOUT', 600))
+# Retries are handled by the scheduler, which knows about the rate limits
+CLIENT_MAX_RETRIES = int(os.environ.get('LLM_CLIENT_MAX_RETRIES', 0))
+
+
+@dataclass
+class Provider:
+    name: str
+    base_url: str | None = None
+    api_key_env: str = 'OPENAI_API_KEY'
+    default_api_key: str | None = None
+
+    @property
+    def api_key(self) -> str:
+        '''Key of the provider, never falls back to the key of another one'''
+        api_key = os.environ.get(self.api_key_env, self.default_api_key)
+        if not api_key:
+            raise ValueError(f'{self.api_key_env} is not set, it is required by the {self.name} provider')
+        return api_key
+
+
+PROVIDERS: dict[str, Provider] = {
+    'openai': Provider('openai'),
+    'groq': Provider('groq', base_url='https://api.groq.com/openai/v1', api_key_env='GROQ_API_KEY'),
+    'ollama': Provider(
+        'ollama',
+        base_url=os.environ.get('OLLAMA_BASE_URL', 'http://localhost:11434/v1'),
+        api_key_env='OLLAMA_API_KEY',
+        default_api_key='ollama'
+    ),
+}
+
+
+@dataclass
+class ConnectionStats:
+    requests: int = 0
+    connections_opened: int = 0
+    errors: int = 0
+    hosts: set[str] = field(default_factory=set)
+
+    @property
+    def reused(self) -> int:
+        return max(self.requests - self.connections_opened, 0)
+
+    def as_dict(self) -> dict:
+        return {
+            'requests': self.requests,
+            'connections_opened': self.connections_opened,
+            'connections_reused': self.reused,
+            'reuse_ratio': round(self.reused / self.requests, 3) if self.requests else 0.0,
+            'errors': self.errors,
+            'hosts': sorted(self.hosts),
+        }
+
+
+class TrackingTransport(httpx.AsyncBaseTransport):
+    '''Transport wrapper counting requests and newly opened TCP connections'''
+    def __init__(self, stats: ConnectionStats, transport: httpx.AsyncBaseTransport) -> None:
+        self.stats = stats
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.stats.requests += 1
+        self.stats.hosts.add(request.url.host)
+        upstream_trace = request.extensions.get('trace')
+
+        async def trace(event_name: str, info: dict):
+            if event_name == 'connection.connect_tcp.complete':
+                self.stats.connections_opened += 1
+            if upstream_trace is not None:
+                await upstream_trace(event_name, info)
+
+        request.extensions = {**request.extensions, 'trace': trace}
+        try:
+            return await self._transport.handle_async_request(request)
+        except Exception:
+            self.stats.errors += 1
+            raise
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class ClientRegistry:
+    '''Process wide registry of long-lived AsyncOpenAI clients, one per provider.
+
+    Clients are created lazily on first use and closed on application shutdown,
+    so all calls to the same provider share a single keep-alive connection pool.
+    '''
+    def __init__(self, limits: httpx.Limits | None = None, timeout: float = POOL_TIMEOUT) -> None:
+        self.limits = limits or httpx.Limits(
+            max_connections=POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=POOL_MAX_KEEPALIVE,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+        )
+        self.timeout = timeout
+        self.providers: dict[str, Provider] = dict(PROVIDERS)
+        self._clients: dict[str, AsyncOpenAI] = {}
+        self._stats: dict[str, ConnectionStats] = {}
+
+    def _build_transport(self, provider: Provider) -> httpx.AsyncBaseTransport:
+        transport = offline_transport(httpx.AsyncHTTPTransport(limits=self.limits))
+        assert transport is not None
+        return transport
+
+    def _build_client(self, provider: Provider) -> AsyncOpenAI:
+        api_key = provider.api_key
+        stats = self._stats.setdefault(provider.name, ConnectionStats())
+        http_client = httpx.AsyncClient(
+            transport=TrackingTransport(stats, self._build_transport(provider)),
+            timeout=self.timeout,
+            follow_redirects=True,
+        )
+        client_args = {'http_client': http_client, 'max_retries': CLIENT_MAX_RETRIES, 'api_key': api_key}
+        if provider.base_url:
+            client_args['base_url'] = provider.base_url
+        LOG.info('Creating pooled client for provider {} ({})', provider.name, provider.base_url or 'default')
+        return AsyncOpenAI(**client_args)
+
+    def get(self, provider: str = 'openai') -> AsyncOpenAI:
+        '''Return the shared client for a provider, creating it if needed'''
+        client = self._clients.get(provider)
+        if client is None or client.is_closed():
+            if provider not in self.providers:
+                raise ValueError(f'Unknown LLM provider {provider}')
+            client = self._build_client(self.providers[provider])
+            self._clients[provider] = client
+        return client
+
+    def provider_for_base_url(self, base_url: str | None) -> str:
+        '''Map a base url onto a registered provider, registering a new one if it is unknown'''
+        if not base_url:
+            return 'openai'
+        normalized = base_url.rstrip('/')
+        for name, provider in self.providers.items():
+            if provider.base_url and provider.base_url.rstrip('/') == normalized:
+                return name
+        self.providers[normalized] = Provider(normalized, base_url=normalized, api_key_env='OPENAI_API_KEY', default_api_key='none')
+        return normalized
+
+    def for_base_url(self, base_url: str | None) -> AsyncOpenAI:
+        return self.get(self.provider_for_base_url(base_url))
+
+    def stats(self) -> dict[str, dict]:
+        return {name: stats.as_dict() for name, stats in self._stats.items()}
+
+    async def aclose(self) -> None:
+        for name, client in self._clients.items():
+            LOG.info('Closing pooled client for provider {}', name)
+            await client.close()
+        self._clients.clear()
+
+
+client_registry = ClientRegistry()
+
+
+def test_provider_for_base_url():
+    registry = ClientRegistry()
+    assert registry.provider_for_base_url(None) == 'openai'
+    assert registry.provider_for_base_url('http://localhost:11434/v1/') == 'ollama'
+    assert registry.provider_for_base_url('http://polaris5:8000/v1') == 'http://polaris5:8000/v1'
+    assert 'http://polaris5:8000/v1' in registry.providers
+
+
+def test_missing_api_key_is_not_replaced_by_another(monkeypatch):
+    monkeypatch.delenv('GROQ_API_KEY', raising=False)
+    monkeypatch.setenv('OPENAI_API_KEY', 'openai-secret')
+    registry = ClientRegistry()
+    with pytest.raises(ValueError, match='GROQ_API_KEY'):
+        registry.get('groq')
+    assert 'groq' not in registry._clients
+    assert registry.providers['ollama'].api_key == 'ollama'
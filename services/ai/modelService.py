@@ -1,109 +1,326 @@
+import asyncio
 import base64
+from contextlib import aclosing
+import hashlib
 import io
-from typing import Literal
-from langfuse.client import os
+from typing import AsyncIterator, Literal
 from loguru import logger as LOG
-from langfuse.openai import AsyncOpenAI
 
 from exceptions import ApiException
+from services.ai.clientRegistry import client_registry
+from services.ai.scheduler import Priority, estimate_tokens, scheduler
+from services.ai.singleflight import SingleFlight
+from services.coordination import compute_once
+from services.data_transformers import audio
+from services.data_transformers.image import IMAGE_MAX_EDGE, ImageDetail, ProcessedImage, preprocess_image, vision_tokens
+from services.memory.media_cache import media_cache
+from services.memory.response_cache import response_cache
+
+TRANSCRIPTION_MODEL = 'whisper-large-v3'
+
+completions_flight = SingleFlight('completions')
+transcriptions_flight = SingleFlight('transcriptions')
+
+async def _create_completion(
+        provider: str,
+        model: str,
+        messages: list,
+        bypass_cache: bool = False,
+        priority: int = Priority.DEFAULT,
+        **kwargs
+) -> str:
+    '''Run a chat completion, serving it from the response cache when enabled.
+    With the cache, identical completions already in flight in this or another worker
+    process are awaited instead of sent again. Without it every call gets its own sample.
+    '''
+    cache_key = response_cache.make_key(provider, model, messages, kwargs)
+    use_cache = response_cache.enabled and not bypass_cache
+    if use_cache:
+        cached_response = await response_cache.get(cache_key)
+        if cached_response is not None:
+            LOG.info('Serving {} completion from cache {}', model, cache_key[:12])
+            return cached_response
+
+    async def complete() -> str:
+        ai = client_registry.get(provider)
+        response = await scheduler.submit(
+            lambda: ai.chat.completions.create( # type: ignore
+                model=model,
+                messages=messages,
+                **kwargs
+            ),
+            provider=provider,
+            model=model,
+            tokens=estimate_tokens(messages) + kwargs.get('max_tokens', 0),
+            priority=priority,
+        )
+        content = str(response.choices[0].message.content)
+        if use_cache:
+            await response_cache.set(cache_key, content)
+        return content
+
+    if not use_cache:
+        return await complete()
+
+    async def complete_once() -> str:
+        return await compute_once('completions', cache_key, lambda: response_cache.get(cache_key), complete)
+
+    return await completions_flight.do(cache_key, complete_once)
+
+async def _stream_completion(
+        provider: str,
+        model: str,
+        messages: list,
+        bypass_cache: bool = False,
+        priority: int = Priority.INTERACTIVE,
+        tokens: int | None = None,
+        **kwargs
+) -> AsyncIterator[str]:
+    '''Stream a chat completion as text deltas, the full text is cached once the stream ends'''
+    use_cache = response_cache.enabled and not bypass_cache
+    if use_cache:
+        cache_key = response_cache.make_key(provider, model, messages, kwargs)
+        cached_response = await response_cache.get(cache_key)
+        if cached_response is not None:
+            LOG.info('Serving {} completion from cache {}', model, cache_key[:12])
+            yield cached_response
+            return
+
+    if provider == 'openai':
+        kwargs.setdefault('stream_options', {'include_usage': True})
+    ai = client_registry.get(provider)
+    stream = await scheduler.submit(
+        lambda: ai.chat.completions.create( # type: ignore
+            model=model,
+            messages=messages,
+            stream=True,
+            **kwargs
+        ),
+        provider=provider,
+        model=model,
+        tokens=tokens if tokens is not None else estimate_tokens(messages) + kwargs.get('max_tokens', 0),
+        priority=priority,
+    )
+    deltas = []
+    try:
+        # Closing the iterator lets the langfuse wrapper finalize the generation, even when the consumer stops early
+        async with aclosing(stream.__aiter__()) as chunks:
+            async for chunk in chunks:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    deltas.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+    finally:
+        await stream.close()
+    if use_cache:
+        await response_cache.set(cache_key, ''.join(deltas))
+
+def _image_messages(system_prompt: str, image: ProcessedImage, user_msg: str, detail: ImageDetail) -> list:
+    img_base64 = base64.b64encode(image.data).decode()
+    return [
+        {'role': 'system', 'content': system_prompt},
+        {'role': 'user', 'content': [
+            {'type': 'text', 'text': user_msg},
+            {'type': 'image_url', 'image_url': {'url': f'data:{image.mime_type};base64,{img_base64}', 'detail': detail}}
+        ]}
+    ]
 
 async def complete_task(
         system_prompt: str,
         data_prompt: str,
         model: str = 'gpt-4o-mini',
         local_model: str = '',
+        bypass_cache: bool = False,
+        priority: int = Priority.DEFAULT,
         **kwargs
 ) -> str:
     LOG.info('Sending to {}, sys=({}), usr=({})', model, system_prompt, data_prompt)
-    client_args = {}
+    provider = 'openai'
     if local_model:
-        client_args['base_url'] = 'http://localhost:11434/v1'
+        provider = 'ollama'
         model = local_model
-    async with AsyncOpenAI(**client_args) as ai:
-        response = await ai.chat.completions.create( # type: ignore
-            messages=[
-                {'role': 'system', 'content': system_prompt},
-                {'role': 'user', 'content': data_prompt}
-            ],
-            model=model,
-            **kwargs
-        )
-        return str(response.choices[0].message.content)
+    return await _create_completion(
+        provider,
+        model,
+        [
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': data_prompt}
+        ],
+        bypass_cache=bypass_cache,
+        priority=priority,
+        **kwargs
+    )
 
 async def complete_task_local(system_prompt: str, data_prompt: str) -> str:
-    async with AsyncOpenAI() as ai:
-        response = await ai.chat.completions.create( # type: ignore
-            messages=[
-                {'role': 'system', 'content': system_prompt},
-                {'role': 'user', 'content': data_prompt}
-            ]
-        )
-        return str(response.choices[0].message.content)
+    ai = client_registry.get('openai')
+    response = await ai.chat.completions.create( # type: ignore
+        messages=[
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': data_prompt}
+        ]
+    )
+    return str(response.choices[0].message.content)
 
-async def send_once(messages: list, model = 'gpt-4o-mini', **kwargs) -> str:
-    async with AsyncOpenAI() as ai:
-        response = await ai.chat.completions.create(
-                model=model,
-                messages=messages,
-                **kwargs
-        )
-        return str(response.choices[0].message.content)
+async def send_once(
+        messages: list,
+        model = 'gpt-4o-mini',
+        bypass_cache: bool = False,
+        priority: int = Priority.DEFAULT,
+        **kwargs
+) -> str:
+    return await _create_completion('openai', model, messages, bypass_cache=bypass_cache, priority=priority, **kwargs)
+
+def stream_once(
+        messages: list,
+        model = 'gpt-4o-mini',
+        bypass_cache: bool = False,
+        priority: int = Priority.INTERACTIVE,
+        **kwargs
+) -> AsyncIterator[str]:
+    '''Streaming variant of send_once, yields the response text as it is generated'''
+    return _stream_completion('openai', model, messages, bypass_cache=bypass_cache, priority=priority, **kwargs)
 
 async def ask_about_image(
         system_prompt: str,
         image: bytes,
         user_msg: str,
-        model: Literal['gpt-4o', 'gpt-4o-mini'] = 'gpt-4o-mini'
+        model: Literal['gpt-4o', 'gpt-4o-mini'] = 'gpt-4o-mini',
+        priority: int = Priority.DEFAULT,
+        detail: ImageDetail = 'auto',
+        max_edge: int = IMAGE_MAX_EDGE,
+        bypass_cache: bool = False,
 ):
-    img_base64 = base64.b64encode(image).decode()
-    async with AsyncOpenAI() as ai:
-        response = await ai.chat.completions.create(
+    '''Ask the vision model about the image, answers are cached by the image content and prompts'''
+    async def ask() -> str:
+        processed_image = await preprocess_image(image, max_edge, detail)
+        messages = _image_messages(system_prompt, processed_image, user_msg, detail)
+        ai = client_registry.get('openai')
+        response = await scheduler.submit(
+            lambda: ai.chat.completions.create(
+                model=model,
+                messages=messages # type: ignore
+            ),
+            provider='openai',
             model=model,
-            messages=[
-                {'role': 'system', 'content': system_prompt},
-                {'role': 'user', 'content': [ # type: ignore
-                    {'type': 'text', 'text': user_msg},
-                    {'type': 'image_url', 'image_url': {'url': f'data:image/jpeg;base64,{img_base64}'}}
-                ]}
-            ]
+            tokens=estimate_tokens(system_prompt + user_msg) + vision_tokens(processed_image, detail),
+            priority=priority,
         )
-    return str(response.choices[0].message.content)
+        return str(response.choices[0].message.content)
 
+    if bypass_cache:
+        return await ask()
+    prompt = '\0'.join([system_prompt, user_msg, detail, str(max_edge)])
+    return await media_cache.get_or_create(image, model, prompt, ask)
 
-async def transcribe(audio_file: bytes):
-    file_buffer = io.BytesIO(audio_file)
-    file_buffer.name = 'audio.m4a'
-    async with AsyncOpenAI(
-        base_url='https://api.groq.com/openai/v1',
-        api_key=os.environ['GROQ_API_KEY']
-    ) as ai:
-        try:
-            LOG.info('Trying to transcribe the data {}',audio_file[:10])
-            response = await ai.audio.transcriptions.create(
-                model='whisper-large-v3',
-                file=file_buffer
+async def stream_about_image(
+        system_prompt: str,
+        image: bytes,
+        user_msg: str,
+        model: Literal['gpt-4o', 'gpt-4o-mini'] = 'gpt-4o-mini',
+        priority: int = Priority.INTERACTIVE,
+        detail: ImageDetail = 'auto',
+        max_edge: int = IMAGE_MAX_EDGE,
+) -> AsyncIterator[str]:
+    '''Streaming variant of ask_about_image'''
+    processed_image = await preprocess_image(image, max_edge, detail)
+    deltas = _stream_completion(
+        'openai',
+        model,
+        _image_messages(system_prompt, processed_image, user_msg, detail),
+        bypass_cache=True,
+        priority=priority,
+        tokens=estimate_tokens(system_prompt + user_msg) + vision_tokens(processed_image, detail),
+    )
+    async with aclosing(deltas):
+        async for delta in deltas:
+            yield delta
+
+
+async def transcribe(
+        audio_file: bytes,
+        priority: int = Priority.DEFAULT,
+        long_audio: bool | None = None,
+        max_parallel_segments: int = 4,
+        bypass_cache: bool = False,
+):
+    '''Transcribe the audio file, long recordings (by default the ones over the upload limit)
+    are split into overlapping segments transcribed concurrently and stitched back together.
+    Transcriptions are cached by the content of the file.
+    '''
+    if bypass_cache:
+        return await _transcribe(audio_file, priority, long_audio, max_parallel_segments)
+    return await media_cache.get_or_create(
+        audio_file,
+        TRANSCRIPTION_MODEL,
+        '',
+        lambda: _transcribe(audio_file, priority, long_audio, max_parallel_segments)
+    )
+
+async def _transcribe(audio_file: bytes, priority: int, long_audio: bool | None, max_parallel_segments: int) -> str:
+    if long_audio is None:
+        long_audio = len(audio_file) > audio.AUDIO_MAX_UPLOAD_BYTES
+    if not long_audio:
+        return await _transcribe_file(audio_file, 'audio.m4a', priority)
+
+    try:
+        segments = await audio.split_audio(audio_file)
+    except (OSError, ValueError) as err:
+        raise ApiException(f'Unable to split the audio file {err}')
+    limit = asyncio.Semaphore(max_parallel_segments)
+
+    async def transcribe_segment(segment: bytes) -> str:
+        async with limit:
+            return await _transcribe_file(segment, 'segment.flac', priority)
+
+    transcripts = await asyncio.gather(*[transcribe_segment(segment) for segment in segments])
+    return audio.stitch_transcripts(transcripts)
+
+async def _transcribe_file(audio_file: bytes, file_name: str, priority: int = Priority.DEFAULT) -> str:
+    def audio_buffer():
+        file_buffer = io.BytesIO(audio_file)
+        file_buffer.name = file_name
+        return file_buffer
+
+    ai = client_registry.get('groq')
+    audio_hash = hashlib.sha256(audio_file).hexdigest()
+    try:
+        LOG.info('Trying to transcribe the data {}',audio_file[:10])
+        response = await transcriptions_flight.do(
+            f'{TRANSCRIPTION_MODEL}:{audio_hash}',
+            lambda: scheduler.submit(
+                lambda: ai.audio.transcriptions.create(
+                    model=TRANSCRIPTION_MODEL,
+                    file=audio_buffer()
+                ),
+                provider='groq',
+                model=TRANSCRIPTION_MODEL,
+                priority=priority,
             )
-            LOG.info('Transcription endpoint responded with {}', response.model_dump_json())
-            return response.model_dump()['text']
-        except Exception as err:
-            err_msg = 'Error occured when trying to transcribe the audio file {}'
-            LOG.error(err_msg, str(err))
-            raise ApiException(err_msg.replace('{}', str(err)))
+        )
+        LOG.info('Transcription endpoint responded with {}', response.model_dump_json())
+        return response.model_dump()['text']
+    except Exception as err:
+        err_msg = 'Error occured when trying to transcribe the audio file {}'
+        LOG.error(err_msg, str(err))
+        raise ApiException(err_msg.replace('{}', str(err)))
 
 async def generate_image(
         prompt: str,
         model: str = 'dall-e-3',
         response_format: Literal['url','b64_json'] = 'url',
         **opts):
-    async with AsyncOpenAI() as ai:
-        response = await ai.images.generate(
+    ai = client_registry.get('openai')
+    response = await scheduler.submit(
+        lambda: ai.images.generate(
             model=model,
             prompt=prompt,
             response_format=response_format,
             **opts
-        )
-        image_response = response.data[0].url if response_format == 'url' else response.data[0].b64_json
-        if image_response:
-            return image_response
-        else:
-            raise ApiException()
+        ),
+        provider='openai',
+        model=model,
+    )
+    image_response = response.data[0].url if response_format == 'url' else response.data[0].b64_json
+    if image_response:
+        return image_response
+    else:
+        raise ApiException()
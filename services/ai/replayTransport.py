@@ -0,0 +1,281 @@
+import asyncio
+import hashlib
+import json
+import os
+import pathlib as p
+import random
+import re
+import time
+from dataclasses import dataclass
+
+import httpx
+from loguru import logger as LOG
+
+# '' talks to the real APIs, 'record' stores their responses, 'replay' serves stored or synthesized ones
+TRANSPORT_MODE = os.environ.get('LLM_TRANSPORT_MODE', '')
+REPLAY_FILE = os.environ.get('LLM_REPLAY_FILE', './.cache/llm_recordings.jsonl')
+REPLAY_LATENCY = float(os.environ.get('LLM_REPLAY_LATENCY', 0))
+REPLAY_JITTER = float(os.environ.get('LLM_REPLAY_JITTER', 0))
+REPLAY_ERROR_RATE = float(os.environ.get('LLM_REPLAY_ERROR_RATE', 0))
+REPLAY_ERROR_STATUS = int(os.environ.get('LLM_REPLAY_ERROR_STATUS', 429))
+REPLAY_EMBEDDING_DIM = int(os.environ.get('LLM_REPLAY_EMBEDDING_DIM', 768))
+# Describe the upstream body, which is forwarded already decoded
+DECODED_BODY_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding'}
+
+
+def request_key(request: httpx.Request, body: bytes) -> str:
+    '''Stable key of a request, independent of JSON key order and multipart boundaries'''
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('application/json'):
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True).encode()
+        except ValueError:
+            pass
+    elif 'boundary=' in content_type:
+        boundary = content_type.split('boundary=')[-1].encode()
+        body = body.replace(boundary, b'boundary')
+    digest = hashlib.sha256(body).hexdigest()
+    return f'{request.method} {request.url.path} {digest}'
+
+
+def _word_vector(word: str, dimension: int) -> list[float]:
+    rng = random.Random(hashlib.sha256(word.encode()).digest())
+    return [rng.gauss(0, 1) for _ in range(dimension)]
+
+
+def fake_embedding(text: str, dimension: int = REPLAY_EMBEDDING_DIM) -> list[float]:
+    '''Deterministic unit vector, the sum of a random vector per word,
+    so texts sharing words are similar as they are with a real embedding model
+    '''
+    words = re.findall(r'\w+', text.lower()) or [text]
+    vector = [sum(values) for values in zip(*(_word_vector(word, dimension) for word in words))]
+    norm = sum(v * v for v in vector) ** 0.5 or 1
+    return [v / norm for v in vector]
+
+
+@dataclass
+class ReplayStats:
+    replayed: int = 0
+    synthesized: int = 0
+    injected_errors: int = 0
+    recorded: int = 0
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    '''In-process stand-in for OpenAI compatible APIs.
+
+    Answers with responses recorded by RecordingTransport, or synthesizes
+    a plausible one when nothing was recorded for a request. Latency and
+    error responses can be injected to exercise the retry and scheduling paths.
+    '''
+    def __init__(
+            self,
+            recordings: str | None = REPLAY_FILE,
+            latency: float = REPLAY_LATENCY,
+            jitter: float = REPLAY_JITTER,
+            error_rate: float = REPLAY_ERROR_RATE,
+            error_status: int = REPLAY_ERROR_STATUS,
+            synthesize: bool = True,
+            seed: int | None = None,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.synthesize = synthesize
+        self.stats = ReplayStats()
+        self._random = random.Random(seed)
+        self._recordings: dict[str, dict] = {}
+        if recordings and p.Path(recordings).exists():
+            with open(recordings) as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._recordings[entry['key']] = entry
+            LOG.info('Loaded {} recorded responses from {}', len(self._recordings), recordings)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self._random.random() < self.error_rate:
+            self.stats.injected_errors += 1
+            return httpx.Response(
+                self.error_status,
+                headers={'retry-after': '0'},
+                json={'error': {'message': 'Injected error', 'type': 'replay', 'code': self.error_status}},
+                request=request,
+            )
+
+        entry = self._recordings.get(request_key(request, body))
+        if entry is not None:
+            self.stats.replayed += 1
+            return httpx.Response(
+                entry['status'],
+                headers=entry['headers'],
+                content=entry['body'].encode(),
+                request=request,
+            )
+
+        if not self.synthesize:
+            return httpx.Response(404, json={'error': {'message': 'No recorded response'}}, request=request)
+        self.stats.synthesized += 1
+        return self._synthesize(request, body)
+
+    def _synthesize(self, request: httpx.Request, body: bytes) -> httpx.Response:
+        path = request.url.path
+        payload = {}
+        if request.headers.get('content-type', '').startswith('application/json'):
+            payload = json.loads(body or b'{}')
+        created = int(time.time())
+
+        if path.endswith('/chat/completions'):
+            messages = payload.get('messages', [])
+            content = messages[-1]['content'] if messages else ''
+            text = content if isinstance(content, str) else json.dumps(content)[:200]
+            text = f'Replayed answer to: {text}'
+            if payload.get('stream'):
+                return self._stream(request, payload.get('model', ''), text, created)
+            return httpx.Response(200, json={
+                'id': 'chatcmpl-replay',
+                'object': 'chat.completion',
+                'created': created,
+                'model': payload.get('model', ''),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': len(body) // 4, 'completion_tokens': len(text) // 4, 'total_tokens': (len(body) + len(text)) // 4},
+            }, request=request)
+
+        if path.endswith('/embeddings'):
+            inputs = payload.get('input', [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            return httpx.Response(200, json={
+                'object': 'list',
+                'model': payload.get('model', ''),
+                'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(text)} for i, text in enumerate(inputs)],
+                'usage': {'prompt_tokens': len(body) // 4, 'total_tokens': len(body) // 4},
+            }, request=request)
+
+        if path.endswith('/audio/transcriptions'):
+            return httpx.Response(200, json={'text': f'Replayed transcription {hashlib.sha256(body).hexdigest()[:8]}'}, request=request)
+
+        if path.endswith('/images/generations'):
+            return httpx.Response(200, json={'created': created, 'data': [{'url': 'https://example.com/replay.png', 'b64_json': ''}]}, request=request)
+
+        # AI_Devs verification endpoint and any other JSON API
+        return httpx.Response(200, json={'code': 0, 'message': 'Replayed'}, request=request)
+
+    def _stream(self, request: httpx.Request, model: str, text: str, created: int) -> httpx.Response:
+        events = []
+        for word in text.split(' '):
+            chunk = {
+                'id': 'chatcmpl-replay',
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}],
+            }
+            events.append(f'data: {json.dumps(chunk)}\n\n')
+        events.append('data: [DONE]\n\n')
+        return httpx.Response(200, headers={'content-type': 'text/event-stream'}, content=''.join(events).encode(), request=request)
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    '''Forwards requests to the wrapped transport and appends the responses to a JSONL file'''
+    def __init__(self, transport: httpx.AsyncBaseTransport, recordings: str = REPLAY_FILE) -> None:
+        self._transport = transport
+        self.path = p.Path(recordings)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.stats = ReplayStats()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        response = await self._transport.handle_async_request(request)
+        content = await response.aread()
+        if response.status_code < 400:
+            entry = {
+                'key': request_key(request, body),
+                'status': response.status_code,
+                'headers': {'content-type': response.headers.get('content-type', 'application/json')},
+                'body': content.decode(errors='replace'),
+            }
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(entry) + '\n')
+            self.stats.recorded += 1
+        return httpx.Response(
+            response.status_code,
+            headers=[(name, value) for name, value in response.headers.multi_items() if name.lower() not in DECODED_BODY_HEADERS],
+            content=content,
+            request=request,
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def offline_transport(transport: httpx.AsyncBaseTransport | None = None) -> httpx.AsyncBaseTransport | None:
+    '''Transport selected by LLM_TRANSPORT_MODE, `transport` is returned when running against the real APIs'''
+    match TRANSPORT_MODE:
+        case 'replay':
+            return ReplayTransport()
+        case 'record':
+            return RecordingTransport(transport or httpx.AsyncHTTPTransport())
+        case _:
+            return transport
+
+
+# TESTS ====
+def test_synthesized_embeddings_are_deterministic():
+    async def run():
+        async with httpx.AsyncClient(transport=ReplayTransport(recordings=None)) as client:
+            first = await client.post('http://llm/v1/embeddings', json={'input': ['a', 'b'], 'model': 'm'})
+            second = await client.post('http://llm/v1/embeddings', json={'model': 'm', 'input': ['a']})
+            return first.json(), second.json()
+
+    first, second = asyncio.run(run())
+    assert len(first['data']) == 2
+    assert first['data'][0]['embedding'] == second['data'][0]['embedding']
+    assert len(first['data'][0]['embedding']) == REPLAY_EMBEDDING_DIM
+
+
+def test_recorded_responses_are_replayed(tmp_path):
+    recordings = tmp_path / 'recordings.jsonl'
+    upstream = httpx.MockTransport(lambda request: httpx.Response(200, json={'code': 0, 'message': 'Recorded'}))
+
+    async def run():
+        async with httpx.AsyncClient(transport=RecordingTransport(upstream, str(recordings))) as client:
+            await client.post('http://centrala/report', json={'task': 'x', 'answer': 1})
+        async with httpx.AsyncClient(transport=ReplayTransport(recordings=str(recordings))) as client:
+            return (await client.post('http://centrala/report', json={'answer': 1, 'task': 'x'})).json()
+
+    assert asyncio.run(run()) == {'code': 0, 'message': 'Recorded'}
+
+
+def test_recording_forwards_decoded_gzip_bodies(tmp_path):
+    import gzip
+
+    body = json.dumps({'code': 0, 'message': 'Compressed'}).encode()
+    upstream = httpx.MockTransport(lambda request: httpx.Response(
+        200,
+        headers={'content-type': 'application/json', 'content-encoding': 'gzip'},
+        content=gzip.compress(body),
+    ))
+
+    async def run():
+        async with httpx.AsyncClient(transport=RecordingTransport(upstream, str(tmp_path / 'recordings.jsonl'))) as client:
+            return (await client.post('http://centrala/report', json={'task': 'x'})).json()
+
+    assert asyncio.run(run()) == {'code': 0, 'message': 'Compressed'}
+    assert json.loads((tmp_path / 'recordings.jsonl').read_text())['body'] == body.decode()
+
+
+def test_error_injection():
+    async def run():
+        async with httpx.AsyncClient(transport=ReplayTransport(recordings=None, error_rate=1)) as client:
+            return await client.post('http://llm/v1/chat/completions', json={'messages': []})
+
+    response = asyncio.run(run())
+    assert response.status_code == REPLAY_ERROR_STATUS
+    assert response.headers['retry-after'] == '0'
@@ -0,0 +1,425 @@
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, TypeVar
+
+import httpx
+import openai
+from loguru import logger as LOG
+
+from services.coordination import SharedTokenBucket
+from services.data_transformers.chunker import estimate_tokens as estimate_text_tokens
+
+T = TypeVar('T')
+
+MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 5))
+RETRY_BASE_DELAY = float(os.environ.get('LLM_RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.environ.get('LLM_RETRY_MAX_DELAY', 60))
+# Share the request and token budgets between the worker processes of the server,
+# only worth the file lock per call when it runs more than one
+SHARED_LIMITS = os.environ.get('LLM_SHARED_LIMITS', '0').lower() in ('1', 'true', 'yes')
+
+
+class Priority(IntEnum):
+    '''Lanes of the scheduler, lower value is served first'''
+    INTERACTIVE = 0
+    DEFAULT = 1
+    BATCH = 2
+
+
+@dataclass
+class RateLimits:
+    requests_per_minute: float = 0
+    tokens_per_minute: float = 0
+    max_concurrency: int = 8
+
+
+DEFAULT_LIMITS: dict[str, RateLimits] = {
+    'openai': RateLimits(requests_per_minute=500, tokens_per_minute=200_000, max_concurrency=16),
+    'groq': RateLimits(requests_per_minute=20, tokens_per_minute=0, max_concurrency=4),
+    'ollama': RateLimits(max_concurrency=2),
+}
+
+
+def load_limits() -> dict[str, RateLimits]:
+    '''Default limits merged with LLM_RATE_LIMITS,
+    a JSON object keyed by "provider" or "provider/model"
+    '''
+    limits = dict(DEFAULT_LIMITS)
+    overrides = json.loads(os.environ.get('LLM_RATE_LIMITS', '{}'))
+    for key, values in overrides.items():
+        limits[key] = RateLimits(**values)
+    return limits
+
+
+def estimate_tokens(payload: Any) -> int:
+    '''Token count of a request payload, used to charge the tokens per minute budget'''
+    text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False, default=str)
+    return estimate_text_tokens(text)
+
+
+class TokenBucket:
+    '''Continuously refilling bucket holding up to one minute worth of capacity'''
+    def __init__(self, per_minute: float) -> None:
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def block(self, seconds: float) -> None:
+        '''Stop handing out capacity, used when the provider asks to back off'''
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, amount: float = 1) -> float:
+        '''Take `amount` from the bucket, returns the time spent waiting'''
+        if self.rate <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            blocked_for = self.blocked_until - time.monotonic()
+            if blocked_for > 0:
+                await asyncio.sleep(blocked_for)
+                waited += blocked_for
+                continue
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return waited
+            delay = (amount - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+
+
+class PriorityLimiter:
+    '''Semaphore handing free slots to the waiter with the highest priority first'''
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.active = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for *_, waiter in self._waiters if not waiter.done())
+
+    async def acquire(self, priority: int = Priority.DEFAULT) -> None:
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # The slot was already handed over to us, pass it on
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            *_, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+@dataclass
+class LaneStats:
+    submitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    retries: int = 0
+    throttled_seconds: float = 0.0
+
+
+@dataclass
+class Budget:
+    '''Request and token buckets of a limits entry, taken by one caller at a time in priority order'''
+    requests: TokenBucket | SharedTokenBucket
+    tokens: TokenBucket | SharedTokenBucket
+    turn: PriorityLimiter = field(default_factory=lambda: PriorityLimiter(1))
+
+    async def acquire(self, tokens: int, priority: int) -> float:
+        '''Wait for the turn of the caller and take its budget, returns the time spent throttled'''
+        await self.turn.acquire(priority)
+        try:
+            return await self.requests.acquire(1) + await self.tokens.acquire(tokens)
+        finally:
+            self.turn.release()
+
+
+@dataclass
+class Lane:
+    limiter: PriorityLimiter
+    budget: Budget
+    stats: LaneStats = field(default_factory=LaneStats)
+
+    @property
+    def requests(self) -> TokenBucket | SharedTokenBucket:
+        return self.budget.requests
+
+    @property
+    def tokens(self) -> TokenBucket | SharedTokenBucket:
+        return self.budget.tokens
+
+
+def retry_after(err: BaseException) -> float | None:
+    '''Seconds the provider asked us to wait, read from Retry-After headers'''
+    response = getattr(err, 'response', None)
+    if not isinstance(response, httpx.Response):
+        return None
+    headers = response.headers
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(err: BaseException) -> bool:
+    if isinstance(err, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    status = getattr(err, 'status_code', None)
+    if status is None and isinstance(err, httpx.HTTPStatusError):
+        status = err.response.status_code
+    return status is not None and (status == 429 or status >= 500)
+
+
+class Scheduler:
+    '''Submits model calls under per provider concurrency and per model
+    request/token budgets, retrying throttled and failed calls with jittered backoff.
+    With `shared` the budgets are kept in files every worker process draws from,
+    concurrency stays a per process limit
+    '''
+    def __init__(
+            self,
+            limits: dict[str, RateLimits] | None = None,
+            max_retries: int = MAX_RETRIES,
+            base_delay: float = RETRY_BASE_DELAY,
+            max_delay: float = RETRY_MAX_DELAY,
+            shared: bool = SHARED_LIMITS,
+    ) -> None:
+        self.limits = limits if limits is not None else load_limits()
+        self.shared = shared
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._limiters: dict[str, PriorityLimiter] = {}
+        self._budgets: dict[str, Budget] = {}
+        self._lanes: dict[str, Lane] = {}
+
+    def _limits_key(self, provider: str, model: str) -> str:
+        '''Entry of the limits the model is under, models without their own share the provider one'''
+        key = f'{provider}/{model}'
+        return key if key in self.limits else provider
+
+    def _limits_for(self, provider: str, model: str) -> RateLimits:
+        return self.limits.get(self._limits_key(provider, model)) or RateLimits()
+
+    def _bucket(self, name: str, per_minute: float) -> TokenBucket | SharedTokenBucket:
+        if self.shared and per_minute > 0:
+            return SharedTokenBucket(name, per_minute)
+        return TokenBucket(per_minute)
+
+    def lane(self, provider: str, model: str) -> Lane:
+        key = f'{provider}/{model}'
+        lane = self._lanes.get(key)
+        if lane is None:
+            limits = self._limits_for(provider, model)
+            provider_limits = self.limits.get(provider) or limits
+            limiter = self._limiters.setdefault(provider, PriorityLimiter(provider_limits.max_concurrency))
+            budget_key = self._limits_key(provider, model)
+            budget = self._budgets.get(budget_key)
+            if budget is None:
+                budget = Budget(self._bucket(f'{budget_key}-requests', limits.requests_per_minute), self._bucket(f'{budget_key}-tokens', limits.tokens_per_minute))
+                self._budgets[budget_key] = budget
+            lane = Lane(limiter, budget)
+            self._lanes[key] = lane
+        return lane
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def submit(
+            self,
+            call: Callable[[], Awaitable[T]],
+            provider: str = 'openai',
+            model: str = '',
+            tokens: int = 0,
+            priority: int = Priority.DEFAULT,
+    ) -> T:
+        lane = self.lane(provider, model)
+        lane.stats.submitted += 1
+        attempt = 0
+        while True:
+            # A call waiting for budget does not hold a concurrency slot others could use,
+            # the budget is handed out in priority order as the slots are
+            lane.stats.throttled_seconds += await lane.budget.acquire(tokens, priority)
+            await lane.limiter.acquire(priority)
+            try:
+                result = await call()
+                lane.stats.completed += 1
+                return result
+            except Exception as err:
+                if attempt >= self.max_retries or not is_retryable(err):
+                    lane.stats.failed += 1
+                    raise
+                wait = retry_after(err)
+                if wait is not None:
+                    lane.requests.block(wait)
+                    delay = wait + random.uniform(0, self.base_delay)
+                else:
+                    delay = self._backoff(attempt)
+                attempt += 1
+                lane.stats.retries += 1
+                LOG.warning('{}/{} call failed ({}), retry {}/{} in {:.2f}s', provider, model, err, attempt, self.max_retries, delay)
+            finally:
+                lane.limiter.release()
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            key: {
+                **lane.stats.__dict__,
+                'active': lane.limiter.active,
+                'waiting': lane.limiter.waiting,
+            }
+            for key, lane in self._lanes.items()
+        }
+
+
+scheduler = Scheduler()
+
+
+# TESTS ====
+def test_priority_limiter_serves_interactive_first():
+    order = []
+
+    async def run():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire()
+
+        async def worker(name: str, priority: int):
+            await limiter.acquire(priority)
+            order.append(name)
+            limiter.release()
+
+        tasks = [
+            asyncio.create_task(worker('batch', Priority.BATCH)),
+            asyncio.create_task(worker('interactive', Priority.INTERACTIVE)),
+        ]
+        await asyncio.sleep(0)
+        limiter.release()
+        await asyncio.gather(*tasks)
+        assert limiter.active == 0
+
+    asyncio.run(run())
+    assert order == ['interactive', 'batch']
+
+
+def test_models_under_provider_limits_share_its_budget():
+    scheduler = Scheduler(limits={'groq': RateLimits(requests_per_minute=20), 'groq/llama-3.3-70b': RateLimits(requests_per_minute=5)})
+    assert scheduler.lane('groq', 'whisper-large-v3').requests is scheduler.lane('groq', 'llama-3.2-90b').requests
+    assert scheduler.lane('groq', 'whisper-large-v3').requests is not scheduler.lane('groq', 'llama-3.3-70b').requests
+    assert scheduler.lane('groq', 'llama-3.3-70b').requests.capacity == 5
+
+
+def test_throttled_calls_do_not_hold_a_slot():
+    scheduler = Scheduler(limits={'openai': RateLimits(max_concurrency=1), 'openai/o1': RateLimits(requests_per_minute=1)}, shared=False)
+
+    async def call():
+        return 'done'
+
+    async def run():
+        await scheduler.submit(call, 'openai', 'o1')
+        # Waits about a minute for the budget of o1
+        throttled = asyncio.create_task(scheduler.submit(call, 'openai', 'o1'))
+        await asyncio.sleep(0.01)
+        try:
+            return await asyncio.wait_for(scheduler.submit(call, 'openai', 'gpt-4o-mini'), timeout=1)
+        finally:
+            throttled.cancel()
+
+    assert asyncio.run(run()) == 'done'
+
+
+def test_rate_budget_serves_interactive_first():
+    scheduler = Scheduler(limits={'openai': RateLimits(requests_per_minute=600, max_concurrency=16)}, shared=False)
+    order = []
+
+    def call(name: str):
+        async def run():
+            order.append(name)
+        return run
+
+    async def run():
+        bucket = scheduler.lane('openai', 'gpt-4o-mini').requests
+        assert isinstance(bucket, TokenBucket)
+        # The budget, not the concurrency, is what the calls wait for
+        bucket.tokens = 0
+        tasks = [asyncio.create_task(scheduler.submit(call(f'batch {i}'), 'openai', 'gpt-4o-mini', priority=Priority.BATCH)) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(scheduler.submit(call('interactive'), 'openai', 'gpt-4o-mini', priority=Priority.INTERACTIVE)))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    # The first batch call already waits for the refill when the interactive one arrives
+    assert order == ['batch 0', 'interactive', 'batch 1', 'batch 2']
+
+
+def test_scheduler_retries_throttled_calls():
+    calls = []
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    throttled = httpx.Response(429, headers={'retry-after': '0'}, request=request)
+
+    async def call():
+        calls.append(1)
+        if len(calls) < 3:
+            raise openai.RateLimitError('Too many requests', response=throttled, body=None)
+        return 'done'
+
+    scheduler = Scheduler(limits={}, base_delay=0)
+    assert asyncio.run(scheduler.submit(call, 'openai', 'gpt-4o-mini')) == 'done'
+    assert scheduler.stats()['openai/gpt-4o-mini']['retries'] == 2
+
+
+def test_scheduler_does_not_retry_client_errors():
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    bad_request = httpx.Response(400, request=request)
+
+    async def call():
+        raise openai.BadRequestError('Bad request', response=bad_request, body=None)
+
+    scheduler = Scheduler(limits={}, base_delay=0)
+    try:
+        asyncio.run(scheduler.submit(call))
+        assert False, 'BadRequestError should be raised'
+    except openai.BadRequestError:
+        pass
@@ -0,0 +1,136 @@
+import asyncio
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable, Generic, TypeVar
+
+from loguru import logger as LOG
+
+T = TypeVar('T')
+
+
+@dataclass
+class FlightStats:
+    calls: int = 0
+    executions: int = 0
+    collapsed: int = 0
+    abandoned: int = 0
+
+
+@dataclass
+class _Flight(Generic[T]):
+    task: asyncio.Future[T]
+    waiters: int = 0
+
+
+class SingleFlight:
+    '''Coalesces concurrent calls sharing a key into a single upstream call.
+
+    The first caller starts the upstream task and later callers await the same
+    result. A cancelled caller only detaches itself, the upstream task is
+    cancelled once every caller waiting for it is gone.
+    '''
+    groups: dict[str, 'SingleFlight'] = {}
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.stats = FlightStats()
+        self._flights: dict[str, _Flight[Any]] = {}
+        SingleFlight.groups[name] = self
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        self.stats.calls += 1
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.stats.executions += 1
+        else:
+            self.stats.collapsed += 1
+            LOG.debug('Joining in-flight {} call {}', self.name, key[:12])
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Nobody is interested in the result anymore
+                self.stats.abandoned += 1
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    @classmethod
+    def all_stats(cls) -> dict[str, dict[str, int]]:
+        return {name: {**asdict(group.stats), 'in_flight': group.in_flight} for name, group in cls.groups.items()}
+
+
+# TESTS ====
+def test_concurrent_calls_share_one_execution():
+    executions = []
+
+    async def upstream():
+        executions.append(1)
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def run():
+        flight = SingleFlight('test-share')
+        results = await asyncio.gather(*[flight.do('key', upstream) for _ in range(5)])
+        return flight, results
+
+    flight, results = asyncio.run(run())
+    assert results == ['result'] * 5
+    assert len(executions) == 1
+    assert flight.stats.collapsed == 4
+    assert flight.in_flight == 0
+
+
+def test_cancelled_caller_does_not_cancel_shared_call():
+    async def upstream():
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def run():
+        flight = SingleFlight('test-cancel')
+        first = asyncio.create_task(flight.do('key', upstream))
+        second = asyncio.create_task(flight.do('key', upstream))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 'result'
+        assert first.cancelled()
+        return flight
+
+    flight = asyncio.run(run())
+    assert flight.stats.abandoned == 0
+
+
+def test_upstream_is_cancelled_when_all_callers_leave():
+    cancelled = []
+
+    async def upstream():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def run():
+        flight = SingleFlight('test-abandon')
+        caller = asyncio.create_task(flight.do('key', upstream))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.sleep(0.01)
+        return flight
+
+    flight = asyncio.run(run())
+    assert cancelled == [1]
+    assert flight.stats.abandoned == 1
+    assert flight.in_flight == 0
@@ -1,17 +1,18 @@
 import os
-from httpx import AsyncClient, HTTPStatusError
+import httpx
+from httpx import HTTPStatusError
 from loguru import logger as LOG
 
 from models.ai_devs import AiDevsAnswer, AiDevsResponse
+from services.web.http_pool import http_pool
 
 VERIFICATION_URL = os.environ.get('AI_DEVS_TASK_URL','https://centrala.ag3nts.org/report')
 
-async def send_answer(answer: AiDevsAnswer, url: str = VERIFICATION_URL):
+async def send_answer(answer: AiDevsAnswer, url: str = VERIFICATION_URL, timeout: float | httpx.Timeout | None = None):
     LOG.info('Sending task answer, {} to {}', answer.model_dump_json(), url)
-    async with AsyncClient() as client:
-        api_response = await client.post(url=url, json=answer.model_dump())
-        try:
-            api_response.raise_for_status()
-        except HTTPStatusError as err:
-            return AiDevsResponse(code=err.response.status_code, message=err.response.json())
-        return AiDevsResponse(**api_response.json())
+    api_response = await http_pool.request('POST', url, json=answer.model_dump(), timeout=timeout, offline=True)
+    try:
+        api_response.raise_for_status()
+    except HTTPStatusError as err:
+        return AiDevsResponse(code=err.response.status_code, message=err.response.json())
+    return AiDevsResponse(**api_response.json())
@@ -0,0 +1,257 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import pathlib as p
+import re
+import struct
+import time
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar('T')
+
+# Shared by every worker of the server, has to be on a local filesystem for flock to work
+COORDINATION_DIR = os.environ.get('COORDINATION_DIR', './.cache/coordination')
+# Bounds of the polling interval of locks awaited from the event loop
+POLL_MIN_SECONDS = 0.001
+POLL_MAX_SECONDS = 0.05
+
+
+@dataclass
+class CoordinationStats:
+    acquisitions: int = 0
+    contended: int = 0
+    wait_seconds: float = 0.0
+    computed: int = 0
+    reused: int = 0
+
+
+stats = CoordinationStats()
+
+
+def all_stats() -> dict:
+    return {**asdict(stats), 'wait_seconds': round(stats.wait_seconds, 3), 'pid': os.getpid()}
+
+
+class FileLock:
+    '''Exclusive flock on a file.
+
+    Every acquisition opens its own descriptor, so the lock excludes threads and
+    coroutines of the same process as well as other processes. Not reentrant.
+    With `remove` the holder deletes the file on release, so short-lived locks
+    do not pile up, and a waiter that got the lock of a deleted file tries again.
+    '''
+    def __init__(self, path: str | p.Path, remove: bool = False) -> None:
+        self.path = p.Path(path)
+        self.remove = remove
+        self.fd: int | None = None
+        self.waited = 0.0
+
+    def acquire(self, blocking: bool = True) -> bool:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            if not self.remove or self._current(fd):
+                break
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self.fd = fd
+        stats.acquisitions += 1
+        return True
+
+    def _current(self, fd: int) -> bool:
+        '''Whether the descriptor is still the file at the path, the previous holder may have deleted it'''
+        try:
+            return os.stat(self.path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def release(self) -> None:
+        if self.fd is not None:
+            if self.remove:
+                self.path.unlink(missing_ok=True)
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self) -> 'FileLock':
+        if not self.acquire(blocking=False):
+            started = time.perf_counter()
+            self.acquire()
+            self._contended(time.perf_counter() - started)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+    async def __aenter__(self) -> 'FileLock':
+        '''Polls instead of blocking, so the event loop keeps running while another process holds the lock'''
+        if self.acquire(blocking=False):
+            return self
+        started = time.perf_counter()
+        delay = POLL_MIN_SECONDS
+        while not self.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, POLL_MAX_SECONDS)
+        self._contended(time.perf_counter() - started)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+    def _contended(self, seconds: float) -> None:
+        self.waited = seconds
+        stats.contended += 1
+        stats.wait_seconds += seconds
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+def key_lock(namespace: str, key: str, directory: str = COORDINATION_DIR) -> FileLock:
+    '''Lock of a single key, its file only exists while the lock is held or awaited'''
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return FileLock(p.Path(directory) / 'locks' / _safe_name(namespace) / f'{digest}.lock', remove=True)
+
+
+async def compute_once(
+        namespace: str,
+        key: str,
+        lookup: Callable[[], Awaitable[T | None]],
+        compute: Callable[[], Awaitable[T]],
+        directory: str = COORDINATION_DIR,
+) -> T:
+    '''Run `compute` for a key in a single process at a time.
+
+    Callers check their cache first, then the lock holder computes and stores
+    the value while the other workers wait and find it with `lookup`.
+    '''
+    async with key_lock(namespace, key, directory):
+        found = await lookup()
+        if found is not None:
+            stats.reused += 1
+            return found
+        stats.computed += 1
+        return await compute()
+
+
+# tokens, last refill, blocked until, all in wall clock time shared by the processes
+BUCKET_STATE = struct.Struct('<ddd')
+
+
+class SharedTokenBucket:
+    '''TokenBucket whose state lives in a file locked on every update,
+    so the budget is shared by every worker process instead of multiplied by them
+    '''
+    def __init__(self, name: str, per_minute: float, directory: str = COORDINATION_DIR) -> None:
+        self.name = name
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.path = p.Path(directory) / 'buckets' / f'{_safe_name(name)}.bin'
+
+    def _update(self, change: Callable[[float, float, float, float], tuple[float, float, float, float]]) -> float:
+        '''Apply `change(now, tokens, updated, blocked_until)` to the state under the lock,
+        it returns the new state and the seconds to wait
+        '''
+        with FileLock(self.path) as lock:
+            assert lock.fd is not None
+            now = time.time()
+            raw = os.pread(lock.fd, BUCKET_STATE.size, 0)
+            tokens, updated, blocked_until = BUCKET_STATE.unpack(raw) if len(raw) == BUCKET_STATE.size else (self.capacity, now, 0.0)
+            tokens, updated, blocked_until, wait = change(now, tokens, updated, blocked_until)
+            os.pwrite(lock.fd, BUCKET_STATE.pack(tokens, updated, blocked_until), 0)
+            return wait
+
+    def block(self, seconds: float) -> None:
+        '''Stop handing out capacity in every process, used when the provider asks to back off'''
+        self._update(lambda now, tokens, updated, blocked_until: (tokens, updated, max(blocked_until, now + seconds), 0.0))
+
+    def _take(self, amount: float) -> float:
+        def change(now: float, tokens: float, updated: float, blocked_until: float):
+            if blocked_until > now:
+                return tokens, updated, blocked_until, blocked_until - now
+            tokens = min(self.capacity, tokens + max(now - updated, 0) * self.rate)
+            if tokens >= amount:
+                return tokens - amount, now, blocked_until, 0.0
+            return tokens, now, blocked_until, (amount - tokens) / self.rate
+        return self._update(change)
+
+    async def acquire(self, amount: float = 1) -> float:
+        '''Take `amount` from the bucket, returns the time spent waiting.
+        The state file is locked and updated in a worker thread, off the event loop
+        '''
+        if self.rate <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while (delay := await asyncio.to_thread(self._take, amount)) > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+        return waited
+
+
+# TESTS ====
+def test_file_lock_excludes_other_descriptors(tmp_path):
+    first = FileLock(tmp_path / 'a.lock')
+    with first:
+        assert not FileLock(tmp_path / 'a.lock').acquire(blocking=False)
+    second = FileLock(tmp_path / 'a.lock')
+    assert second.acquire(blocking=False)
+    second.release()
+
+
+def test_removed_lock_files_are_not_held_twice(tmp_path):
+    holder = FileLock(tmp_path / 'key.lock', remove=True)
+    holder.acquire()
+    # A waiter that opened the file before the holder deleted it
+    waiter_fd = os.open(tmp_path / 'key.lock', os.O_RDWR)
+    holder.release()
+    assert not (tmp_path / 'key.lock').exists()
+    assert not FileLock(tmp_path / 'key.lock', remove=True)._current(waiter_fd)
+    os.close(waiter_fd)
+
+
+def test_unrelated_keys_do_not_wait_for_each_other(tmp_path):
+    with key_lock('completions', 'a', str(tmp_path)):
+        other = key_lock('completions', 'b', str(tmp_path))
+        assert other.acquire(blocking=False)
+        other.release()
+        assert not key_lock('completions', 'a', str(tmp_path)).acquire(blocking=False)
+    assert list((tmp_path / 'locks' / 'completions').iterdir()) == []
+
+
+def test_compute_once_reuses_value_stored_by_lock_holder(tmp_path):
+    store: dict[str, str] = {}
+    calls = []
+
+    async def lookup():
+        return store.get('key')
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        store['key'] = 'value'
+        return 'value'
+
+    async def run():
+        # Two callers that both missed their cache, as two workers would
+        return await asyncio.gather(*[compute_once('test', 'key', lookup, compute, str(tmp_path)) for _ in range(2)])
+
+    assert asyncio.run(run()) == ['value', 'value']
+    assert calls == [1]
+
+
+def test_shared_bucket_budget_spans_instances(tmp_path):
+    first = SharedTokenBucket('openai/gpt-4o-mini', 60, str(tmp_path))
+    second = SharedTokenBucket('openai/gpt-4o-mini', 60, str(tmp_path))
+    assert asyncio.run(first.acquire(59)) == 0
+    assert second._take(2) > 0.5
+    second.block(30)
+    assert 29 < first._take(1) <= 30
@@ -0,0 +1,120 @@
+import asyncio
+import os
+import re
+import tempfile
+
+from loguru import logger as LOG
+
+from exceptions import ApiException
+
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+FFPROBE_BINARY = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+AUDIO_SEGMENT_SECONDS = float(os.environ.get('AUDIO_SEGMENT_SECONDS', 600))
+AUDIO_SEGMENT_OVERLAP = float(os.environ.get('AUDIO_SEGMENT_OVERLAP', 5))
+# Uploads above this size are split, the transcription endpoint rejects files over 25MB
+AUDIO_MAX_UPLOAD_BYTES = int(os.environ.get('AUDIO_MAX_UPLOAD_BYTES', 20 * 1024 * 1024))
+AUDIO_SPLIT_CONCURRENCY = int(os.environ.get('AUDIO_SPLIT_CONCURRENCY', os.cpu_count() or 1))
+
+
+async def _run(*args: str) -> bytes:
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        LOG.error('{} failed: {}', args[0], stderr.decode(errors='replace')[-500:])
+        raise ApiException(f'{args[0]} exited with code {process.returncode}')
+    return stdout
+
+
+async def probe_duration(path: str) -> float:
+    '''Duration of the audio file in seconds'''
+    output = await _run(FFPROBE_BINARY, '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path)
+    return float(output.decode().strip())
+
+
+def segment_bounds(duration: float, segment_seconds: float, overlap: float) -> list[tuple[float, float]]:
+    '''Start and length of overlapping segments covering the whole duration'''
+    step = segment_seconds - overlap
+    if step <= 0:
+        raise ValueError('Segment overlap has to be shorter than the segment')
+    bounds = []
+    start = 0.0
+    while True:
+        bounds.append((start, min(segment_seconds, duration - start)))
+        if start + segment_seconds >= duration:
+            return bounds
+        start += step
+
+
+async def split_audio(
+        audio: bytes,
+        segment_seconds: float = AUDIO_SEGMENT_SECONDS,
+        overlap: float = AUDIO_SEGMENT_OVERLAP,
+) -> list[bytes]:
+    '''Split the audio into overlapping mono 16kHz FLAC segments using ffmpeg subprocesses'''
+    with tempfile.TemporaryDirectory(prefix='audio-') as directory:
+        source = os.path.join(directory, 'source')
+        await asyncio.to_thread(_write, source, audio)
+        duration = await probe_duration(source)
+        bounds = segment_bounds(duration, segment_seconds, overlap)
+        LOG.info('Splitting {:.0f}s of audio into {} segments', duration, len(bounds))
+        limit = asyncio.Semaphore(AUDIO_SPLIT_CONCURRENCY)
+
+        async def cut(start: float, length: float) -> bytes:
+            async with limit:
+                return await _run(
+                    FFMPEG_BINARY, '-v', 'error', '-ss', f'{start:.3f}', '-t', f'{length:.3f}', '-i', source,
+                    '-vn', '-ac', '1', '-ar', '16000', '-c:a', 'flac', '-f', 'flac', 'pipe:1'
+                )
+
+        return list(await asyncio.gather(*[cut(start, length) for start, length in bounds]))
+
+
+def _write(path: str, data: bytes) -> None:
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+def _normalize(word: str) -> str:
+    return re.sub(r'\W', '', word.lower())
+
+
+def stitch_transcripts(parts: list[str], max_overlap_words: int = 40) -> str:
+    '''Join transcripts of consecutive overlapping segments,
+    dropping the words repeated at the start of the next segment
+    '''
+    words: list[str] = []
+    for part in parts:
+        part_words = part.split()
+        tail = [_normalize(w) for w in words[-max_overlap_words:]]
+        head = [_normalize(w) for w in part_words[:max_overlap_words]]
+        overlap = 0
+        for size in range(min(len(tail), len(head)), 0, -1):
+            if tail[-size:] == head[:size]:
+                overlap = size
+                break
+        words.extend(part_words[overlap:])
+    return ' '.join(words)
+
+
+# TESTS ====
+def test_segment_bounds_cover_duration():
+    bounds = segment_bounds(1500, 600, 5)
+    assert bounds == [(0.0, 600), (595.0, 600), (1190.0, 310.0)]
+    assert segment_bounds(100, 600, 5) == [(0.0, 100)]
+
+
+def test_stitch_removes_overlap():
+    parts = [
+        'Andrzej Maj teaches at the university',
+        'at the University. He moved to Kraków',
+        'to Kraków last year.',
+    ]
+    assert stitch_transcripts(parts) == 'Andrzej Maj teaches at the university He moved to Kraków last year.'
+
+
+def test_stitch_without_overlap():
+    assert stitch_transcripts(['one two', 'three four']) == 'one two three four'
@@ -1,5 +1,41 @@
+from functools import lru_cache
 from itertools import batched
+import json
 import re
+from typing import Any, Callable, Iterable, Iterator
+
+from loguru import logger as LOG
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Input tokens packed into a single request, leaves room for the answer in the output window
+CHUNK_TOKEN_TARGETS = {
+    'gpt-4o': 4000,
+    'gpt-4o-mini': 4000,
+    'gemma2:9b': 2000,
+}
+DEFAULT_CHUNK_TOKEN_TARGET = 2000
+
+
+@lru_cache
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model) # type: ignore
+    except KeyError:
+        return tiktoken.get_encoding('o200k_base') # type: ignore
+
+
+def estimate_tokens(text: str, model: str = 'gpt-4o-mini') -> int:
+    '''Token count of a text, exact when tiktoken is installed,
+    otherwise estimated from the character and word count
+    '''
+    if tiktoken is not None:
+        return len(_encoding(model).encode(text))
+    return max(len(text) // 4, int(len(text.split()) * 1.3)) + 1
+
 
 class StringChunker:
     def __init__(self, text: str) -> None:
@@ -9,9 +45,9 @@ class StringChunker:
         return re.split(reg, self._text)
 
 class BasicChunker:
-    _data: dict | list | str
+    _data: dict | list | str | Iterable
 
-    def __init__(self, iter: str) -> None:
+    def __init__(self, iter: str | Iterable) -> None:
         self._data = iter
 
     def chunk(self, number_of_items: int):
@@ -29,6 +65,37 @@ class BasicChunker:
         else:
             return list(batched(self._data, number_of_items))
 
+    def iter_token_chunks(
+            self,
+            max_tokens: int | None = None,
+            model: str = 'gpt-4o-mini',
+            keep: Callable[[Any], bool] | None = None,
+            serialize: Callable[[Any], str] = json.dumps,
+    ) -> Iterator[list | dict]:
+        '''Lazily pack items into chunks holding at most `max_tokens` tokens.
+        Items for which `keep` returns False are skipped, an item exceeding
+        the budget on its own is yielded as a single chunk.
+        '''
+        budget = max_tokens or CHUNK_TOKEN_TARGETS.get(model, DEFAULT_CHUNK_TOKEN_TARGET)
+        is_dict = isinstance(self._data, dict)
+        items = self._data.items() if is_dict else self._data # type: ignore
+
+        chunk, chunk_tokens = [], 1
+        for item in items:
+            if keep is not None and not keep(item[1] if is_dict else item):
+                continue
+            # Separator between the serialized items costs roughly one token
+            item_tokens = estimate_tokens(serialize(item[1] if is_dict else item), model) + 1
+            if chunk and chunk_tokens + item_tokens > budget:
+                yield dict(chunk) if is_dict else chunk
+                chunk, chunk_tokens = [], 1
+            if item_tokens > budget:
+                LOG.warning('Item with {} tokens exceeds the chunk budget of {}', item_tokens, budget)
+            chunk.append(item)
+            chunk_tokens += item_tokens
+        if chunk:
+            yield dict(chunk) if is_dict else chunk
+
 def test_simple_array_n2():
     simple_arr = '[1,2,3,4,5,6,7]'
     chunker = BasicChunker(simple_arr)
@@ -49,3 +116,20 @@ def test_simple_dict():
     out = chunker.chunk(2)
     assert len(out[0]) == 2
     assert len(out[1]) == 1
+
+def test_token_chunks_respect_budget():
+    items = [{'question': f'{i} + {i}', 'answer': 2 * i} for i in range(50)]
+    chunks = list(BasicChunker(items).iter_token_chunks(60))
+    assert sum(len(c) for c in chunks) == 50
+    assert all(sum(estimate_tokens(json.dumps(i)) + 1 for i in c) + 1 <= 60 for c in chunks)
+
+def test_token_chunks_prefilter():
+    items = [{'question': '1 + 1'}, {'question': '2 + 2', 'test': {'q': 'capital of Poland?', 'a': '???'}}]
+    chunks = list(BasicChunker(iter(items)).iter_token_chunks(1000, keep=lambda item: 'test' in item))
+    assert chunks == [[items[1]]]
+
+def test_token_chunks_dict():
+    simple_dict = {'a': 'x' * 40, 'b': 'y' * 40, 'c': 'z' * 40}
+    chunks = list(BasicChunker(simple_dict).iter_token_chunks(30))
+    assert all(isinstance(c, dict) for c in chunks)
+    assert {k for c in chunks for k in c} == {'a', 'b', 'c'}
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import io
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Literal
+
+from loguru import logger as LOG
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+ImageDetail = Literal['low', 'high', 'auto']
+
+IMAGE_MAX_EDGE = int(os.environ.get('VISION_MAX_EDGE', 2048))
+IMAGE_JPEG_QUALITY = int(os.environ.get('VISION_JPEG_QUALITY', 85))
+IMAGE_CACHE_ENTRIES = int(os.environ.get('VISION_CACHE_ENTRIES', 256))
+# Vision models see at most a 512px image in low detail, and 768px on the short side in high detail
+LOW_DETAIL_EDGE = 512
+HIGH_DETAIL_SHORT_EDGE = 768
+ORIENTATION_TAG = 0x0112
+
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+_executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='image')
+_processed: OrderedDict[str, 'ProcessedImage'] = OrderedDict()
+
+
+@dataclass(frozen=True)
+class ProcessedImage:
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+
+
+def sniff_image_type(data: bytes) -> str:
+    '''MIME type read from the file signature, the file name is not trusted'''
+    for signature, mime_type in _SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def _target_size(width: int, height: int, max_edge: int, detail: ImageDetail) -> tuple[int, int]:
+    edge = min(max_edge, LOW_DETAIL_EDGE) if detail == 'low' else max_edge
+    scale = min(1.0, edge / max(width, height))
+    # The provider scales larger images down to the short side of high detail itself
+    if detail != 'low':
+        scale = min(scale, HIGH_DETAIL_SHORT_EDGE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def vision_tokens(image: ProcessedImage, detail: ImageDetail = 'auto') -> int:
+    '''Input tokens billed for an image, 85 base tokens plus 170 per 512px tile in high detail'''
+    if detail == 'low':
+        return 85
+    # Images Pillow could not decode are sent as they are, counted as the largest size
+    width, height = _target_size(image.width or 2048, image.height or 2048, 2048, 'high')
+    tiles = -(-width // 512) * -(-height // 512)
+    return 85 + 170 * tiles
+
+
+def preprocess_image_sync(data: bytes, max_edge: int = IMAGE_MAX_EDGE, detail: ImageDetail = 'auto') -> ProcessedImage:
+    '''Downscale the image to what the vision model will look at and re-encode it compactly,
+    formats Pillow cannot decode are passed through unchanged
+    '''
+    source_type = sniff_image_type(data)
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError) as exc:
+        LOG.warning('Unable to decode the image ({}), sending it unprocessed', exc)
+        mime_type = source_type if source_type != 'application/octet-stream' else 'image/jpeg'
+        return ProcessedImage(data, mime_type, 0, 0)
+    # The re-encoded image has no EXIF orientation, so rotate the pixels instead
+    rotated = image.getexif().get(ORIENTATION_TAG, 1) != 1
+    if rotated:
+        image = ImageOps.exif_transpose(image)
+    size = _target_size(image.width, image.height, max_edge, detail)
+    resized = size != image.size
+    if resized:
+        image = image.resize(size, Image.Resampling.LANCZOS)
+
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    buffer = io.BytesIO()
+    if has_alpha:
+        image.save(buffer, format='PNG', optimize=True)
+        mime_type = 'image/png'
+    else:
+        image.convert('RGB').save(buffer, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+        mime_type = 'image/jpeg'
+
+    # Re-encoding a small image can make it bigger, keep the original then
+    if not resized and not rotated and len(buffer.getvalue()) >= len(data) and source_type != 'application/octet-stream':
+        return ProcessedImage(data, source_type, image.width, image.height)
+    return ProcessedImage(buffer.getvalue(), mime_type, image.width, image.height)
+
+
+async def preprocess_image(data: bytes, max_edge: int = IMAGE_MAX_EDGE, detail: ImageDetail = 'auto') -> ProcessedImage:
+    '''Preprocess the image in a worker thread, results are cached by content hash'''
+    key = f'{hashlib.sha256(data).hexdigest()}:{max_edge}:{detail}'
+    processed = _processed.get(key)
+    if processed is not None:
+        _processed.move_to_end(key)
+        return processed
+
+    loop = asyncio.get_running_loop()
+    processed = await loop.run_in_executor(_executor, preprocess_image_sync, data, max_edge, detail)
+    LOG.info(
+        'Preprocessed image {}KB -> {}KB ({}x{} {})',
+        len(data) // 1024, len(processed.data) // 1024, processed.width, processed.height, processed.mime_type
+    )
+    _processed[key] = processed
+    while len(_processed) > IMAGE_CACHE_ENTRIES:
+        _processed.popitem(last=False)
+    return processed
+
+
+def _png(width: int, height: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), 'white').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def test_sniff_image_type():
+    assert sniff_image_type(_png(2, 2)) == 'image/png'
+    assert sniff_image_type(b'\xff\xd8\xff\xe0rest') == 'image/jpeg'
+    assert sniff_image_type(b'RIFF\x00\x00\x00\x00WEBPVP8 ') == 'image/webp'
+    assert sniff_image_type(b'not an image') == 'application/octet-stream'
+
+def test_large_png_is_downscaled():
+    processed = preprocess_image_sync(_png(4000, 3000), max_edge=2048)
+    assert (processed.width, processed.height) == (1024, 768)
+    assert Image.open(io.BytesIO(processed.data)).size == (1024, 768)
+    assert processed.mime_type == 'image/jpeg'
+    tall = preprocess_image_sync(_png(1000, 3000), max_edge=2048, detail='high')
+    # The long edge cap is the tighter one here
+    assert (tall.width, tall.height) == (683, 2048)
+
+def test_detail_levels():
+    assert _target_size(4000, 3000, 2048, 'low') == (512, 384)
+    assert _target_size(4000, 3000, 2048, 'high') == (1024, 768)
+    assert _target_size(4000, 3000, 2048, 'auto') == (1024, 768)
+    assert _target_size(100, 100, 2048, 'auto') == (100, 100)
+
+def test_vision_tokens():
+    image = ProcessedImage(b'', 'image/png', 1024, 1024)
+    assert vision_tokens(image, 'low') == 85
+    assert vision_tokens(image, 'high') == 85 + 170 * 4
+
+def test_exif_orientation_is_applied():
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    # Rotate 90 degrees clockwise to display, as phone cameras store portrait photos
+    exif[ORIENTATION_TAG] = 6
+    Image.new('RGB', (400, 300), 'white').save(buffer, format='JPEG', exif=exif)
+    processed = preprocess_image_sync(buffer.getvalue())
+    assert (processed.width, processed.height) == (300, 400)
+    assert Image.open(io.BytesIO(processed.data)).size == (300, 400)
+
+def test_undecodable_image_is_passed_through():
+    data = b'RIFF\x00\x00\x00\x00WEBPVP8 truncated'
+    processed = preprocess_image_sync(data)
+    assert (processed.data, processed.mime_type) == (data, 'image/webp')
+    assert vision_tokens(processed, 'high') == 85 + 170 * 4
+
+def test_preprocess_is_cached():
+    data = _png(3000, 3000)
+    first = asyncio.run(preprocess_image(data, detail='low'))
+    second = asyncio.run(preprocess_image(data, detail='low'))
+    assert first is second
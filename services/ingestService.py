@@ -1,14 +1,248 @@
-from typing import BinaryIO, Sequence
+import asyncio
+import hashlib
+import os
+import pathlib as p
+import re
+import time
+from dataclasses import asdict, dataclass, field
+from typing import BinaryIO, Callable, Iterator
 from zipfile import ZipFile
 
-def read_files_from_zip(zipArchive: BinaryIO , file_types: list[str] = []) -> list[tuple[str,bytes]]:
-    output = []
+from loguru import logger as LOG
+
+from services.ai.scheduler import Priority
+from services.data_transformers.chunker import BasicChunker
+from services.vectorService import EMBEDDING_BATCH_SIZE, INSERT_CONCURRENCY, VectorService
+
+INGEST_CHUNK_TOKENS = int(os.environ.get('INGEST_CHUNK_TOKENS', 512))
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 256))
+INGEST_LEDGER_PATH = os.environ.get('INGEST_LEDGER_PATH', './.cache/ingest')
+
+
+def iter_files_from_zip(zipArchive: BinaryIO, file_types: list[str] = []) -> Iterator[tuple[str, bytes]]:
+    '''Lazily read the archive members, one at a time'''
     with ZipFile(zipArchive, 'r') as zip_handle:
         for file in zip_handle.filelist:
             if file_types and check_filetype(file.filename) in file_types:
                 with zip_handle.open(file, 'r') as file_handle:
-                    output.append((file.filename, file_handle.read()))
-    return output
+                    yield file.filename, file_handle.read()
+
+def read_files_from_zip(zipArchive: BinaryIO , file_types: list[str] = []) -> list[tuple[str,bytes]]:
+    return list(iter_files_from_zip(zipArchive, file_types))
 
 def check_filetype(filename: str):
     return filename.split('.')[-1]
+
+def chunk_text(text: str, max_tokens: int = INGEST_CHUNK_TOKENS) -> list[str]:
+    '''Split a text on blank lines and pack the paragraphs into chunks of at most `max_tokens`'''
+    paragraphs = [paragraph.strip() for paragraph in re.split(r'\n\s*\n', text) if paragraph.strip()]
+    return ['\n\n'.join(chunk) for chunk in BasicChunker(paragraphs).iter_token_chunks(max_tokens, serialize=str)] #type: ignore
+
+
+def file_key(file_name: str, content: bytes) -> str:
+    '''Identity of an archive member, the same content under another name is another file
+    whose name tag has to be indexed as well
+    '''
+    return hashlib.sha256(file_name.encode() + b'\0' + content).hexdigest()
+
+
+class IngestLedger:
+    '''Keys of the files already indexed into a collection, appended to a text file
+    so an interrupted ingestion resumes where it stopped. It has to be cleared
+    when the collection is created again, the new one holds none of the files
+    '''
+    def __init__(self, path: str | p.Path) -> None:
+        self.path = p.Path(path)
+        self.hashes: set[str] = set()
+        if self.path.exists():
+            self.hashes = set(self.path.read_text().split())
+
+    @classmethod
+    def for_collection(cls, database_name: str, collection_name: str) -> 'IngestLedger':
+        return cls(p.Path(INGEST_LEDGER_PATH) / database_name / f'{collection_name}.txt')
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.hashes
+
+    def add(self, key: str) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as file:
+            file.write(key + '\n')
+        self.hashes.add(key)
+
+    def clear(self) -> None:
+        self.path.unlink(missing_ok=True)
+        self.hashes.clear()
+
+
+@dataclass
+class IngestProgress:
+    files: int = 0
+    skipped_files: int = 0
+    indexed_files: int = 0
+    chunks: int = 0
+    inserted: int = 0
+    batches: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def seconds(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> dict:
+        return {
+            **{k: v for k, v in asdict(self).items() if k != 'started'},
+            'seconds': round(self.seconds, 3),
+            'chunks_per_second': round(self.inserted / self.seconds, 1) if self.seconds else 0.0,
+        }
+
+
+@dataclass
+class _Chunk:
+    file_name: str
+    key: str
+    text: str
+
+
+async def ingest_zip(
+        vector_service: VectorService,
+        collection_name: str,
+        archive: BinaryIO,
+        file_types: list[str] = [],
+        ledger: IngestLedger | None = None,
+        chunk_tokens: int = INGEST_CHUNK_TOKENS,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        queue_size: int = INGEST_QUEUE_SIZE,
+        concurrency: int = INSERT_CONCURRENCY,
+        on_progress: Callable[[IngestProgress], None] | None = None,
+) -> IngestProgress:
+    '''Index the text files of a zip archive in constant memory.
+
+    Members are read lazily and chunked, the chunks are embedded and inserted
+    in batches by `concurrency` workers, with bounded queues between the stages.
+    Every chunk is tagged with its file name, files already in the `ledger`
+    under the same name and content are skipped.
+    '''
+    progress = IngestProgress()
+    chunks: asyncio.Queue[_Chunk | None] = asyncio.Queue(queue_size)
+    batches: asyncio.Queue[list[_Chunk] | None] = asyncio.Queue(concurrency)
+    # Chunks of every file still waiting to be inserted, a file is done when it reaches zero
+    pending: dict[str, int] = {}
+    seen: set[str] = set()
+
+    def file_done(key: str) -> None:
+        del pending[key]
+        progress.indexed_files += 1
+        if ledger is not None:
+            ledger.add(key)
+
+    async def read():
+        members = iter_files_from_zip(archive, file_types)
+        while (member := await asyncio.to_thread(next, members, None)) is not None:
+            file_name, content = member
+            progress.files += 1
+            key = file_key(file_name, content)
+            if key in seen or (ledger is not None and key in ledger):
+                progress.skipped_files += 1
+                continue
+            seen.add(key)
+            file_chunks = chunk_text(content.decode(errors='replace'), chunk_tokens)
+            pending[key] = len(file_chunks)
+            if not file_chunks:
+                file_done(key)
+            for text in file_chunks:
+                progress.chunks += 1
+                await chunks.put(_Chunk(file_name, key, text))
+        await chunks.put(None)
+
+    async def batch():
+        current: list[_Chunk] = []
+        while (chunk := await chunks.get()) is not None:
+            current.append(chunk)
+            if len(current) >= batch_size:
+                await batches.put(current)
+                current = []
+        if current:
+            await batches.put(current)
+        for _ in range(concurrency):
+            await batches.put(None)
+
+    async def insert():
+        while (current := await batches.get()) is not None:
+            result = await vector_service.insert_batch(
+                collection_name,
+                [chunk.text for chunk in current],
+                [[chunk.file_name] for chunk in current],
+                priority=Priority.BATCH,
+            )
+            progress.inserted += result['insert_count']
+            progress.batches += 1
+            for chunk in current:
+                pending[chunk.key] -= 1
+                if not pending[chunk.key]:
+                    file_done(chunk.key)
+            LOG.info('Ingest into {}: {}', collection_name, progress.as_dict())
+            if on_progress is not None:
+                on_progress(progress)
+
+    async with asyncio.TaskGroup() as group:
+        group.create_task(read())
+        group.create_task(batch())
+        for _ in range(concurrency):
+            group.create_task(insert())
+    return progress
+
+
+# TESTS ====
+class _RecordingVectorService:
+    def __init__(self, fail_after: int | None = None) -> None:
+        self.inserted: list[tuple[str, list[str]]] = []
+        self.fail_after = fail_after
+
+    async def insert_batch(self, collection_name, docs, tags, priority=Priority.BATCH):
+        if self.fail_after is not None and len(self.inserted) >= self.fail_after:
+            raise RuntimeError('Embedding service went away')
+        self.inserted.extend(zip(docs, tags))
+        return {'insert_count': len(docs), 'ids': list(range(len(docs)))}
+
+
+def _archive(files: dict[str, str]):
+    import io
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w') as zip_handle:
+        for name, text in files.items():
+            zip_handle.writestr(name, text)
+    buffer.seek(0)
+    return buffer
+
+
+def test_chunk_text_packs_paragraphs():
+    text = '\n\n'.join(f'Paragraph {i} ' + 'word ' * 40 for i in range(6))
+    chunks = chunk_text(text, max_tokens=120)
+    assert 1 < len(chunks) < 6
+    assert '\n\n'.join(chunks).split() == text.split()
+
+
+def test_ingest_resumes_by_file(tmp_path):
+    files = {f'report_{i}.txt': f'Weapon report number {i}' for i in range(10)}
+    files['copy.txt'] = files['report_0.txt']
+    files['notes.md'] = 'not indexed'
+    ledger = IngestLedger(tmp_path / 'ledger.txt')
+
+    failing = _RecordingVectorService(fail_after=4)
+    try:
+        asyncio.run(ingest_zip(failing, 'weapons', _archive(files), ['txt'], ledger, batch_size=2, concurrency=1)) #type: ignore
+        assert False, 'The failing insert should be raised'
+    except ExceptionGroup:
+        pass
+    assert len(IngestLedger(tmp_path / 'ledger.txt').hashes) == 4
+
+    service = _RecordingVectorService()
+    progress = asyncio.run(ingest_zip(service, 'weapons', _archive(files), ['txt'], IngestLedger(tmp_path / 'ledger.txt'), batch_size=2)) #type: ignore
+    # The copy is indexed under its own name, its name can be the answer
+    assert sorted(tags[0] for _, tags in failing.inserted + service.inserted) == sorted([f'report_{i}.txt' for i in range(10)] + ['copy.txt'])
+    assert progress.files == 11 and progress.skipped_files == 4 and progress.indexed_files == 7
+
+    ledger = IngestLedger(tmp_path / 'ledger.txt')
+    ledger.clear()
+    assert not ledger.hashes and not IngestLedger(tmp_path / 'ledger.txt').hashes
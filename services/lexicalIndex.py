@@ -0,0 +1,284 @@
+import json
+import math
+import os
+import pathlib as p
+import re
+import tempfile
+import threading
+from collections import Counter
+from heapq import nlargest
+from typing import Any
+
+from loguru import logger as LOG
+
+from services.coordination import FileLock
+
+LEXICAL_INDEX_PATH = os.environ.get('LEXICAL_INDEX_PATH', './.cache/lexical')
+BM25_K1 = float(os.environ.get('BM25_K1', 1.5))
+BM25_B = float(os.environ.get('BM25_B', 0.75))
+# Damping constant of reciprocal rank fusion, higher values flatten the rank differences
+RRF_K = int(os.environ.get('RRF_K', 60))
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+Hits = list[dict[str, Any]]
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    '''Inverted index over the documents of one collection, scored with Okapi BM25.
+
+    Documents are appended to a JSON lines file and the index is rebuilt
+    from it in memory when the index is opened. Worker processes append to the
+    same file under a flock, and every search first indexes the lines the
+    other processes appended since. A rebuild or a clear replaces the file,
+    the other processes notice the new inode and read it again.
+    '''
+    def __init__(self, path: p.Path | None = None, k1: float = BM25_K1, b: float = BM25_B) -> None:
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._reset()
+        self._catch_up()
+        if self.documents:
+            LOG.info('Loaded {} documents into lexical index {}', len(self.documents), path)
+
+    def _reset(self) -> None:
+        self.documents: list[dict] = []
+        self.postings: dict[str, dict[int, int]] = {}
+        self.lengths: list[int] = []
+        self.total_length = 0
+        # File already indexed and how many of its bytes
+        self._inode: int | None = None
+        self._offset = 0
+
+    @property
+    def built(self) -> bool:
+        '''Whether the index holds the documents of its collection, an in-memory one always does'''
+        return self.path is None or self.path.exists()
+
+    def _file_lock(self) -> FileLock:
+        assert self.path is not None
+        return FileLock(self.path.with_suffix('.lock'))
+
+    def _catch_up(self) -> None:
+        '''Index the complete lines appended to the file since it was last read'''
+        if self.path is None:
+            return
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            # Cleared by another process
+            if self._inode is not None:
+                self._reset()
+            return
+        # A shorter file was replaced as well, its inode number may have been reused
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._reset()
+            self._inode = stat.st_ino
+        if stat.st_size <= self._offset:
+            return
+        with open(self.path, 'rb') as file:
+            file.seek(self._offset)
+            appended = file.read()
+        # A line another process is still writing is read on the next catch up
+        complete = appended[:appended.rfind(b'\n') + 1]
+        self._offset += len(complete)
+        for line in complete.splitlines():
+            if line.strip():
+                self._index(json.loads(line))
+
+    def _index(self, document: dict) -> None:
+        row = len(self.documents)
+        terms = Counter(tokenize(document['text']))
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[row] = count
+        length = sum(terms.values())
+        self.lengths.append(length)
+        self.total_length += length
+        self.documents.append(document)
+
+    def add(self, ids: list, texts: list[str], tags: list[list[str]] | None = None) -> None:
+        '''Index documents under the ids they got in the vector store'''
+        tags = tags if tags is not None else [[] for _ in texts]
+        documents = [{'id': id, 'text': text, 'tags': doc_tags} for id, text, doc_tags in zip(ids, texts, tags)]
+        with self._lock:
+            if self.path is None:
+                for document in documents:
+                    self._index(document)
+                return
+            with self._file_lock():
+                self._catch_up()
+                lines = ''.join(json.dumps(document, ensure_ascii=False) + '\n' for document in documents).encode()
+                with open(self.path, 'ab') as file:
+                    file.write(lines)
+                    self._inode = os.fstat(file.fileno()).st_ino
+                self._offset += len(lines)
+            for document in documents:
+                self._index(document)
+
+    def rebuild(self, ids: list, texts: list[str], tags: list[list[str]] | None = None, replace: bool = True) -> bool:
+        '''Index exactly these documents, dropping the indexed ones.
+        Without `replace` an index another process built in the meantime is kept, returns whether it was rebuilt
+        '''
+        tags = tags if tags is not None else [[] for _ in texts]
+        documents = [{'id': id, 'text': text, 'tags': doc_tags} for id, text, doc_tags in zip(ids, texts, tags)]
+        with self._lock:
+            if self.path is None:
+                self._reset()
+                for document in documents:
+                    self._index(document)
+                return True
+            with self._file_lock():
+                if not replace and self.path.exists():
+                    self._catch_up()
+                    return False
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                lines = ''.join(json.dumps(document, ensure_ascii=False) + '\n' for document in documents).encode()
+                with tempfile.NamedTemporaryFile(dir=self.path.parent, prefix='.tmp-', delete=False) as file:
+                    file.write(lines)
+                os.replace(file.name, self.path)
+                self._reset()
+                self._inode = self.path.stat().st_ino
+                self._offset = len(lines)
+            for document in documents:
+                self._index(document)
+        LOG.info('Rebuilt lexical index {} with {} documents', self.path, len(documents))
+        return True
+
+    def clear(self) -> None:
+        '''Drop every document, as when the collection is dropped or created anew'''
+        with self._lock:
+            if self.path is not None:
+                with self._file_lock():
+                    self.path.unlink(missing_ok=True)
+            self._reset()
+
+    def search(self, query: str, limit: int = 5, output_fields: list[str] = [], tags: list[str] | None = None) -> Hits:
+        '''Top documents for the query, in the hit format of the vector store'''
+        with self._lock:
+            self._catch_up()
+            count = len(self.documents)
+            if not count:
+                return []
+            average_length = self.total_length / count
+            scores: dict[int, float] = {}
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for row, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[row] / average_length)
+                    scores[row] = scores.get(row, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+            if tags:
+                wanted = set(tags)
+                scores = {row: score for row, score in scores.items() if wanted.intersection(self.documents[row]['tags'])}
+            top = nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [
+                {
+                    'id': self.documents[row]['id'],
+                    'distance': score,
+                    'entity': {field: self.documents[row].get(field) for field in output_fields},
+                }
+                for row, score in top
+            ]
+
+    def stats(self) -> dict:
+        return {'documents': len(self.documents), 'terms': len(self.postings)}
+
+
+def rank_fusion(result_lists: list[Hits], limit: int = 5, k: int = RRF_K) -> Hits:
+    '''Merge ranked hit lists by reciprocal rank fusion,
+    the distance of a fused hit is its summed 1 / (k + rank) score
+    '''
+    scores: dict[Any, float] = {}
+    hits: dict[Any, dict] = {}
+    for results in result_lists:
+        for rank, hit in enumerate(results, start=1):
+            scores[hit['id']] = scores.get(hit['id'], 0.0) + 1 / (k + rank)
+            hits.setdefault(hit['id'], hit)
+    top = nlargest(limit, scores.items(), key=lambda item: item[1])
+    return [{**hits[id], 'distance': score} for id, score in top]
+
+
+class LexicalIndexes:
+    '''BM25 index of every (database, collection), persisted under `path`'''
+    def __init__(self, path: str = LEXICAL_INDEX_PATH) -> None:
+        self.path = p.Path(path)
+        self._indexes: dict[tuple[str, str], BM25Index] = {}
+
+    def _index_path(self, database_name: str, collection_name: str) -> p.Path:
+        return self.path / database_name / f'{collection_name}.jsonl'
+
+    def get(self, database_name: str, collection_name: str) -> BM25Index:
+        key = (database_name, collection_name)
+        index = self._indexes.get(key)
+        if index is None:
+            index = BM25Index(self._index_path(database_name, collection_name))
+            self._indexes[key] = index
+        return index
+
+    def clear(self, database_name: str, collection_name: str) -> None:
+        '''Clear the index of a dropped or recreated collection, if it has one'''
+        if (database_name, collection_name) in self._indexes or self._index_path(database_name, collection_name).exists():
+            self.get(database_name, collection_name).clear()
+
+    def stats(self) -> dict:
+        return {f'{db}/{collection}': index.stats() for (db, collection), index in self._indexes.items()}
+
+
+lexical_indexes = LexicalIndexes()
+
+
+# TESTS ====
+def test_bm25_prefers_exact_matches(tmp_path):
+    index = BM25Index(tmp_path / 'knowledge.jsonl')
+    index.add([1, 2, 3], [
+        'Rafał Bomba worked in the lab',
+        'The lab is located near Grudziądz',
+        'Sector C4 report: nobody was found',
+    ], tags=[['people'], ['places'], ['reports']])
+    assert [hit['id'] for hit in index.search('c4 report', limit=2)] == [3]
+    assert index.search('lab', output_fields=['text'])[0]['entity']['text'] in ('Rafał Bomba worked in the lab', 'The lab is located near Grudziądz')
+    assert [hit['id'] for hit in index.search('lab', tags=['places'])] == [2]
+
+    reopened = BM25Index(tmp_path / 'knowledge.jsonl')
+    assert reopened.search('bomba')[0]['id'] == 1
+
+
+def test_rank_fusion_rewards_agreement():
+    dense = [{'id': 1, 'distance': 0.9}, {'id': 2, 'distance': 0.8}, {'id': 3, 'distance': 0.7}]
+    lexical = [{'id': 3, 'distance': 12.0}, {'id': 4, 'distance': 5.0}]
+    fused = rank_fusion([dense, lexical], limit=3)
+    assert [hit['id'] for hit in fused] == [3, 1, 2]
+    assert fused[0]['distance'] == 1 / 63 + 1 / 61
+
+
+def test_documents_added_by_another_worker_are_found(tmp_path):
+    # Two indexes over one file stand in for two server workers
+    first, second = BM25Index(tmp_path / 'knowledge.jsonl'), BM25Index(tmp_path / 'knowledge.jsonl')
+    first.add([1], ['Rafał Bomba worked in the lab'])
+    second.add([2], ['Sector C4 report: nobody was found'])
+    assert [hit['id'] for hit in first.search('c4 report')] == [2]
+    assert [hit['id'] for hit in second.search('bomba')] == [1]
+    assert second.stats()['documents'] == 2
+
+
+def test_rebuild_and_clear_reach_other_workers(tmp_path):
+    first, second = BM25Index(tmp_path / 'knowledge.jsonl'), BM25Index(tmp_path / 'knowledge.jsonl')
+    assert not first.built
+    first.add([1], ['Rafał Bomba worked in the lab'])
+    assert second.search('bomba')[0]['id'] == 1
+    assert not second.rebuild([7], ['Sector C4 report: nobody was found'], replace=False)
+    assert second.rebuild([7, 8], ['Sector C4 report: nobody was found', 'Bomba escaped'])
+    assert [hit['id'] for hit in first.search('bomba')] == [8]
+    assert first.stats()['documents'] == 2
+    first.clear()
+    assert second.search('report') == [] and not second.built
+    second.add([9], ['A new report'])
+    assert [hit['id'] for hit in first.search('report')] == [9]
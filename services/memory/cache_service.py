@@ -1,28 +1,606 @@
+import asyncio
+import bisect
+import hashlib
+import os
 import pathlib as p
+import re
+import struct
+import tempfile
+import threading
+import time
 from base64 import urlsafe_b64encode
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from loguru import logger as LOG
+
+from services.coordination import FileLock, compute_once
+from services.memory.log_store import LogStore
+
+FILE_CACHE_DIR = os.environ.get('FILE_CACHE_DIR', './.cache')
+# Seconds an entry stays valid, 0 keeps entries until they are evicted
+FILE_CACHE_TTL = float(os.environ.get('FILE_CACHE_TTL', 0))
+# 'files' keeps one file per entry, 'log' a single append-only log per namespace
+FILE_CACHE_BACKEND = os.environ.get('FILE_CACHE_BACKEND', 'files')
+FILE_CACHE_MAX_BYTES = int(os.environ.get('FILE_CACHE_MAX_BYTES', 1024 ** 3))
+# Size of the in-process tier shared by every namespace, 0 disables it
+FILE_CACHE_MEMORY_BYTES = int(os.environ.get('FILE_CACHE_MEMORY_BYTES', 64 * 1024 ** 2))
+# Entries larger than this share of the memory tier are only kept on disk
+MEMORY_ENTRY_SHARE = 0.125
+LATENCY_BUCKETS_MS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 500)
+# Share of the size cap the cache is trimmed down to when it overflows
+EVICTION_TARGET = 0.9
+# Expiry time of entries without a TTL, far enough to never expire
+NEVER = 2 ** 40
+# Other worker processes write to the same directories, the size counted by a process is refreshed this often
+SIZE_RESCAN_SECONDS = 60
+# Entries whose use this process remembers, to order them for eviction
+RECENT_ENTRIES = 100_000
+# magic, expiry time, in front of the value in every entry file
+ENTRY_HEADER = struct.Struct('<4sd')
+ENTRY_MAGIC = b'FCE1'
+# Names of the entries of the flat base64 layout used before the sharded one
+LEGACY_NAME = re.compile(r'[A-Za-z0-9_-]+=*')
+
+
+class LatencyHistogram:
+    '''Counts of observed latencies in fixed millisecond buckets'''
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS_MS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        milliseconds = seconds * 1000
+        self.counts[bisect.bisect_left(self.buckets, milliseconds)] += 1
+        self.total += milliseconds
+
+    def as_dict(self) -> dict:
+        count = sum(self.counts)
+        labels = [f'<={bucket}ms' for bucket in self.buckets] + [f'>{self.buckets[-1]}ms']
+        return {
+            'count': count,
+            'mean_ms': round(self.total / count, 4) if count else 0.0,
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+@dataclass
+class FileCacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    expirations: int = 0
+    memory_evictions: int = 0
+    disk_evictions: int = 0
+    latency: dict[str, LatencyHistogram] = field(
+        default_factory=lambda: {name: LatencyHistogram() for name in ('memory_hit', 'disk_hit', 'miss', 'write')}
+    )
+
+    def as_dict(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        counters = {k: v for k, v in self.__dict__.items() if k != 'latency'}
+        return {
+            **counters,
+            'hit_ratio': round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            'latency': {name: histogram.as_dict() for name, histogram in self.latency.items()},
+        }
+
+
+class MemoryTier:
+    '''Process wide LRU of cache entries, bounded by their total size in bytes'''
+    def __init__(self, max_bytes: int = FILE_CACHE_MEMORY_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[tuple[str, str], tuple[float, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._pop((namespace, key))
+                return None
+            self._entries.move_to_end((namespace, key))
+            return entry[1]
+
+    def put(self, namespace: str, key: str, data: bytes, expires: float) -> list[str]:
+        '''Store an entry, returns the namespace of every entry evicted to make room'''
+        if len(data) > self.max_bytes * MEMORY_ENTRY_SHARE:
+            self.delete(namespace, key)
+            return []
+        evicted = []
+        with self._lock:
+            self._pop((namespace, key))
+            self._entries[(namespace, key)] = (expires, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                (evicted_namespace, _), (_, evicted_data) = self._entries.popitem(last=False)
+                self.size -= len(evicted_data)
+                evicted.append(evicted_namespace)
+        return evicted
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._pop((namespace, key))
+
+    def recency(self, namespace: str) -> dict[str, int]:
+        '''Keys of a namespace held in memory, ranked from the least recently used'''
+        with self._lock:
+            keys = [key for entry_namespace, key in self._entries if entry_namespace == namespace]
+        return {key: rank for rank, key in enumerate(keys)}
+
+    def _pop(self, entry_key: tuple[str, str]) -> None:
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+memory_tier = MemoryTier()
+_stats: dict[str, FileCacheStats] = {}
+
+
+def all_stats() -> dict:
+    '''Counters and latencies of every namespace used in this process'''
+    return {
+        'memory': memory_tier.stats(),
+        'namespaces': {name: stats.as_dict() for name, stats in _stats.items()},
+        'stores': {path: store.stats() for path, store in list(_stores.items())},
+    }
+
+
+class FileStore:
+    '''One file per entry, named by the sha256 of the key and sharded into two
+    levels of directories. Files are written atomically, with the expiry time
+    of the entry in a small header in front of the value. Reads do not touch the
+    file, the entries used by this process are remembered in memory for eviction.
+    Worker processes share the directory, the size is recounted in a background
+    thread every SIZE_RESCAN_SECONDS and a single process evicts at a time.
+    '''
+    def __init__(self, path: str | p.Path) -> None:
+        self.path = p.Path(path)
+        self._size = 0
+        self._counted: float | None = None
+        self._rescan: threading.Thread | None = None
+        self._recent: OrderedDict[str, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry_path(self, digest: str) -> p.Path:
+        return self.path / digest[:2] / digest[2:4] / digest
+
+    def _used(self, digest: str) -> None:
+        with self._lock:
+            self._recent[digest] = None
+            self._recent.move_to_end(digest)
+            if len(self._recent) > RECENT_ENTRIES:
+                self._recent.popitem(last=False)
+
+    def read(self, digest: str) -> tuple[bytes, float] | None:
+        '''Value and expiry time of an entry'''
+        path = self._entry_path(digest)
+        try:
+            raw = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        if raw[:len(ENTRY_MAGIC)] != ENTRY_MAGIC or len(raw) < ENTRY_HEADER.size:
+            return None
+        self._used(digest)
+        return raw[ENTRY_HEADER.size:], ENTRY_HEADER.unpack_from(raw)[1]
+
+    @staticmethod
+    def _expires(path: p.Path) -> float:
+        '''Expiry time of an entry file, reading only its header'''
+        try:
+            with open(path, 'rb') as file:
+                head = file.read(ENTRY_HEADER.size)
+        except FileNotFoundError:
+            return 0.0
+        if head[:len(ENTRY_MAGIC)] != ENTRY_MAGIC or len(head) != ENTRY_HEADER.size:
+            # Not an entry, expired so it is the first to go
+            return 0.0
+        return ENTRY_HEADER.unpack(head)[1]
+
+    def write(self, digest: str, data: bytes, expires: float) -> None:
+        path = self._entry_path(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix='.tmp-', delete=False) as file:
+            file.write(ENTRY_HEADER.pack(ENTRY_MAGIC, expires))
+            file.write(data)
+        try:
+            previous = self._value_size(path.stat())
+        except FileNotFoundError:
+            previous = 0
+        os.replace(file.name, path)
+        self._grow(len(data) - previous)
+        self._used(digest)
+
+    def delete(self, digest: str) -> None:
+        path = self._entry_path(digest)
+        try:
+            size = self._value_size(path.stat())
+        except FileNotFoundError:
+            return
+        path.unlink(missing_ok=True)
+        self._grow(-size)
+
+    def _entries(self) -> list[tuple[p.Path, os.stat_result]]:
+        entries = []
+        for path in self.path.glob('*/*/*'):
+            if path.name.startswith('.tmp-'):
+                continue
+            try:
+                entries.append((path, path.stat()))
+            except FileNotFoundError:
+                # Removed by another process since the listing
+                pass
+        return entries
+
+    @staticmethod
+    def _value_size(stat: os.stat_result) -> int:
+        '''Bytes of the value of an entry file, the size counts values like the log store does'''
+        return max(stat.st_size - ENTRY_HEADER.size, 0)
+
+    def _count(self) -> None:
+        size = sum(self._value_size(stat) for _, stat in self._entries())
+        with self._lock:
+            self._size = size
+            self._counted = time.monotonic()
+            self._rescan = None
+
+    def size(self) -> int:
+        '''Bytes of the entries, counted in full the first time and then kept up to date
+        by this process, while a background thread recounts what the other processes wrote
+        '''
+        counted = self._counted
+        if counted is None:
+            self._count()
+            return self._size
+        with self._lock:
+            if self._rescan is None and time.monotonic() - counted > SIZE_RESCAN_SECONDS:
+                self._rescan = threading.Thread(target=self._count, name='file-cache-rescan', daemon=True)
+                self._rescan.start()
+            return self._size
+
+    def _grow(self, delta: int) -> None:
+        with self._lock:
+            self._size += delta
+
+    def evict(self, target: int, hot: dict[str, int]) -> list[str]:
+        '''Drop expired and then least recently used entries until the files fit `target`.
+        Entries in `hot` count as more recent than the others, in the given order, then the ones
+        this process used, entries only other processes used are ordered by their atime
+        '''
+        lock = FileLock(self.path / '.evict.lock')
+        if not lock.acquire(blocking=False):
+            # Another worker is already making room
+            return []
+        try:
+            now = time.time()
+            with self._lock:
+                recent = {digest: rank for rank, digest in enumerate(self._recent)}
+            entries = sorted(
+                ((path, stat, self._expires(path)) for path, stat in self._entries()),
+                key=lambda entry: (entry[2] >= now, hot.get(entry[0].name, -1), recent.get(entry[0].name, -1), entry[1].st_atime),
+            )
+            with self._lock:
+                self._size = sum(self._value_size(stat) for _, stat, _ in entries)
+                self._counted = time.monotonic()
+                evicted = []
+                for path, stat, expires_at in entries:
+                    if self._size <= target and expires_at >= now:
+                        break
+                    path.unlink(missing_ok=True)
+                    self._recent.pop(path.name, None)
+                    self._size -= self._value_size(stat)
+                    evicted.append(path.name)
+            return evicted
+        finally:
+            lock.release()
+
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {'bytes': self.size()}
+
+
+STORES = {'files': FileStore, 'log': LogStore}
+# Stores keep size counters and open files, so every directory has a single one per process
+_stores: dict[str, FileStore | LogStore] = {}
+_stores_lock = threading.Lock()
+
+
+def _open_store(backend: str, path: p.Path) -> FileStore | LogStore:
+    with _stores_lock:
+        key = str(path.resolve())
+        if key not in _stores:
+            _stores[key] = STORES[backend](path)
+        return _stores[key]
+
+
+_legacy_dirs: dict[str, bool] = {}
+
+
+def _has_legacy_entries(cache_dir: p.Path) -> bool:
+    '''Whether the directory holds entries of the flat layout, looked up once per process'''
+    key = str(cache_dir.resolve())
+    if key not in _legacy_dirs:
+        try:
+            with os.scandir(cache_dir) as entries:
+                _legacy_dirs[key] = any(entry.is_file() and LEGACY_NAME.fullmatch(entry.name) for entry in entries)
+        except FileNotFoundError:
+            _legacy_dirs[key] = False
+    return _legacy_dirs[key]
+
+
+def close_stores() -> None:
+    '''Close the open stores, log stores write their index snapshot'''
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
+
 
 class FileCacheService:
-    CACHE_DIR = './.cache'
-    def __init__(self) -> None:
-        self.cache_dir_path = p.Path(self.CACHE_DIR)
-        self._ensure_cache_dir()
+    '''Key/value cache of bytes on disk, behind an in-process LRU tier.
+
+    The disk tier is a `FileStore`, one file per entry, or a `LogStore`,
+    a single append-only log, picked by `backend`. Entries are addressed by the
+    sha256 of the key and the least recently used ones are evicted once the
+    namespace grows over `max_bytes`. Writes go through both tiers, reads are
+    served from memory when possible.
+    '''
+    CACHE_DIR = FILE_CACHE_DIR
+
+    def __init__(
+            self,
+            namespace: str = 'default',
+            cache_dir: str | None = None,
+            ttl: float = FILE_CACHE_TTL,
+            max_bytes: int = FILE_CACHE_MAX_BYTES,
+            memory: MemoryTier | None = memory_tier,
+            backend: str = FILE_CACHE_BACKEND,
+    ) -> None:
+        if backend not in STORES:
+            raise ValueError(f'Unknown file cache backend {backend}, expected one of {list(STORES)}')
+        self.namespace = namespace
+        self.memory = memory if memory is not None and memory.max_bytes > 0 else None
+        self.stats = _stats.setdefault(namespace, FileCacheStats())
+        self.cache_dir_path = p.Path(cache_dir or self.CACHE_DIR)
+        self.path = self.cache_dir_path / ('files' if backend == 'files' else 'logs') / namespace
+        self.backend = backend
+        self._store: FileStore | LogStore | None = None
+        # Entries of the memory tier are grouped by directory, namespaces of two cache dirs do not mix
+        self._tier = str(self.path.resolve())
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    @property
+    def store(self) -> FileStore | LogStore:
+        '''Disk tier, opened on first use so importing a module with a cache creates no directories'''
+        if self._store is None:
+            self._store = _open_store(self.backend, self.path)
+        return self._store
+
+    @staticmethod
+    def _digest(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _legacy_path(self, key: str) -> p.Path:
+        return self.cache_dir_path / urlsafe_b64encode(key.encode()).decode()
 
-    def _ensure_cache_dir(self) -> None:
-        if not self.cache_dir_path.exists():
-            self.cache_dir_path.mkdir()
+    def get_bytes(self, key: str) -> bytes | None:
+        started = time.perf_counter()
+        digest = self._digest(key)
+        if self.memory is not None:
+            data = self.memory.get(self._tier, digest)
+            if data is not None:
+                self.stats.memory_hits += 1
+                self.stats.latency['memory_hit'].observe(time.perf_counter() - started)
+                return data
+        data, expires = self._disk_get(key, digest)
+        if data is None:
+            self.stats.misses += 1
+            self.stats.latency['miss'].observe(time.perf_counter() - started)
+            return None
+        self._remember(digest, data, expires)
+        self.stats.disk_hits += 1
+        self.stats.latency['disk_hit'].observe(time.perf_counter() - started)
+        return data
+
+    def _remember(self, digest: str, data: bytes, expires: float) -> None:
+        if self.memory is not None:
+            for tier in self.memory.put(self._tier, digest, data, expires):
+                _stats.setdefault(p.Path(tier).name, FileCacheStats()).memory_evictions += 1
+
+    def _disk_get(self, key: str, digest: str) -> tuple[bytes | None, float]:
+        entry = self.store.read(digest)
+        if entry is None:
+            return self._migrate_legacy(key), NEVER
+        if entry[1] < time.time():
+            self.store.delete(digest)
+            self.stats.expirations += 1
+            return None, 0
+        return entry
+
+    def _migrate_legacy(self, key: str) -> bytes | None:
+        '''Move an entry written by the previous flat base64 named layout'''
+        if not _has_legacy_entries(self.cache_dir_path):
+            return None
+        try:
+            legacy = self._legacy_path(key)
+            data = legacy.read_bytes()
+        except OSError:
+            # Missing, or a key too long to ever have been stored as a file name
+            return None
+        self.save_bytes(key, data)
+        legacy.unlink(missing_ok=True)
+        LOG.info('Migrated legacy cache entry {}', legacy.name[:32])
+        return data
+
+    def save_bytes(self, key: str, data: bytes, ttl: float | None = None) -> None:
+        started = time.perf_counter()
+        digest = self._digest(key)
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else NEVER
+        self.store.write(digest, data, expires)
+        if self.store.size() > self.max_bytes:
+            self.evict()
+        self._remember(digest, data, expires)
+        self.stats.writes += 1
+        self.stats.latency['write'].observe(time.perf_counter() - started)
+
+    def delete(self, key: str) -> None:
+        digest = self._digest(key)
+        if self.memory is not None:
+            self.memory.delete(self._tier, digest)
+        self.store.delete(digest)
+
+    def size(self) -> int:
+        return self.store.size()
+
+    def evict(self) -> int:
+        '''Drop expired and then least recently used entries until the namespace fits its cap.
+        Memory hits do not reach the disk tier, so entries held in memory are ordered by the memory
+        tier and considered more recent than the ones only on disk
+        '''
+        hot = self.memory.recency(self._tier) if self.memory is not None else {}
+        evicted = self.store.evict(int(self.max_bytes * EVICTION_TARGET), hot)
+        if self.memory is not None:
+            for digest in evicted:
+                self.memory.delete(self._tier, digest)
+        self.stats.disk_evictions += len(evicted)
+        LOG.info('Evicted {} entries from file cache {}', len(evicted), self.namespace)
+        return len(evicted)
 
     def get(self, url: str) -> str:
-        hash = urlsafe_b64encode(url.encode())
-        cached_file = self.cache_dir_path.joinpath(hash.decode())
-        if cached_file.exists():
-            with open(cached_file, 'r') as file:
-                return file.read()
-        else:
-            return ''
-
-    def save(self, url: str, data: str):
-        hash = urlsafe_b64encode(url.encode())
-        cached_file = self.cache_dir_path.joinpath(hash.decode())
-        with open(cached_file, 'w') as file:
-            file.write(data)
+        '''Cached text, an empty string when missing'''
+        data = self.get_bytes(url)
+        return data.decode() if data is not None else ''
+
+    def save(self, url: str, data: str | bytes, ttl: float | None = None):
+        self.save_bytes(url, data.encode() if isinstance(data, str) else data, ttl)
+
+    async def aget_bytes(self, key: str) -> bytes | None:
+        return await asyncio.to_thread(self.get_bytes, key)
+
+    async def asave_bytes(self, key: str, data: bytes, ttl: float | None = None) -> None:
+        await asyncio.to_thread(self.save_bytes, key, data, ttl)
+
+    async def aget(self, url: str) -> str:
+        return await asyncio.to_thread(self.get, url)
+
+    async def asave(self, url: str, data: str | bytes, ttl: float | None = None) -> None:
+        await asyncio.to_thread(self.save, url, data, ttl)
+
+    async def aget_or_create(self, key: str, create: Callable[[], Awaitable[str]], ttl: float | None = None) -> str:
+        '''Cached text, or the result of `create` saved to the cache, an empty text is a result too.
+        A missing entry is created by one worker process at a time, the others wait and read it back
+        '''
+        async def lookup() -> str | None:
+            cached = await self.aget_bytes(key)
+            return cached.decode() if cached is not None else None
+
+        cached = await lookup()
+        if cached is not None:
+            return cached
+
+        async def create_and_save() -> str:
+            result = await create()
+            await self.asave(key, result, ttl)
+            return result
+
+        return await compute_once(self.namespace, key, lookup, create_and_save, str(self.cache_dir_path / 'coordination'))
+
+
+# TESTS ====
+def test_long_keys_and_bytes(tmp_path):
+    for backend in STORES:
+        cache = FileCacheService(cache_dir=str(tmp_path), backend=backend)
+        key = 'https://centrala.ag3nts.org/data/' + 'x' * 1000 + '/json.txt'
+        cache.save(key, 'text')
+        cache.save_bytes('binary', b'\x00\xff')
+        assert cache.get(key) == 'text'
+        assert cache.get_bytes('binary') == b'\x00\xff'
+        assert cache.get('missing') == ''
+        assert cache.size() == 6
+
+
+def test_entries_expire(tmp_path):
+    for backend in STORES:
+        cache = FileCacheService(cache_dir=str(tmp_path), ttl=60, backend=backend, memory=None)
+        cache.save('fresh', 'value')
+        cache.save('stale', 'value', ttl=-1)
+        assert cache.get('fresh') == 'value'
+        assert cache.get_bytes('stale') is None
+        assert cache.size() == 5
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = FileCacheService(cache_dir=str(tmp_path), max_bytes=30, memory=None)
+    for i in range(3):
+        cache.save(f'key {i}', 'x' * 10)
+    cache.get('key 0')
+    cache.save('key 3', 'x' * 10)
+    assert cache.get('key 1') == ''
+    assert cache.get('key 0') and cache.get('key 3')
+    assert cache.size() <= 30
+
+
+def test_entry_files_keep_expiry_in_a_header(tmp_path):
+    cache = FileCacheService(cache_dir=str(tmp_path), memory=None)
+    cache.save('key', 'value', ttl=60)
+    path = cache.store._entry_path(cache._digest('key')) #type: ignore
+    modified = path.stat().st_mtime_ns
+    assert cache.get('key') == 'value'
+    # Hits do not write to the entry
+    assert path.stat().st_mtime_ns == modified
+    assert time.time() < cache.store.read(cache._digest('key'))[1] <= time.time() + 60 #type: ignore
+
+
+def test_nothing_is_created_before_use(tmp_path):
+    cache = FileCacheService('lazy', cache_dir=str(tmp_path / 'cache'))
+    assert cache.get('missing') == ''
+    assert not (tmp_path / 'cache').exists()
+
+
+def test_legacy_entries_are_migrated(tmp_path):
+    (tmp_path / urlsafe_b64encode(b'https://example.com').decode()).write_text('legacy')
+    cache = FileCacheService(cache_dir=str(tmp_path))
+    assert asyncio.run(cache.aget('https://example.com')) == 'legacy'
+    assert not (tmp_path / urlsafe_b64encode(b'https://example.com').decode()).exists()
+    assert cache.get('https://example.com') == 'legacy'
+
+
+def test_memory_tier_serves_hot_keys(tmp_path):
+    tier = MemoryTier(max_bytes=100)
+    cache = FileCacheService('hot', cache_dir=str(tmp_path), memory=tier)
+    cache.save('key', 'value')
+    cache.store._entry_path(cache._digest('key')).unlink() #type: ignore
+    assert cache.get('key') == 'value'
+
+    cold = FileCacheService('hot', cache_dir=str(tmp_path), memory=MemoryTier(max_bytes=100))
+    cold.save('other', 'value')
+    cold.memory.delete(cold._tier, cold._digest('other')) #type: ignore
+    assert cold.get('other') == 'value'
+    stats = cold.stats.as_dict()
+    assert (stats['memory_hits'], stats['disk_hits'], stats['writes']) == (1, 1, 2)
+    assert stats['latency']['disk_hit']['count'] == 1
+
 
+def test_memory_tier_is_bounded_by_bytes():
+    tier = MemoryTier(max_bytes=80)
+    assert tier.put('a', 'big', b'x' * 11, NEVER) == []
+    assert tier.get('a', 'big') is None
+    for i in range(9):
+        tier.put('a' if i < 5 else 'b', str(i), b'x' * 10, NEVER)
+    assert tier.size == 80
+    assert tier.put('b', 'last', b'x' * 10, NEVER) == ['a']
+    assert tier.get('a', '0') is None and tier.get('b', 'last') == b'x' * 10
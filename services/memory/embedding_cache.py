@@ -0,0 +1,298 @@
+import hashlib
+import json
+import os
+import pathlib as p
+import struct
+import threading
+import time
+
+import numpy as np
+from loguru import logger as LOG
+
+from services.coordination import FileLock
+
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', './.cache/embeddings')
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 100_000))
+EMBEDDING_CACHE_DTYPE = os.environ.get('EMBEDDING_CACHE_DTYPE', 'float32')
+# Share of the entries dropped at once when the cache is full
+EVICTION_FRACTION = 0.1
+
+# Raw bytes, fixed width byte strings would drop the trailing NUL bytes of a key
+INDEX_DTYPE = np.dtype([('key', 'V32'), ('used', 'f8')])
+# Bumped by every write, kept in the lock file, tells the other processes to reload their slots
+GENERATION = struct.Struct('<Q')
+
+
+class EmbeddingCache:
+    '''Embeddings of one (base_url, model) pair keyed by the sha256 of the text.
+
+    Vectors live in a fixed capacity memory-mapped matrix, next to a memory-mapped
+    index of (key, last used) records, so the cache survives restarts. When it is
+    full the least recently used entries are evicted. Worker processes map the
+    same files and access them under a flock, slots are only taken when the shared
+    index shows them free, and a process reloads its slots when the generation in
+    the lock file shows another one wrote. Hits are copies of the mapped vectors.
+    '''
+    def __init__(
+            self,
+            namespace: str,
+            directory: str = EMBEDDING_CACHE_DIR,
+            max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+            dtype: str = EMBEDDING_CACHE_DTYPE,
+    ) -> None:
+        self.namespace = namespace
+        self.path = p.Path(directory) / hashlib.sha256(namespace.encode()).hexdigest()[:16]
+        self.capacity = max_entries
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._slots: dict[bytes, int] = {}
+        self._free: list[int] = []
+        self._size = 0
+        self._generation = 0
+        self._vectors: np.memmap | None = None
+        self._index: np.memmap | None = None
+        self._open()
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.sha256(text.encode()).digest()
+
+    def _holds(self, slot: int, key: bytes) -> bool:
+        '''Whether the slot still holds the key, another process may have evicted it'''
+        assert self._index is not None
+        return bytes(self._index['key'][slot]) == key
+
+    def _file_lock(self) -> FileLock:
+        return FileLock(self.path.with_suffix('.lock'))
+
+    @staticmethod
+    def _read_generation(lock: FileLock) -> int:
+        assert lock.fd is not None
+        raw = os.pread(lock.fd, GENERATION.size, 0)
+        return GENERATION.unpack(raw)[0] if len(raw) == GENERATION.size else 0
+
+    def _sync(self, lock: FileLock) -> None:
+        '''Reload the slots when another process wrote since this one last looked'''
+        generation = self._read_generation(lock)
+        if generation != self._generation:
+            self._load_slots()
+            self._generation = generation
+
+    def _bump(self, lock: FileLock) -> None:
+        assert lock.fd is not None
+        self._generation = self._read_generation(lock) + 1
+        os.pwrite(lock.fd, GENERATION.pack(self._generation), 0)
+
+    @property
+    def dimension(self) -> int | None:
+        return None if self._vectors is None else self._vectors.shape[1]
+
+    def _open(self) -> None:
+        meta_path = self.path / 'meta.json'
+        if not meta_path.exists():
+            return
+        meta = json.loads(meta_path.read_text())
+        if meta['capacity'] != self.capacity or meta['dtype'] != self.dtype.name:
+            LOG.warning('Embedding cache {} was created with other settings, resetting it', self.namespace)
+            return
+        self._map(meta['dimension'], 'r+')
+        self._load_slots()
+        LOG.info('Loaded {} cached embeddings for {}', len(self._slots), self.namespace)
+
+    def _load_slots(self) -> None:
+        assert self._index is not None
+        used = np.flatnonzero(self._index['used'] > 0)
+        self._slots = {bytes(self._index['key'][slot]): int(slot) for slot in used}
+        self._size = int(used.max()) + 1 if len(used) else 0
+        self._free = sorted(set(range(self._size)) - set(self._slots.values()))
+
+    def _map(self, dimension: int, mode: str) -> None:
+        self._vectors = np.memmap(self.path / 'vectors.bin', dtype=self.dtype, mode=mode, shape=(self.capacity, dimension))
+        self._index = np.memmap(self.path / 'index.bin', dtype=INDEX_DTYPE, mode=mode, shape=(self.capacity,))
+
+    def _create(self, dimension: int) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        # The files are sparse, disk space is only used by the written slots
+        self._map(dimension, 'w+')
+        meta = {'namespace': self.namespace, 'dimension': dimension, 'dtype': self.dtype.name, 'capacity': self.capacity}
+        (self.path / 'meta.json').write_text(json.dumps(meta))
+
+    def _evict(self) -> None:
+        assert self._index is not None
+        # Free slots are marked unused, they are not candidates
+        taken = np.flatnonzero(self._index['used'][:self._size] > 0)
+        count = min(max(1, int(self.capacity * EVICTION_FRACTION)), len(taken))
+        if count == 0:
+            return
+        used = self._index['used'][taken]
+        for slot in taken[np.argpartition(used, count - 1)[:count]]:
+            key = bytes(self._index['key'][slot])
+            if self._slots.get(key) == slot:
+                del self._slots[key]
+            self._index[slot] = (b'', 0)
+            self._free.append(int(slot))
+        LOG.info('Evicted {} embeddings from {}', count, self.namespace)
+
+    def _allocate(self) -> int:
+        assert self._index is not None
+        while True:
+            if not self._free and self._size >= self.capacity:
+                self._evict()
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = self._size
+                self._size += 1
+            if self._index['used'][slot] == 0:
+                return slot
+            # Taken by another process since this one looked
+            self._slots.setdefault(bytes(self._index['key'][slot]), slot)
+
+    def get_many(self, texts: list[str]) -> list[np.ndarray | None]:
+        '''Cached vectors for the texts, hits are copies the slot can be reused under'''
+        with self._lock:
+            if self._vectors is None and (self.path / 'meta.json').exists():
+                # Created by another process
+                with self._file_lock():
+                    self._open()
+            if self._vectors is None or self._index is None:
+                self.misses += len(texts)
+                return [None] * len(texts)
+            now = time.time()
+            found: list[np.ndarray | None] = []
+            with self._file_lock() as lock:
+                self._sync(lock)
+                for text in texts:
+                    slot = self._slots.get(self.key(text))
+                    if slot is None:
+                        self.misses += 1
+                        found.append(None)
+                        continue
+                    self.hits += 1
+                    self._index['used'][slot] = now
+                    found.append(self._vectors[slot].copy())
+            return found
+
+    def put_many(self, texts: list[str], vectors: list) -> None:
+        if not texts:
+            return
+        with self._lock, self._file_lock() as lock:
+            if self._vectors is None:
+                # Another process may have created the files in the meantime
+                self._open()
+            if self._vectors is None:
+                self._create(len(vectors[0]))
+            assert self._vectors is not None and self._index is not None
+            self._sync(lock)
+            now = time.time()
+            for text, vector in zip(texts, vectors):
+                key = self.key(text)
+                slot = self._slots.get(key)
+                if slot is None or not self._holds(slot, key):
+                    slot = self._allocate()
+                    self._slots[key] = slot
+                self._vectors[slot] = vector
+                self._index[slot] = (key, now)
+            self._bump(lock)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._vectors is not None and self._index is not None:
+                self._vectors.flush()
+                self._index.flush()
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._slots),
+            'capacity': self.capacity,
+            'dimension': self.dimension,
+            'dtype': self.dtype.name,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+_caches: dict[str, EmbeddingCache] = {}
+
+def embedding_cache_for(base_url: str | None, model: str) -> EmbeddingCache:
+    '''Shared cache for the embedding model served at base_url'''
+    namespace = f'{base_url or "openai"}|{model}'
+    if namespace not in _caches:
+        _caches[namespace] = EmbeddingCache(namespace)
+    return _caches[namespace]
+
+def all_stats() -> dict[str, dict]:
+    return {namespace: cache.stats() for namespace, cache in _caches.items()}
+
+
+# TESTS ====
+def test_hits_survive_reopening(tmp_path):
+    cache = EmbeddingCache('http://localhost:11434/v1|bge-m3', str(tmp_path), max_entries=10)
+    cache.put_many(['a', 'b'], [[1.0, 0.0], [0.0, 1.0]])
+    cache.flush()
+
+    reopened = EmbeddingCache('http://localhost:11434/v1|bge-m3', str(tmp_path), max_entries=10)
+    a, missing, b = reopened.get_many(['a', 'c', 'b'])
+    assert missing is None
+    assert a is not None and list(a) == [1.0, 0.0]
+    assert b is not None and list(b) == [0.0, 1.0]
+    assert (reopened.hits, reopened.misses) == (2, 1)
+
+
+def test_keys_ending_with_a_nul_byte_survive_reopening(tmp_path):
+    text = next(str(i) for i in range(10_000) if EmbeddingCache.key(str(i)).endswith(b'\0'))
+    cache = EmbeddingCache('test', str(tmp_path), max_entries=10)
+    cache.put_many([text], [[1.0]])
+    cache.flush()
+
+    reopened = EmbeddingCache('test', str(tmp_path), max_entries=10)
+    hit = reopened.get_many([text])[0]
+    assert hit is not None and list(hit) == [1.0]
+    reopened.put_many([text], [[2.0]])
+    assert reopened.stats()['entries'] == 1
+
+
+def test_writes_of_other_processes_are_found(tmp_path):
+    first = EmbeddingCache('test', str(tmp_path), max_entries=10)
+    second = EmbeddingCache('test', str(tmp_path), max_entries=10)
+    first.put_many(['a'], [[1.0]])
+    assert second.get_many(['a'])[0] is not None
+    second.put_many(['b'], [[2.0]])
+    first.put_many(['c'], [[3.0]])
+    a, b, c = second.get_many(['a', 'b', 'c'])
+    assert a is not None and b is not None and c is not None
+    assert (list(a), list(b), list(c)) == ([1.0], [2.0], [3.0])
+    assert second.stats()['entries'] == 3
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = EmbeddingCache('test', str(tmp_path), max_entries=10)
+    cache.put_many([str(i) for i in range(10)], [[float(i)] for i in range(10)])
+    time.sleep(0.01)
+    cache.get_many([str(i) for i in range(1, 10)])
+    cache.put_many(['new'], [[42.0]])
+    assert cache.get_many(['0'])[0] is None
+    assert cache.get_many(['new'])[0] is not None
+    assert cache.stats()['entries'] == 10
+
+
+def test_hits_are_copies_and_free_slots_are_not_evicted(tmp_path):
+    cache = EmbeddingCache('test', str(tmp_path), max_entries=10)
+    cache.put_many([str(i) for i in range(10)], [[float(i)] for i in range(10)])
+    hit = cache.get_many(['0'])[0]
+    cache.put_many(['0'], [[42.0]])
+    assert hit is not None and list(hit) == [0.0]
+    # With a free slot left by the first eviction the second one still drops an entry
+    cache._evict()
+    cache._evict()
+    assert cache.stats()['entries'] == 8
+
+
+def test_float16_storage(tmp_path):
+    cache = EmbeddingCache('test', str(tmp_path), max_entries=4, dtype='float16')
+    cache.put_many(['a'], [[0.5, 0.25]])
+    vector = cache.get_many(['a'])[0]
+    assert vector is not None and vector.dtype == np.float16
+    assert np.allclose(vector, [0.5, 0.25])
@@ -0,0 +1,392 @@
+import mmap
+import os
+import pathlib as p
+import secrets
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+from loguru import logger as LOG
+
+from services.coordination import FileLock
+
+# Compact once the dead records take this share of the log
+FILE_CACHE_COMPACT_RATIO = float(os.environ.get('FILE_CACHE_COMPACT_RATIO', 0.5))
+# Dead bytes below this are never worth rewriting the log
+COMPACT_MIN_BYTES = 1024 ** 2
+
+MAGIC = b'FCLOG1\0\0'
+# magic, generation of the log
+FILE_HEADER = struct.Struct('<8sQ')
+# crc32 of everything after it, key digest, expires, value length, tombstone
+RECORD_HEADER = struct.Struct('<I32sdI?')
+# magic, generation of the log the index belongs to, log offset the index covers
+INDEX_HEADER = struct.Struct('<8sQQ')
+INDEX_DTYPE = np.dtype([('key', 'V32'), ('offset', '<u8'), ('size', '<u4'), ('expires', '<f8'), ('used', '<f8')])
+
+
+def _record(key: bytes, data: bytes, expires: float, tombstone: bool = False) -> bytes:
+    body = RECORD_HEADER.pack(0, key, expires, len(data), tombstone)[4:] + data
+    return struct.pack('<I', zlib.crc32(body)) + body
+
+
+class LogStore:
+    '''Entries of a cache namespace in a single append-only log file.
+
+    Values are read through mmap, a hash index maps key digests to
+    (offset, size, expires, last used) and is snapshotted to `index.bin`.
+    Every record carries a CRC32 and the log written after the snapshot is
+    replayed on open, so a torn write at the tail is cut off after a crash.
+    Records are not fsynced one by one, a crash loses at most the last writes.
+    Overwritten, deleted and evicted records stay in the log until a background
+    compaction copies the live ones into a new file.
+
+    Worker processes can share a store: appends, evictions and the swap of a
+    compacted log hold a flock on `lock`, and every process replays the records
+    the others appended, or reopens the log they compacted, before using its index.
+    '''
+    def __init__(self, path: str | p.Path, compact_ratio: float = FILE_CACHE_COMPACT_RATIO) -> None:
+        self.path = p.Path(path)
+        self.log_path = self.path / 'data.log'
+        self.index_path = self.path / 'index.bin'
+        self.compact_ratio = compact_ratio
+        self.compactions = 0
+        self._lock = threading.RLock()
+        self._entries: dict[bytes, list] = {}
+        self._live = 0
+        self._compacting: threading.Thread | None = None
+        self._map: mmap.mmap | None = None
+        self._mapped = 0
+        self.path.mkdir(parents=True, exist_ok=True)
+        with FileLock(self.path / 'lock'):
+            compacting = FileLock(self.path / 'compact.lock')
+            if compacting.acquire(blocking=False):
+                # Left over by a compaction that crashed
+                (self.path / 'data.log.compact').unlink(missing_ok=True)
+                compacting.release()
+            self._open(truncate=True)
+
+    def _open(self, truncate: bool) -> None:
+        start = self._load() if self.log_path.exists() else None
+        if start is None:
+            self._generation = secrets.randbits(63)
+            self.log_path.write_bytes(FILE_HEADER.pack(MAGIC, self._generation))
+            self._entries, self._live, start = {}, 0, FILE_HEADER.size
+        self._file = open(self.log_path, 'r+b')
+        self._remap()
+        self._catch_up(start, truncate)
+        LOG.info('Opened cache log {} with {} entries', self.log_path, len(self._entries))
+
+    def _catch_up(self, start: int, truncate: bool) -> None:
+        '''Replay the mapped log from `start`. Only the lock holder may cut off
+        an incomplete tail, without the lock it can be a record still being written
+        '''
+        self._end = self._replay(start, self._mapped)
+        if truncate and self._end < self._mapped:
+            LOG.warning('Dropped {} bytes of torn records from {}', self._mapped - self._end, self.log_path)
+            self._file.truncate(self._end)
+            self._remap()
+
+    def _refresh(self, truncate: bool = False) -> None:
+        '''Catch up with the records other processes appended, or reopen the log they compacted'''
+        if os.stat(self.log_path).st_ino != os.fstat(self._file.fileno()).st_ino:
+            self._close_file()
+            self._entries, self._live = {}, 0
+            self._open(truncate)
+        elif os.fstat(self._file.fileno()).st_size > self._end:
+            self._remap()
+            self._catch_up(self._end, truncate)
+
+    @contextmanager
+    def _exclusive(self):
+        with self._lock, FileLock(self.path / 'lock'):
+            self._refresh(truncate=True)
+            yield
+
+    def _load(self) -> int | None:
+        '''Read the index snapshot, returns the offset to replay the log from'''
+        with open(self.log_path, 'rb') as file:
+            header = file.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header)[0] != MAGIC:
+            LOG.warning('{} is not a cache log, resetting it', self.log_path)
+            return None
+        self._generation = FILE_HEADER.unpack(header)[1]
+        try:
+            raw = self.index_path.read_bytes()
+            magic, generation, covered = INDEX_HEADER.unpack_from(raw)
+        except (FileNotFoundError, struct.error):
+            return FILE_HEADER.size
+        if magic != MAGIC or generation != self._generation or covered > self.log_path.stat().st_size:
+            return FILE_HEADER.size
+        table = np.frombuffer(raw, INDEX_DTYPE, offset=INDEX_HEADER.size)
+        self._entries = {
+            bytes(key): [offset, size, expires, used]
+            for key, offset, size, expires, used in zip(
+                table['key'], table['offset'].tolist(), table['size'].tolist(), table['expires'].tolist(), table['used'].tolist()
+            )
+        }
+        self._live = int(table['size'].sum())
+        return covered
+
+    def _replay(self, start: int, end: int, entries: dict[bytes, list] | None = None, shift: int = 0) -> int:
+        '''Apply the intact records between `start` and `end`, returns where they stop'''
+        assert self._map is not None
+        offset = start
+        while offset + RECORD_HEADER.size <= end:
+            crc, key, expires, length, tombstone = RECORD_HEADER.unpack_from(self._map, offset)
+            body_end = offset + RECORD_HEADER.size + length
+            if body_end > end or zlib.crc32(self._map[offset + 4:body_end]) != crc:
+                break
+            if entries is None:
+                self._apply(key, offset + RECORD_HEADER.size, length, expires, tombstone)
+            elif tombstone:
+                entries.pop(key, None)
+            else:
+                entries[key] = [offset + RECORD_HEADER.size + shift, length, expires, time.time()]
+            offset = body_end
+        return offset
+
+    def _apply(self, key: bytes, offset: int, length: int, expires: float, tombstone: bool) -> None:
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._live -= previous[1]
+        if not tombstone:
+            self._entries[key] = [offset, length, expires, time.time()]
+            self._live += length
+
+    def _remap(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        self._mapped = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self._mapped, access=mmap.ACCESS_READ)
+
+    def _view(self, offset: int, length: int) -> bytes:
+        if offset + length > self._mapped:
+            self._file.flush()
+            self._remap()
+        assert self._map is not None
+        return self._map[offset:offset + length]
+
+    def _append(self, key: bytes, data: bytes, expires: float, tombstone: bool = False) -> None:
+        record = _record(key, data, expires, tombstone)
+        self._file.seek(self._end)
+        self._file.write(record)
+        self._file.flush()
+        self._apply(key, self._end + RECORD_HEADER.size, len(data), expires, tombstone)
+        self._end += len(record)
+
+    def read(self, digest: str) -> tuple[bytes, float] | None:
+        '''Value and expiry time of an entry'''
+        with self._lock:
+            self._refresh()
+            entry = self._entries.get(bytes.fromhex(digest))
+            if entry is None:
+                return None
+            entry[3] = time.time()
+            return self._view(entry[0], entry[1]), entry[2]
+
+    def write(self, digest: str, data: bytes, expires: float) -> None:
+        with self._exclusive():
+            self._append(bytes.fromhex(digest), data, expires)
+            self._maybe_compact()
+
+    def delete(self, digest: str) -> None:
+        with self._exclusive():
+            if bytes.fromhex(digest) in self._entries:
+                self._append(bytes.fromhex(digest), b'', 0, tombstone=True)
+                self._maybe_compact()
+
+    def size(self) -> int:
+        '''Bytes of the live values'''
+        return self._live
+
+    def evict(self, target: int, hot: dict[str, int]) -> list[str]:
+        '''Drop expired and then least recently used entries until the live values fit `target`.
+        Entries in `hot` count as more recent than the others, in the given order
+        '''
+        now = time.time()
+        with self._exclusive():
+            entries = sorted(
+                self._entries.items(),
+                key=lambda item: (item[1][2] >= now, hot.get(item[0].hex(), -1), item[1][3]),
+            )
+            evicted = []
+            for key, (_, _, expires, _) in entries:
+                if self._live <= target and expires >= now:
+                    break
+                self._append(key, b'', 0, tombstone=True)
+                evicted.append(key.hex())
+            self._maybe_compact()
+            return evicted
+
+    def _dead_bytes(self) -> int:
+        return self._end - FILE_HEADER.size - self._live - len(self._entries) * RECORD_HEADER.size
+
+    def _maybe_compact(self) -> None:
+        dead = self._dead_bytes()
+        if dead < COMPACT_MIN_BYTES or dead < self._end * self.compact_ratio:
+            return
+        if self._compacting is None or not self._compacting.is_alive():
+            self._compacting = threading.Thread(target=self.compact, name=f'compact-{self.path.name}', daemon=True)
+            self._compacting.start()
+
+    def compact(self) -> None:
+        '''Copy the live records into a new log and swap it in.
+        Readers and writers are only blocked while the records appended during the copy are moved over
+        '''
+        compacting = FileLock(self.path / 'compact.lock')
+        if not compacting.acquire(blocking=False):
+            # Another process is compacting this log
+            return
+        try:
+            self._compact()
+        finally:
+            compacting.release()
+
+    def _compact(self) -> None:
+        with self._lock:
+            self._refresh()
+            live = {key: list(entry) for key, entry in self._entries.items()}
+            copied_until = self._end
+            inode = os.fstat(self._file.fileno()).st_ino
+        generation = secrets.randbits(63)
+        temporary = self.path / 'data.log.compact'
+        entries: dict[bytes, list] = {}
+        with open(temporary, 'wb') as file:
+            position = file.write(FILE_HEADER.pack(MAGIC, generation))
+            for key, (offset, size, expires, used) in live.items():
+                with self._lock:
+                    data = self._view(offset, size)
+                position += file.write(_record(key, data, expires))
+                entries[key] = [position - size, size, expires, used]
+            with self._exclusive():
+                if os.fstat(self._file.fileno()).st_ino != inode:
+                    # Another process compacted the log before this one took over
+                    temporary.unlink()
+                    return
+                tail = self._view(copied_until, self._end - copied_until)
+                file.write(tail)
+                file.flush()
+                os.fsync(file.fileno())
+                self._replay(copied_until, self._end, entries, shift=position - copied_until)
+                for key, entry in entries.items():
+                    if key in self._entries:
+                        entry[3] = self._entries[key][3]
+                os.replace(temporary, self.log_path)
+                self._close_file()
+                before = self._end
+                self._file = open(self.log_path, 'r+b')
+                self._generation = generation
+                self._entries = entries
+                self._live = sum(entry[1] for entry in entries.values())
+                self._end = position + len(tail)
+                self._remap()
+                self._snapshot()
+                self.compactions += 1
+        LOG.info('Compacted cache log {} from {} to {} bytes', self.log_path, before, self._end)
+
+    def _snapshot(self) -> None:
+        '''Write the index, the log it covers is synced first'''
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        table = np.array(
+            [(key, *entry) for key, entry in self._entries.items()],
+            dtype=INDEX_DTYPE,
+        )
+        temporary = self.path / 'index.bin.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(INDEX_HEADER.pack(MAGIC, self._generation, self._end))
+            file.write(table.tobytes())
+        os.replace(temporary, self.index_path)
+
+    def flush(self) -> None:
+        with self._exclusive():
+            self._snapshot()
+
+    def _close_file(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def close(self) -> None:
+        if self._compacting is not None:
+            self._compacting.join()
+        with self._exclusive():
+            self._snapshot()
+            self._close_file()
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self._live,
+            'log_bytes': self._end,
+            'dead_bytes': self._dead_bytes(),
+            'compactions': self.compactions,
+        }
+
+
+# TESTS ====
+def test_entries_survive_reopen(tmp_path):
+    store = LogStore(tmp_path)
+    store.write('aa' * 32, b'first', 2e12)
+    store.write('bb' * 32, b'second', 200.0)
+    store.write('aa' * 32, b'third', 300.0)
+    store.delete('bb' * 32)
+    store.close()
+
+    store = LogStore(tmp_path)
+    assert store.read('aa' * 32) == (b'third', 300.0)
+    assert store.read('bb' * 32) is None
+    store.write('cc' * 32, b'unindexed', 400.0)
+    store._file.close()
+
+    store = LogStore(tmp_path)
+    assert store.read('cc' * 32) == (b'unindexed', 400.0)
+    assert store.size() == len(b'third') + len(b'unindexed')
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    store = LogStore(tmp_path)
+    store.write('aa' * 32, b'kept', 2e12)
+    store.write('bb' * 32, b'torn' * 10, 2e12)
+    store._file.truncate(store._end - 7)
+    store._file.close()
+
+    store = LogStore(tmp_path)
+    assert store.read('aa' * 32) == (b'kept', 2e12)
+    assert store.read('bb' * 32) is None
+    store.write('bb' * 32, b'rewritten', 2e12)
+    assert store.read('bb' * 32) == (b'rewritten', 2e12)
+
+
+def test_compaction_keeps_live_entries(tmp_path):
+    store = LogStore(tmp_path)
+    for i in range(100):
+        store.write(f'{i % 10:064x}', str(i).encode() * 100, 2e12)
+    evicted = store.evict(target=5 * 200, hot={f'{9:064x}': 0})
+    assert len(evicted) == 5 and f'{9:064x}' not in evicted
+    log_bytes = store.stats()['log_bytes']
+    store.compact()
+    assert store.stats()['log_bytes'] < log_bytes / 10 and store.stats()['dead_bytes'] == 0
+    assert store.read(f'{9:064x}') == (b'99' * 100, 2e12)
+    store.close()
+    assert LogStore(tmp_path).read(f'{9:064x}') == (b'99' * 100, 2e12)
+
+
+def test_processes_see_each_other_writes(tmp_path):
+    first, second = LogStore(tmp_path), LogStore(tmp_path)
+    first.write('aa' * 32, b'from first', 2e12)
+    second.write('bb' * 32, b'from second', 2e12)
+    assert second.read('aa' * 32) == (b'from first', 2e12)
+    assert first.read('bb' * 32) == (b'from second', 2e12)
+
+    second.delete('aa' * 32)
+    first.compact()
+    assert first.read('aa' * 32) is None
+    second.write('cc' * 32, b'after compaction', 2e12)
+    assert first.read('cc' * 32) == (b'after compaction', 2e12)
+    assert second.read('bb' * 32) == (b'from second', 2e12)
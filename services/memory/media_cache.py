@@ -0,0 +1,76 @@
+import asyncio
+import hashlib
+from typing import Awaitable, Callable
+
+from loguru import logger as LOG
+
+from services.memory.cache_service import FileCacheService
+
+
+class MediaCache:
+    '''Results derived from media files, like transcriptions and OCR,
+    keyed by the hash of the file content, the model and the prompt used.
+    The same file uploaded under another name is a hit, two different
+    files sharing a name are not. A missing result is created by one worker
+    process at a time, the others wait and read it from the cache.
+    '''
+    def __init__(self, file_cache: FileCacheService | None = None) -> None:
+        self._file_cache = file_cache or FileCacheService('media')
+
+    @staticmethod
+    def make_key(data: bytes, model: str, prompt: str = '') -> str:
+        content_hash = hashlib.sha256(data).hexdigest()
+        derivation_hash = hashlib.sha256(f'{content_hash}\0{model}\0{prompt}'.encode()).hexdigest()
+        return f'media:{derivation_hash}'
+
+    async def get_or_create(self, data: bytes, model: str, prompt: str, create: Callable[[], Awaitable[str]]) -> str:
+        key = self.make_key(data, model, prompt)
+        cached = await self._file_cache.aget_bytes(key)
+        # An empty transcription or OCR result is a result as well
+        if cached is not None:
+            LOG.info('Serving {} result from media cache {}', model, key)
+            return cached.decode()
+        return await self._file_cache.aget_or_create(key, create)
+
+
+media_cache = MediaCache()
+
+
+def test_key_depends_on_content_model_and_prompt():
+    key = MediaCache.make_key(b'audio', 'whisper-large-v3')
+    assert key == MediaCache.make_key(b'audio', 'whisper-large-v3')
+    assert key != MediaCache.make_key(b'other audio', 'whisper-large-v3')
+    assert key != MediaCache.make_key(b'audio', 'whisper-large-v3-turbo')
+    assert key != MediaCache.make_key(b'audio', 'whisper-large-v3', 'prompt')
+
+
+def test_get_or_create_calls_once(tmp_path):
+    cache = MediaCache(FileCacheService('media', cache_dir=str(tmp_path)))
+    calls = []
+
+    async def create():
+        calls.append(1)
+        return 'transcription'
+
+    async def run():
+        first = await cache.get_or_create(b'audio', 'whisper', '', create)
+        second = await cache.get_or_create(b'audio', 'whisper', '', create)
+        return first, second
+
+    assert asyncio.run(run()) == ('transcription', 'transcription')
+    assert calls == [1]
+
+
+def test_empty_results_are_cached(tmp_path):
+    cache = MediaCache(FileCacheService('media', cache_dir=str(tmp_path)))
+    calls = []
+
+    async def create():
+        calls.append(1)
+        return ''
+
+    async def run():
+        return [await cache.get_or_create(b'silence', 'whisper', '', create) for _ in range(2)]
+
+    assert asyncio.run(run()) == ['', '']
+    assert calls == [1]
@@ -0,0 +1,119 @@
+import os
+import pathlib as p
+import re
+import struct
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Hashable
+
+from services.coordination import FileLock
+
+QUERY_CACHE_ENTRIES = int(os.environ.get('RAG_QUERY_CACHE_ENTRIES', 1024))
+QUERY_CACHE_TTL = float(os.environ.get('RAG_QUERY_CACHE_TTL', 3600))
+# Write generations of the collections, shared by the worker processes
+QUERY_CACHE_DIR = os.environ.get('RAG_QUERY_CACHE_DIR', './.cache/query_cache')
+
+GENERATION = struct.Struct('<Q')
+
+
+@dataclass
+class QueryCacheStats:
+    hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+
+    def as_dict(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {**asdict(self), 'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0}
+
+
+class QueryResultCache:
+    '''In-memory LRU of search results per collection.
+
+    Every write to a collection bumps its generation, a counter in a file
+    shared by the worker processes, and results are only served while the
+    generation they were searched at is current. So a cached result never
+    misses a remembered document, whichever worker remembered it.
+    '''
+    def __init__(self, max_entries: int = QUERY_CACHE_ENTRIES, ttl: float = QUERY_CACHE_TTL, directory: str = QUERY_CACHE_DIR) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = p.Path(directory)
+        self.stats = QueryCacheStats()
+        self._entries: OrderedDict[tuple, tuple[float, int, Any]] = OrderedDict()
+
+    def _generation_path(self, collection: str) -> p.Path:
+        name = re.sub(r'[^\w.-]', '_', collection)
+        return self.path / f'{name}.generation'
+
+    def generation(self, collection: str) -> int:
+        '''Current generation of the collection, read it before searching and pass it to `put`'''
+        try:
+            return GENERATION.unpack(self._generation_path(collection).read_bytes())[0]
+        except (FileNotFoundError, struct.error):
+            return 0
+
+    def get(self, collection: str, key: Hashable) -> Any | None:
+        entry = self._entries.get((collection, key))
+        if entry is None or entry[0] < time.monotonic() or entry[1] != self.generation(collection):
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end((collection, key))
+        self.stats.hits += 1
+        return entry[2]
+
+    def put(self, collection: str, key: Hashable, value: Any, generation: int | None = None) -> None:
+        generation = self.generation(collection) if generation is None else generation
+        self._entries[(collection, key)] = (time.monotonic() + self.ttl, generation, value)
+        self._entries.move_to_end((collection, key))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, collection: str) -> None:
+        path = self._generation_path(collection)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(path.with_suffix('.lock')):
+            temporary = path.with_suffix(f'.{os.getpid()}.tmp')
+            temporary.write_bytes(GENERATION.pack(self.generation(collection) + 1))
+            os.replace(temporary, path)
+        for key in [key for key in self._entries if key[0] == collection]:
+            del self._entries[key]
+        self.stats.invalidations += 1
+
+
+query_cache = QueryResultCache()
+
+
+# TESTS ====
+def test_results_are_dropped_on_write(tmp_path):
+    cache = QueryResultCache(max_entries=2, directory=str(tmp_path))
+    cache.put('knowledge', ('hybrid', 5, 'who'), [[1]])
+    cache.put('other', ('hybrid', 5, 'who'), [[2]])
+    assert cache.get('knowledge', ('hybrid', 5, 'who')) == [[1]]
+    cache.invalidate('knowledge')
+    assert cache.get('knowledge', ('hybrid', 5, 'who')) is None
+    assert cache.get('other', ('hybrid', 5, 'who')) == [[2]]
+    assert cache.stats.as_dict()['hit_ratio'] == 0.667
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    cache = QueryResultCache(max_entries=2, directory=str(tmp_path))
+    cache.put('knowledge', 'a', 1)
+    cache.put('knowledge', 'b', 2)
+    cache.get('knowledge', 'a')
+    cache.put('knowledge', 'c', 3)
+    assert cache.get('knowledge', 'b') is None
+    assert cache.get('knowledge', 'a') == 1
+
+
+def test_writes_in_another_worker_drop_results(tmp_path):
+    # Two caches over one directory stand in for two server workers
+    first, second = QueryResultCache(directory=str(tmp_path)), QueryResultCache(directory=str(tmp_path))
+    generation = first.generation('knowledge')
+    second.invalidate('knowledge')
+    # Searched before the write, stored after it
+    first.put('knowledge', 'who', [[1]], generation)
+    assert first.get('knowledge', 'who') is None
+    first.put('knowledge', 'who', [[2]])
+    assert first.get('knowledge', 'who') == [[2]]
@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import json
+import os
+import pathlib as p
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any
+
+from loguru import logger as LOG
+
+CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', '0').lower() in ('1', 'true', 'yes')
+CACHE_PATH = os.environ.get('LLM_CACHE_PATH', './.cache/llm_responses.sqlite3')
+CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', 7 * 24 * 3600))
+CACHE_MEMORY_ENTRIES = int(os.environ.get('LLM_CACHE_MEMORY_ENTRIES', 512))
+CACHE_DISK_ENTRIES = int(os.environ.get('LLM_CACHE_DISK_ENTRIES', 20_000))
+
+# Request arguments that do not influence the generated output
+NON_SAMPLING_KWARGS = {'langfuse_prompt', 'name', 'metadata', 'trace_id', 'session_id', 'user_id', 'tags', 'stream', 'timeout'}
+
+
+@dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    def as_dict(self) -> dict[str, Any]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            **asdict(self),
+            'hit_ratio': round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+
+class ResponseCache:
+    '''Content addressed cache of LLM responses.
+
+    A bounded in-memory LRU sits in front of a SQLite store on disk,
+    entries expire after `ttl` seconds and the least recently used ones
+    are evicted once a tier reaches its capacity.
+    '''
+    _EVICTION_INTERVAL = 64
+
+    def __init__(
+            self,
+            path: str = CACHE_PATH,
+            memory_entries: int = CACHE_MEMORY_ENTRIES,
+            disk_entries: int = CACHE_DISK_ENTRIES,
+            ttl: float = CACHE_TTL,
+            enabled: bool = CACHE_ENABLED,
+    ) -> None:
+        self.path = p.Path(path)
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.stats = CacheStats()
+        self._memory: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self._writes_since_eviction = 0
+
+    @staticmethod
+    def make_key(provider: str, model: str, messages: Any, params: dict[str, Any]) -> str:
+        '''Hash of everything that determines the model output'''
+        sampling = {k: v for k, v in params.items() if k not in NON_SAMPLING_KWARGS}
+        payload = json.dumps(
+            {'provider': provider, 'model': model, 'messages': messages, 'params': sampling},
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                '''CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )'''
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed_at)')
+        return self._db
+
+    def _remember(self, key: str, expires_at: float, value: str) -> None:
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            self.stats.evictions += 1
+
+    def _disk_get(self, key: str) -> tuple[float, str] | None:
+        with self._db_lock:
+            db = self._connection()
+            row = db.execute('SELECT expires_at, value FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[0] < time.time():
+                db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.stats.expirations += 1
+                return None
+            db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            return row[0], row[1]
+
+    def _disk_set(self, key: str, expires_at: float, value: str) -> None:
+        with self._db_lock:
+            db = self._connection()
+            db.execute(
+                'INSERT OR REPLACE INTO responses (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, value, expires_at, time.time()),
+            )
+            self._writes_since_eviction += 1
+            if self._writes_since_eviction >= self._EVICTION_INTERVAL:
+                self._writes_since_eviction = 0
+                self._evict(db)
+
+    def _evict(self, db: sqlite3.Connection) -> None:
+        expired = db.execute('DELETE FROM responses WHERE expires_at < ?', (time.time(),)).rowcount
+        self.stats.expirations += max(expired, 0)
+        (count,) = db.execute('SELECT COUNT(*) FROM responses').fetchone()
+        overflow = count - self.disk_entries
+        if overflow > 0:
+            db.execute(
+                'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)',
+                (overflow,),
+            )
+            self.stats.evictions += overflow
+            LOG.info('Evicted {} entries from the response cache', overflow)
+
+    async def get(self, key: str) -> str | None:
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[0] >= time.time():
+                self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                return entry[1]
+            del self._memory[key]
+            self.stats.expirations += 1
+
+        entry = await asyncio.to_thread(self._disk_get, key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        self.stats.disk_hits += 1
+        self._remember(key, *entry)
+        return entry[1]
+
+    async def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._remember(key, expires_at, value)
+        self.stats.writes += 1
+        await asyncio.to_thread(self._disk_set, key, expires_at, value)
+
+    def clear(self) -> None:
+        self._memory.clear()
+        with self._db_lock:
+            self._connection().execute('DELETE FROM responses')
+
+
+response_cache = ResponseCache()
+
+
+# TESTS ====
+def test_memory_tier_is_lru_bounded(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / 'cache.sqlite3'), memory_entries=2, enabled=True)
+
+    async def run():
+        for key in ('a', 'b', 'c'):
+            await cache.set(key, key.upper())
+        assert list(cache._memory) == ['b', 'c']
+        assert await cache.get('a') == 'A'
+
+    asyncio.run(run())
+    assert cache.stats.disk_hits == 1
+    assert cache.stats.evictions >= 1
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / 'cache.sqlite3'), enabled=True)
+
+    async def run():
+        await cache.set('k', 'v', ttl=-1)
+        return await cache.get('k')
+
+    assert asyncio.run(run()) is None
+    assert cache.stats.misses == 1
+
+
+def test_key_ignores_tracing_kwargs():
+    messages = [{'role': 'user', 'content': 'Hi'}]
+    a = ResponseCache.make_key('openai', 'gpt-4o-mini', messages, {'temperature': 0, 'langfuse_prompt': object()})
+    b = ResponseCache.make_key('openai', 'gpt-4o-mini', messages, {'temperature': 0})
+    c = ResponseCache.make_key('openai', 'gpt-4o-mini', messages, {'temperature': 1})
+    assert a == b
+    assert a != c
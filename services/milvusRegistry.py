@@ -0,0 +1,230 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, TypeVar
+
+from loguru import logger as LOG
+from pymilvus import MilvusClient
+
+MILVUS_URI = os.environ.get('MILVUS_URI', 'http://100.77.242.95:19530')
+MILVUS_TOKEN = os.environ.get('MILVUS_TOKEN', 'root:Milvus')
+# Threads running the blocking MilvusClient calls, shared by every database
+MILVUS_THREADS = int(os.environ.get('MILVUS_THREADS', 8))
+
+T = TypeVar('T')
+
+
+class AsyncMilvusClient:
+    '''Awaitable facade over MilvusClient.
+
+    The blocking client calls run in a bounded thread pool,
+    keeping the event loop free while Milvus answers.
+    '''
+    def __init__(self, client: MilvusClient, executor: ThreadPoolExecutor) -> None:
+        self.sync = client
+        self._executor = executor
+        self.calls = 0
+        self.active = 0
+
+    async def _run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        self.calls += 1
+        self.active += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            self.active -= 1
+
+    async def has_collection(self, collection_name: str) -> bool:
+        return await self._run(self.sync.has_collection, collection_name)
+
+    async def describe_collection(self, collection_name: str) -> dict:
+        return await self._run(self.sync.describe_collection, collection_name)
+
+    async def create_collection(self, collection_name: str, dimension: int, **kwargs) -> None:
+        return await self._run(self.sync.create_collection, collection_name, dimension, **kwargs)
+
+    async def drop_collection(self, collection_name: str) -> None:
+        return await self._run(self.sync.drop_collection, collection_name)
+
+    async def describe_index(self, collection_name: str, index_name: str) -> dict:
+        return await self._run(self.sync.describe_index, collection_name, index_name)
+
+    async def insert(self, collection_name: str, data: list[dict], **kwargs) -> dict:
+        return await self._run(self.sync.insert, collection_name=collection_name, data=data, **kwargs)
+
+    async def search(self, collection_name: str, data: list, **kwargs) -> Any:
+        return await self._run(self.sync.search, collection_name, data, **kwargs)
+
+    async def query(self, collection_name: str, **kwargs) -> list[dict]:
+        return await self._run(self.sync.query, collection_name, **kwargs)
+
+    def close(self) -> None:
+        self.sync.close()
+
+
+class CollectionCache:
+    '''Existence and schema of the collections in one database.
+
+    Looked up once and kept until the collection is created or dropped
+    through VectorService, so the hot paths do not pay a round-trip for it.
+    '''
+    def __init__(self, client: AsyncMilvusClient) -> None:
+        self._client = client
+        self._exists: dict[str, bool] = {}
+        self._schemas: dict[str, dict] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def exists(self, collection_name: str) -> bool:
+        if collection_name in self._exists:
+            self.hits += 1
+            return self._exists[collection_name]
+        self.misses += 1
+        exists = await self._client.has_collection(collection_name)
+        self._exists[collection_name] = exists
+        return exists
+
+    async def describe(self, collection_name: str) -> dict:
+        if collection_name in self._schemas:
+            self.hits += 1
+            return self._schemas[collection_name]
+        self.misses += 1
+        schema = await self._client.describe_collection(collection_name)
+        self._schemas[collection_name] = schema
+        self._exists[collection_name] = True
+        return schema
+
+    def invalidate(self, collection_name: str | None = None) -> None:
+        if collection_name is None:
+            self._exists.clear()
+            self._schemas.clear()
+            return
+        self._exists.pop(collection_name, None)
+        self._schemas.pop(collection_name, None)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'collections': sorted(k for k, v in self._exists.items() if v)}
+
+
+@dataclass
+class MilvusConnection:
+    client: AsyncMilvusClient
+    collections: CollectionCache = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.collections = CollectionCache(self.client)
+
+
+class MilvusRegistry:
+    '''Process wide registry of MilvusClients, one per (uri, database).
+
+    Clients are opened on first use and closed on application shutdown.
+    '''
+    def __init__(self, uri: str = MILVUS_URI, token: str = MILVUS_TOKEN, threads: int = MILVUS_THREADS) -> None:
+        self.uri = uri
+        self.token = token
+        self.threads = threads
+        self._executor: ThreadPoolExecutor | None = None
+        self._connections: dict[tuple[str, str], MilvusConnection] = {}
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='milvus')
+        return self._executor
+
+    def get(self, database_name: str, uri: str | None = None) -> MilvusConnection:
+        '''Return the shared connection to a database, opening it if needed'''
+        key = (uri or self.uri, database_name)
+        connection = self._connections.get(key)
+        if connection is None:
+            LOG.info('Opening Milvus client for {} database {}', *key)
+            client = MilvusClient(uri=key[0], token=self.token, db_name=database_name)
+            connection = MilvusConnection(AsyncMilvusClient(client, self.executor))
+            self._connections[key] = connection
+        return connection
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            f'{uri}/{db}': {
+                **connection.collections.stats(),
+                'calls': connection.client.calls,
+                'active': connection.client.active,
+            }
+            for (uri, db), connection in self._connections.items()
+        }
+
+    def close(self) -> None:
+        for (uri, db), connection in self._connections.items():
+            LOG.info('Closing Milvus client for {} database {}', uri, db)
+            connection.client.close()
+        self._connections.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+milvus_registry = MilvusRegistry()
+
+
+# TESTS ====
+class _SlowClient:
+    def __init__(self, latency: float = 0) -> None:
+        self.latency = latency
+        self.calls = 0
+
+    def has_collection(self, collection_name: str) -> bool:
+        self.calls += 1
+        return collection_name == 'knowledge'
+
+    def describe_collection(self, collection_name: str) -> dict:
+        self.calls += 1
+        return {'collection_name': collection_name, 'fields': []}
+
+    def search(self, collection_name: str, data: list, **kwargs) -> list:
+        time.sleep(self.latency)
+        return [[] for _ in data]
+
+
+def test_collection_cache_until_invalidated():
+    client = _SlowClient()
+
+    async def run():
+        with ThreadPoolExecutor(1) as executor:
+            cache = CollectionCache(AsyncMilvusClient(client, executor)) #type: ignore
+            assert await cache.exists('knowledge') and await cache.exists('knowledge')
+            assert not await cache.exists('missing') and not await cache.exists('missing')
+            assert (await cache.describe('knowledge'))['collection_name'] == 'knowledge'
+            await cache.describe('knowledge')
+            assert client.calls == 3
+            cache.invalidate('knowledge')
+            await cache.exists('knowledge')
+            assert client.calls == 4
+
+    asyncio.run(run())
+
+
+def test_blocking_calls_run_concurrently_off_the_loop():
+    async def run():
+        with ThreadPoolExecutor(4) as executor:
+            client = AsyncMilvusClient(_SlowClient(latency=0.1), executor) #type: ignore
+            started = asyncio.get_running_loop().time()
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticking = asyncio.create_task(ticker())
+            await asyncio.gather(*[client.search('knowledge', [[0.0]]) for _ in range(4)])
+            ticking.cancel()
+            return asyncio.get_running_loop().time() - started, ticks
+
+    elapsed, ticks = asyncio.run(run())
+    assert elapsed < 0.3
+    assert ticks >= 5
@@ -0,0 +1,661 @@
+import asyncio
+import json
+import os
+import pathlib as p
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Literal, get_args
+
+import numpy as np
+from loguru import logger as LOG
+from pymilvus import DataType, MilvusClient, MilvusException
+
+from services.coordination import FileLock
+from services.milvusRegistry import MilvusConnection, milvus_registry
+
+# 'milvus' talks to MILVUS_URI, 'local' keeps the collections in process
+VECTOR_BACKEND = os.environ.get('VECTOR_BACKEND', 'milvus')
+VECTOR_LOCAL_PATH = os.environ.get('VECTOR_LOCAL_PATH', './.cache/vectors')
+# Local collections with more rows are searched through an IVF index instead of brute force
+VECTOR_IVF_THRESHOLD = int(os.environ.get('VECTOR_IVF_THRESHOLD', 50_000))
+VECTOR_IVF_NPROBE = int(os.environ.get('VECTOR_IVF_NPROBE', 8))
+# Quantized collections re-rank this many candidates per requested hit with the float vectors
+VECTOR_RERANK_FACTOR = int(os.environ.get('VECTOR_RERANK_FACTOR', 10))
+SCAN_BLOCK_ROWS = 8192
+# Largest limit a Milvus search accepts
+MILVUS_MAX_TOPK = 16384
+
+StorageMode = Literal['float32', 'int8', 'binary']
+STORAGE_MODES: tuple[str, ...] = get_args(StorageMode)
+
+SearchHits = list[list[dict[str, Any]]]
+
+
+class VectorBackend(ABC):
+    '''Storage and cosine similarity search of the collections in one database.
+
+    Inserted rows hold a `vector` and any other fields, search results
+    follow the Milvus format of {'id', 'distance', 'entity'} per hit.
+    '''
+    @abstractmethod
+    async def has_collection(self, collection_name: str) -> bool: ...
+
+    @abstractmethod
+    async def create_collection(self, collection_name: str, dimension: int, storage: StorageMode = 'float32') -> None:
+        '''Create an empty collection, `storage` selects how the vectors are kept for searching'''
+
+    @abstractmethod
+    async def drop_collection(self, collection_name: str) -> None: ...
+
+    @abstractmethod
+    async def insert(self, collection_name: str, data: list[dict]) -> dict: ...
+
+    @abstractmethod
+    async def rows(self, collection_name: str, output_fields: list[str]) -> list[dict[str, Any]]:
+        '''Every row of the collection as {'id', **output_fields}, without the vectors'''
+
+    @abstractmethod
+    async def search(
+            self,
+            collection_name: str,
+            vectors: list[np.ndarray],
+            limit: int = 5,
+            output_fields: list[str] = [],
+            tags: list[str] | None = None,
+    ) -> SearchHits:
+        '''Top `limit` hits for every vector, only among rows having any of the `tags` when given'''
+
+    def stats(self) -> dict:
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+class MilvusBackend(VectorBackend):
+    '''Collections in a Milvus database.
+
+    The int8 storage mode searches a scalar quantized IVF_SQ8 index, fetches
+    `VECTOR_RERANK_FACTOR` candidates per requested hit with their float vectors
+    and re-ranks them exactly, as the local quantized collections do.
+    '''
+    def __init__(self, connection: MilvusConnection) -> None:
+        self.client = connection.client
+        self.collections = connection.collections
+        self._storage: dict[str, StorageMode] = {}
+
+    async def _storage_of(self, collection_name: str) -> StorageMode:
+        '''Storage mode of a collection, read from the type of its vector index'''
+        storage = self._storage.get(collection_name)
+        if storage is None:
+            index = await self.client.describe_index(collection_name, 'vector')
+            storage = 'int8' if (index or {}).get('index_type') == 'IVF_SQ8' else 'float32'
+            self._storage[collection_name] = storage
+        return storage
+
+    def _invalidate(self, collection_name: str) -> None:
+        self.collections.invalidate(collection_name)
+        self._storage.pop(collection_name, None)
+
+    async def has_collection(self, collection_name: str) -> bool:
+        return await self.collections.exists(collection_name)
+
+    async def create_collection(self, collection_name: str, dimension: int, storage: StorageMode = 'float32') -> None:
+        kwargs = {}
+        if storage == 'int8':
+            # Same layout as the quick setup collections, with a scalar quantized IVF index
+            schema = MilvusClient.create_schema(auto_id=True, enable_dynamic_field=True)
+            schema.add_field('id', DataType.INT64, is_primary=True)
+            schema.add_field('vector', DataType.FLOAT_VECTOR, dim=dimension)
+            index_params = MilvusClient.prepare_index_params()
+            index_params.add_index('vector', index_type='IVF_SQ8', metric_type='COSINE', params={'nlist': 1024})
+            kwargs = {'schema': schema, 'index_params': index_params}
+        elif storage != 'float32':
+            raise ValueError(f'Storage mode {storage} is not supported by the Milvus backend')
+        try:
+            await self.client.create_collection(collection_name, dimension, auto_id=True, **kwargs)
+        finally:
+            self._invalidate(collection_name)
+
+    async def drop_collection(self, collection_name: str) -> None:
+        try:
+            await self.client.drop_collection(collection_name)
+        finally:
+            self._invalidate(collection_name)
+
+    async def insert(self, collection_name: str, data: list[dict]) -> dict:
+        rows = [{**row, 'vector': np.asarray(row['vector'], dtype=np.float32).tolist()} for row in data]
+        return await self.client.insert(collection_name, rows)
+
+    async def rows(self, collection_name: str, output_fields: list[str]) -> list[dict[str, Any]]:
+        # Auto ids are positive, the filter matches every row
+        rows = await self.client.query(collection_name, filter='id >= 0', output_fields=output_fields)
+        return [{'id': row['id'], **{field: row.get(field) for field in output_fields}} for row in rows]
+
+    async def search(self, collection_name, vectors, limit=5, output_fields=[], tags=None) -> SearchHits:
+        kwargs = {}
+        if tags:
+            kwargs['filter'] = f'json_contains_any(tags, {json.dumps(tags)})'
+        queries = [np.asarray(v, dtype=np.float32) for v in vectors]
+        try:
+            rerank = limit > 0 and await self._storage_of(collection_name) == 'int8'
+            if not rerank:
+                return await self.client.search(
+                    collection_name, [query.tolist() for query in queries],
+                    limit=limit, output_fields=output_fields, **kwargs
+                )
+            candidates = await self.client.search(
+                collection_name, [query.tolist() for query in queries],
+                limit=min(limit * VECTOR_RERANK_FACTOR, MILVUS_MAX_TOPK),
+                output_fields=list({*output_fields, 'vector'}), **kwargs
+            )
+        except MilvusException:
+            # The collection might have been dropped behind our back
+            self._invalidate(collection_name)
+            raise
+        return [_rerank(hits, query, limit, output_fields) for hits, query in zip(candidates, queries)]
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def _rerank(hits: list[dict[str, Any]], query: np.ndarray, limit: int, output_fields: list[str]) -> list[dict[str, Any]]:
+    '''Top `limit` of the candidate hits by the exact cosine of their float vectors'''
+    if not hits:
+        return []
+    vectors = _normalize(np.asarray([hit['entity']['vector'] for hit in hits], dtype=np.float32))
+    scores = vectors @ _normalize(query)
+    return [
+        {
+            'id': hits[position]['id'],
+            'distance': float(scores[position]),
+            'entity': {field: hits[position]['entity'].get(field) for field in output_fields},
+        }
+        for position in _top(scores, limit)
+    ]
+
+
+def _top(scores: np.ndarray, limit: int) -> np.ndarray:
+    '''Positions of the `limit` highest scores, best first'''
+    if limit <= 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.argpartition(-scores, limit - 1)[:limit] if len(scores) > limit else np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+class IvfIndex:
+    '''Inverted file index, rows are bucketed by their nearest k-means centroid
+    and a search only scores the rows of the `nprobe` closest buckets
+    '''
+    def __init__(self, vectors: np.ndarray, iterations: int = 8, seed: int = 0) -> None:
+        self.size = len(vectors)
+        nlist = max(1, int(np.sqrt(self.size)))
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(self.size, size=min(self.size, nlist * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assigned = np.argmax(sample @ centroids.T, axis=1)
+            for bucket in range(nlist):
+                members = sample[assigned == bucket]
+                if len(members):
+                    centroids[bucket] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        self.centroids = centroids
+        assignments = np.concatenate([
+            np.argmax(vectors[start:start + 8192] @ centroids.T, axis=1)
+            for start in range(0, self.size, 8192)
+        ])
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(nlist + 1))
+        self.buckets = [order[bounds[i]:bounds[i + 1]] for i in range(nlist)]
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        closest = np.argsort(self.centroids @ query)[::-1][:nprobe]
+        return np.concatenate([self.buckets[bucket] for bucket in closest])
+
+
+def _quantize_int8(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''Symmetric int8 codes with one scale per row'''
+    scales = np.abs(matrix).max(axis=1, keepdims=True) / 127
+    scales = np.where(scales == 0, 1, scales).astype(np.float32)
+    return np.round(matrix / scales).astype(np.int8), scales
+
+
+def _storage_files(dimension: int, storage: str) -> dict[str, tuple[type, int]]:
+    '''Append-only files of a collection with their dtype and row width'''
+    files: dict[str, tuple[type, int]] = {'vectors.f32': (np.float32, dimension)}
+    if storage == 'int8':
+        files['codes.i8'] = (np.int8, dimension)
+        files['scales.f32'] = (np.float32, 1)
+    elif storage == 'binary':
+        files['codes.b1'] = (np.uint8, (dimension + 7) // 8)
+    return files
+
+
+class LocalCollection:
+    '''One collection kept on disk as append-only matrices, memory-mapped
+    for search, with the other fields of every row in a JSON lines file.
+
+    With the int8 or binary storage modes searches scan compact codes of the
+    vectors and only read the float32 rows of the best candidates, to re-rank
+    them exactly.
+
+    Worker processes can share a collection: inserts hold a flock on `lock`
+    and first load the records the other processes appended, so ids and rows
+    stay aligned, and searches catch up with them before scanning.
+    '''
+    def __init__(self, path: p.Path) -> None:
+        self.path = path
+        meta = json.loads((path / 'meta.json').read_text())
+        self.dimension = meta['dimension']
+        self.storage: StorageMode = meta.get('storage', 'float32')
+        self._lock = threading.Lock()
+        self.records: list[dict] = []
+        self.tag_rows: dict[str, list[int]] = {}
+        self.ivf: IvfIndex | None = None
+        with self._file_lock():
+            self._load()
+
+    def _file_lock(self) -> FileLock:
+        return FileLock(self.path / 'lock')
+
+    @property
+    def _records_path(self) -> p.Path:
+        return self.path / 'records.jsonl'
+
+    def _load(self) -> None:
+        path, records_path = self.path, self._records_path
+        if records_path.exists():
+            with open(records_path) as file:
+                self.records = [json.loads(line) for line in file if line.strip()]
+        # Rows written only partially before a crash are dropped
+        stored_rows = min(
+            (path / name).stat().st_size // (np.dtype(dtype).itemsize * width)
+            for name, (dtype, width) in self._files().items()
+        )
+        if stored_rows != len(self.records) or any(
+            (path / name).stat().st_size != stored_rows * np.dtype(dtype).itemsize * width
+            for name, (dtype, width) in self._files().items()
+        ):
+            LOG.warning('Collection {} has {} complete vectors for {} records, truncating', path.name, stored_rows, len(self.records))
+            self.records = self.records[:stored_rows]
+            for name, (dtype, width) in self._files().items():
+                with open(path / name, 'r+b') as file:
+                    file.truncate(len(self.records) * np.dtype(dtype).itemsize * width)
+            with open(records_path, 'w') as file:
+                file.writelines(json.dumps(record) + '\n' for record in self.records)
+        records, self.records = self.records, []
+        self._add(records)
+        self._records_size = records_path.stat().st_size if records_path.exists() else 0
+        self.arrays = self._map()
+
+    def _add(self, records: list[dict]) -> None:
+        for record in records:
+            for tag in record.get('tags') or []:
+                self.tag_rows.setdefault(tag, []).append(len(self.records))
+            self.records.append(record)
+        self.next_id = self.records[-1]['id'] + 1 if self.records else 1
+
+    def _stale(self) -> bool:
+        try:
+            return self._records_path.stat().st_size != self._records_size
+        except FileNotFoundError:
+            return False
+
+    def _catch_up(self) -> None:
+        '''Load the records other processes appended, called holding the file lock'''
+        if not self._stale():
+            return
+        if self._records_path.stat().st_size < self._records_size:
+            # Rewritten by a process that dropped torn rows, read it again
+            self.records, self.tag_rows = [], {}
+            self._load()
+            return
+        with open(self._records_path, 'rb') as file:
+            file.seek(self._records_size)
+            appended = file.read()
+        self._records_size += len(appended)
+        self._add([json.loads(line) for line in appended.splitlines() if line.strip()])
+        self.arrays = self._map()
+
+    @classmethod
+    def create(cls, path: p.Path, dimension: int, storage: StorageMode = 'float32') -> 'LocalCollection':
+        if storage not in STORAGE_MODES:
+            raise ValueError(f'Unknown storage mode {storage}')
+        path.mkdir(parents=True, exist_ok=True)
+        (path / 'meta.json').write_text(json.dumps({'dimension': dimension, 'metric': 'COSINE', 'storage': storage}))
+        for name in _storage_files(dimension, storage):
+            (path / name).touch()
+        return cls(path)
+
+    def _files(self) -> dict[str, tuple[type, int]]:
+        return _storage_files(self.dimension, self.storage)
+
+    def _map(self) -> dict[str, np.ndarray]:
+        rows = len(self.records)
+        return {
+            name: np.memmap(self.path / name, dtype=dtype, mode='r', shape=(rows, width)) if rows else np.empty((0, width), dtype=dtype)
+            for name, (dtype, width) in self._files().items()
+        }
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.arrays['vectors.f32']
+
+    @property
+    def scanned_bytes(self) -> int:
+        '''Size of the matrices a full search scans'''
+        if self.storage == 'float32':
+            return self.vectors.nbytes
+        return sum(array.nbytes for name, array in self.arrays.items() if name != 'vectors.f32')
+
+    def insert(self, data: list[dict]) -> dict:
+        matrix = _normalize(np.asarray([row['vector'] for row in data], dtype=np.float32))
+        if matrix.ndim != 2 or matrix.shape[1] != self.dimension:
+            raise ValueError(f'Expected vectors of dimension {self.dimension}, got {matrix.shape}')
+        encoded = {'vectors.f32': matrix}
+        if self.storage == 'int8':
+            encoded['codes.i8'], encoded['scales.f32'] = _quantize_int8(matrix)
+        elif self.storage == 'binary':
+            encoded['codes.b1'] = np.packbits(matrix > 0, axis=1)
+        with self._lock, self._file_lock():
+            self._catch_up()
+            ids = list(range(self.next_id, self.next_id + len(data)))
+            records = [{'id': id, **{k: v for k, v in row.items() if k != 'vector'}} for id, row in zip(ids, data)]
+            for name, array in encoded.items():
+                with open(self.path / name, 'ab') as file:
+                    file.write(np.ascontiguousarray(array).tobytes())
+            lines = ''.join(json.dumps(record) + '\n' for record in records).encode()
+            with open(self._records_path, 'ab') as file:
+                file.write(lines)
+            self._records_size += len(lines)
+            self._add(records)
+            self.arrays = self._map()
+        return {'insert_count': len(ids), 'ids': ids}
+
+    def rows(self, output_fields: list[str]) -> list[dict[str, Any]]:
+        with self._lock:
+            if self._stale():
+                with self._file_lock():
+                    self._catch_up()
+            return [{'id': record['id'], **{field: record.get(field) for field in output_fields}} for record in self.records]
+
+    def _index(self, vectors: np.ndarray) -> IvfIndex | None:
+        if len(vectors) < VECTOR_IVF_THRESHOLD:
+            return None
+        if self.ivf is None or len(vectors) > 2 * self.ivf.size:
+            LOG.info('Building IVF index of {} over {} rows', self.path.name, len(vectors))
+            self.ivf = IvfIndex(np.asarray(vectors))
+        return self.ivf
+
+    @staticmethod
+    def _scan(matrix: np.ndarray, query: np.ndarray, rows: np.ndarray | None, score) -> np.ndarray:
+        '''Scores of the rows, computed in blocks to bound the temporary float copies'''
+        if rows is not None:
+            return score(matrix[rows], query, rows)
+        return np.concatenate([
+            score(matrix[start:start + SCAN_BLOCK_ROWS], query, slice(start, start + SCAN_BLOCK_ROWS))
+            for start in range(0, len(matrix), SCAN_BLOCK_ROWS)
+        ] or [np.empty(0, dtype=np.float32)])
+
+    def _approximate(self, arrays: dict[str, np.ndarray], query: np.ndarray, rows: np.ndarray | None) -> np.ndarray:
+        if self.storage == 'int8':
+            scales = arrays['scales.f32'][:, 0]
+            return self._scan(arrays['codes.i8'], query, rows, lambda codes, q, at: (codes.astype(np.float32) @ q) * scales[at])
+        query_bits = np.packbits(query > 0)
+        # Fewer differing signs means a smaller angle, negated hamming distance ranks like cosine
+        return self._scan(arrays['codes.b1'], query_bits, rows, lambda codes, q, at: -np.bitwise_count(codes ^ q).sum(axis=1, dtype=np.int32))
+
+    def search(self, queries: np.ndarray, limit: int, output_fields: list[str], tags: list[str] | None) -> SearchHits:
+        with self._lock:
+            if self._stale():
+                with self._file_lock():
+                    self._catch_up()
+            arrays = self.arrays
+            vectors = arrays['vectors.f32']
+            records = self.records[:len(vectors)]
+            allowed = None
+            if tags:
+                allowed = np.zeros(len(vectors), dtype=bool)
+                for tag in tags:
+                    allowed[self.tag_rows.get(tag, [])] = True
+            ivf = self._index(vectors)
+        queries = _normalize(np.asarray(queries, dtype=np.float32))
+
+        results: SearchHits = []
+        for query in queries:
+            if ivf is not None:
+                rows = np.concatenate([ivf.candidates(query, VECTOR_IVF_NPROBE), np.arange(ivf.size, len(vectors))])
+                if allowed is not None:
+                    rows = rows[allowed[rows]]
+            elif allowed is not None:
+                rows = np.flatnonzero(allowed)
+            else:
+                rows = None
+            if self.storage == 'float32':
+                scores = vectors @ query if rows is None else vectors[rows] @ query
+            else:
+                approximate = self._approximate(arrays, query, rows)
+                shortlist = _top(approximate, limit * VECTOR_RERANK_FACTOR)
+                rows = shortlist if rows is None else rows[shortlist]
+                rows = np.sort(rows)
+                scores = vectors[rows] @ query
+            top = _top(scores, limit)
+            hits = []
+            for position in top:
+                record = records[position if rows is None else rows[position]]
+                hits.append({
+                    'id': record['id'],
+                    'distance': float(scores[position]),
+                    'entity': {field: record.get(field) for field in output_fields},
+                })
+            results.append(hits)
+        return results
+
+
+class LocalBackend(VectorBackend):
+    '''In-process backend keeping every collection under `path`, searched with NumPy'''
+    def __init__(self, path: str | p.Path) -> None:
+        self.path = p.Path(path)
+        self._collections: dict[str, LocalCollection] = {}
+
+    def _collection(self, collection_name: str) -> LocalCollection:
+        collection = self._collections.get(collection_name)
+        if collection is None:
+            collection = LocalCollection(self.path / collection_name)
+            self._collections[collection_name] = collection
+        return collection
+
+    async def has_collection(self, collection_name: str) -> bool:
+        return collection_name in self._collections or (self.path / collection_name / 'meta.json').exists()
+
+    async def create_collection(self, collection_name: str, dimension: int, storage: StorageMode = 'float32') -> None:
+        self._collections[collection_name] = await asyncio.to_thread(LocalCollection.create, self.path / collection_name, dimension, storage)
+
+    async def drop_collection(self, collection_name: str) -> None:
+        self._collections.pop(collection_name, None)
+        await asyncio.to_thread(shutil.rmtree, self.path / collection_name, True)
+
+    async def insert(self, collection_name: str, data: list[dict]) -> dict:
+        return await asyncio.to_thread(self._collection(collection_name).insert, data)
+
+    async def rows(self, collection_name: str, output_fields: list[str]) -> list[dict[str, Any]]:
+        return await asyncio.to_thread(self._collection(collection_name).rows, output_fields)
+
+    async def search(self, collection_name, vectors, limit=5, output_fields=[], tags=None) -> SearchHits:
+        collection = self._collection(collection_name)
+        return await asyncio.to_thread(collection.search, np.asarray(vectors), limit, output_fields, tags)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                'rows': len(collection.records),
+                'dimension': collection.dimension,
+                'storage': collection.storage,
+                'scanned_bytes': collection.scanned_bytes,
+                'ivf': collection.ivf is not None,
+            }
+            for name, collection in self._collections.items()
+        }
+
+
+class VectorBackends:
+    '''Backend of every database, chosen by VECTOR_BACKEND'''
+    def __init__(self, kind: str = VECTOR_BACKEND, local_path: str = VECTOR_LOCAL_PATH) -> None:
+        if kind not in ('milvus', 'local'):
+            raise ValueError(f'Unknown vector backend {kind}')
+        self.kind = kind
+        self.local_path = p.Path(local_path)
+        self._backends: dict[str, VectorBackend] = {}
+
+    def get(self, database_name: str) -> VectorBackend:
+        backend = self._backends.get(database_name)
+        if backend is None:
+            if self.kind == 'local':
+                backend = LocalBackend(self.local_path / database_name)
+            else:
+                backend = MilvusBackend(milvus_registry.get(database_name))
+            self._backends[database_name] = backend
+        return backend
+
+    def stats(self) -> dict:
+        if self.kind == 'milvus':
+            return {'backend': self.kind, 'databases': milvus_registry.stats()}
+        return {'backend': self.kind, 'databases': {name: backend.stats() for name, backend in self._backends.items()}}
+
+    def close(self) -> None:
+        for backend in self._backends.values():
+            backend.close()
+        self._backends.clear()
+        milvus_registry.close()
+
+
+vector_backends = VectorBackends()
+
+
+# TESTS ====
+def _rows(count: int, dimension: int = 8, seed: int = 0) -> list[dict]:
+    rng = np.random.default_rng(seed)
+    return [
+        {'vector': rng.normal(size=dimension), 'text': f'doc {i}', 'tags': ['even' if i % 2 == 0 else 'odd']}
+        for i in range(count)
+    ]
+
+
+def test_local_backend_search_and_tag_filter(tmp_path):
+    rows = _rows(50)
+
+    async def run():
+        backend = LocalBackend(tmp_path)
+        await backend.create_collection('knowledge', 8)
+        inserted = await backend.insert('knowledge', rows)
+        assert inserted['insert_count'] == 50
+        hits = await backend.search('knowledge', [rows[7]['vector'], rows[8]['vector']], limit=3, output_fields=['text'])
+        assert [hit[0]['entity']['text'] for hit in hits] == ['doc 7', 'doc 8']
+        assert hits[0][0]['distance'] >= hits[0][1]['distance']
+        filtered = await backend.search('knowledge', [rows[7]['vector']], limit=5, output_fields=['tags'], tags=['even'])
+        assert len(filtered[0]) == 5 and all(hit['entity']['tags'] == ['even'] for hit in filtered[0])
+
+    asyncio.run(run())
+
+
+def test_local_backend_persists(tmp_path):
+    rows = _rows(10)
+
+    async def run():
+        await LocalBackend(tmp_path).create_collection('knowledge', 8)
+        await LocalBackend(tmp_path).insert('knowledge', rows)
+        reopened = LocalBackend(tmp_path)
+        assert await reopened.has_collection('knowledge')
+        hits = await reopened.search('knowledge', [rows[3]['vector']], limit=1, output_fields=['text'])
+        assert hits[0][0]['entity']['text'] == 'doc 3'
+        await reopened.insert('knowledge', rows[:1])
+        assert reopened.stats()['knowledge']['rows'] == 11
+        await reopened.drop_collection('knowledge')
+        assert not await reopened.has_collection('knowledge')
+
+    asyncio.run(run())
+
+
+def test_local_collection_shared_by_workers(tmp_path):
+    rows = _rows(20)
+
+    async def run():
+        # Two backends over one directory stand in for two server workers
+        first, second = LocalBackend(tmp_path), LocalBackend(tmp_path)
+        await first.create_collection('knowledge', 8)
+        ids = (await first.insert('knowledge', rows[:10]))['ids'] + (await second.insert('knowledge', rows[10:]))['ids']
+        assert ids == list(range(1, 21))
+        hits = await first.search('knowledge', [rows[15]['vector']], limit=1, output_fields=['text'], tags=['odd'])
+        assert hits[0][0]['entity']['text'] == 'doc 15'
+        assert await first.search('knowledge', [rows[15]['vector']], limit=0) == [[]]
+        assert (await first.rows('knowledge', ['text']))[19] == {'id': 20, 'text': 'doc 19'}
+
+    asyncio.run(run())
+    assert LocalBackend(tmp_path).stats() == {}
+    assert len(LocalCollection(tmp_path / 'knowledge').records) == 20
+
+
+def test_milvus_int8_storage_reranks_exactly():
+    rows = _rows(50, dimension=16)
+    query = rows[7]['vector']
+
+    class FakeClient:
+        def __init__(self) -> None:
+            self.limits: list[int] = []
+
+        async def describe_index(self, collection_name, index_name):
+            return {'index_type': 'IVF_SQ8' if collection_name == 'int8' else 'AUTOINDEX'}
+
+        async def search(self, collection_name, data, limit, output_fields, **kwargs):
+            self.limits.append(limit)
+            # Quantization error: the approximate order puts the true nearest row last
+            order = [i for i in range(len(rows)) if i != 7][:limit - 1] + [7]
+            return [[
+                {'id': i + 1, 'distance': 1.0 - n / 100, 'entity': {'text': rows[i]['text'], 'vector': rows[i]['vector'].tolist()}}
+                for n, i in enumerate(order)
+            ]]
+
+    client = FakeClient()
+    backend = MilvusBackend(MilvusConnection(client))  # type: ignore[arg-type]
+
+    async def run():
+        hits = await backend.search('int8', [query], limit=3, output_fields=['text'])
+        assert client.limits == [3 * VECTOR_RERANK_FACTOR]
+        assert hits[0][0]['id'] == 8
+        assert abs(hits[0][0]['distance'] - 1) < 1e-5
+        assert hits[0][0]['entity'] == {'text': 'doc 7'}
+        assert hits[0][1]['distance'] >= hits[0][2]['distance']
+        assert len(hits[0]) == 3
+        await backend.search('float32', [query], limit=3, output_fields=['text'])
+        assert client.limits[-1] == 3
+
+    asyncio.run(run())
+
+
+def test_ivf_index_finds_nearest_rows():
+    vectors = _normalize(np.random.default_rng(1).normal(size=(2000, 16)).astype(np.float32))
+    index = IvfIndex(vectors)
+    found = sum(i in index.candidates(vectors[i], nprobe=8) for i in range(0, 2000, 20))
+    assert found == 100
+
+
+def test_quantized_storage_reranks_exactly(tmp_path):
+    rows = _rows(300, dimension=32)
+
+    async def run():
+        backend = LocalBackend(tmp_path)
+        for storage in ('int8', 'binary'):
+            await backend.create_collection(storage, 32, storage=storage)
+            await backend.insert(storage, rows)
+            hits = await backend.search(storage, [rows[42]['vector']], limit=3, output_fields=['text'])
+            assert hits[0][0]['entity']['text'] == 'doc 42'
+            assert abs(hits[0][0]['distance'] - 1) < 1e-5
+            assert backend.stats()[storage]['scanned_bytes'] < 300 * 32 * 4 / 3
+        reopened = LocalBackend(tmp_path)
+        assert (await reopened.search('binary', [rows[7]['vector']], limit=1))[0][0]['id'] == 8
+
+    asyncio.run(run())
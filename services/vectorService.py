@@ -1,48 +1,108 @@
 import asyncio
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+import time
+from itertools import batched
 from typing import Any, Literal
 from loguru import logger as LOG
-from langfuse.openai import AsyncOpenAI
+import numpy as np
 from openai.types.create_embedding_response import CreateEmbeddingResponse
-from pymilvus import MilvusClient, MilvusException
+from pymilvus import MilvusException
 from pymilvus.exceptions import ErrorCode
 
+from services.ai.clientRegistry import client_registry
+from services.ai.scheduler import Priority, estimate_tokens, scheduler
+from services.ai.singleflight import SingleFlight
+from services.lexicalIndex import lexical_indexes
+from services.memory.embedding_cache import EmbeddingCache, embedding_cache_for
+from services.vectorBackends import StorageMode, VectorBackend, vector_backends
+
+embeddings_flight = SingleFlight('embeddings')
+
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 64))
+INSERT_CONCURRENCY = int(os.environ.get('VECTOR_INSERT_CONCURRENCY', 4))
+
 class EmbeddingService:
-    def __init__(self, base_url=None, model='text-embedding-ada-002') -> None:
-        self.client_args = {}
-        if base_url:
-            self.client_args['base_url'] = base_url
+    def __init__(self, base_url=None, model='text-embedding-ada-002', cache: EmbeddingCache | None = None) -> None:
+        self.base_url = base_url
+        self.provider = client_registry.provider_for_base_url(base_url)
         self.model = model
+        self.cache = cache if cache is not None else embedding_cache_for(base_url, model)
+
+    async def generate_embedding(self, embedding_text: str | list[str], priority: int = Priority.DEFAULT) -> CreateEmbeddingResponse:
+        ai = client_registry.get(self.provider)
+        text_hash = hashlib.sha256(json.dumps(embedding_text, ensure_ascii=False).encode()).hexdigest()
+        return await embeddings_flight.do(
+            f'{self.provider}:{self.model}:{text_hash}',
+            lambda: scheduler.submit(
+                lambda: ai.embeddings.create(input=embedding_text, model=self.model),
+                provider=self.provider,
+                model=self.model,
+                tokens=estimate_tokens(embedding_text),
+                priority=priority,
+            )
+        )
 
-    async def generate_embedding(self, embedding_text: str | list[str]) -> CreateEmbeddingResponse:
-        async with AsyncOpenAI(**self.client_args) as ai:
-            return await ai.embeddings.create(input=embedding_text, model=self.model)
+    async def embed(self, texts: list[str], priority: int = Priority.DEFAULT) -> list[np.ndarray]:
+        '''Embeddings of all the texts, cached ones are read from the embedding cache
+        and the missing ones generated in a single request
+        '''
+        vectors = self.cache.get_many(texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            response = await self.generate_embedding(missing, priority=priority)
+            generated = {
+                text: np.asarray(embedding.embedding, dtype=np.float32)
+                for text, embedding in zip(missing, sorted(response.data, key=lambda e: e.index))
+            }
+            self.cache.put_many(list(generated), list(generated.values()))
+            vectors = [generated[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors #type: ignore
+
+
+@dataclass
+class InsertReport:
+    inserted: int
+    batches: int
+    seconds: float
+    ids: list
+
+    @property
+    def docs_per_second(self) -> float:
+        return self.inserted / self.seconds if self.seconds else 0.0
 
 
 class VectorService:
     TASK_TYPES = Literal['search_document', 'search_query', 'clustering', 'classification']
-    def __init__(self, embedding_service: EmbeddingService | None, database_name: str) -> None:
+    def __init__(self, embedding_service: EmbeddingService | None, database_name: str, backend: VectorBackend | None = None) -> None:
         self._embedding_service = embedding_service
-        self.client = MilvusClient(uri='http://100.77.242.95:19530', token='root:Milvus', db_name=database_name)
+        self.database_name = database_name
+        self.backend = backend if backend is not None else vector_backends.get(database_name)
 
-    def __ensure_collection(self, collection_name: str):
-        if not self.client.has_collection(collection_name):
+    async def __ensure_collection(self, collection_name: str):
+        if not await self.backend.has_collection(collection_name):
             raise MilvusException(code=ErrorCode.COLLECTION_NOT_FOUND, message='Collection Not Found')
 
     def __ensure_embedding_service_setup(self):
         if self._embedding_service is None:
             raise MilvusException(code=ErrorCode.UNEXPECTED_ERROR, message='Embedding service required, but None found')
 
-    def create_collection(self, collection_name: str, dimension: int) -> bool:
+    async def create_collection(self, collection_name: str, dimension: int, storage: StorageMode = 'float32') -> bool:
         '''Create collection, 
+        storage 'int8' or 'binary' keeps quantized vectors for the search,
         if collection has been created return True,
         if collection already exists return False
         '''
-        if self.client.has_collection(collection_name):
+        if await self.backend.has_collection(collection_name):
             LOG.info('Collection "{}" already exists', collection_name)
             return False
         
         try:
-            self.client.create_collection(collection_name, dimension, auto_id=True)
+            await self.backend.create_collection(collection_name, dimension, storage)
+            # A lexical index left from a dropped collection of the same name holds stale ids
+            lexical_indexes.clear(self.database_name, collection_name)
             return True
         except Exception as exc:
             LOG.error('Unable to create a collection due to an error: {}', str(exc))
@@ -53,55 +113,135 @@ class VectorService:
 
     async def insert_into_collection(self, collection_name: str, docs: list[str], tags: list[str] = []):
         '''Insert documents into a collection with tags'''
-        self.__ensure_collection(collection_name)
-        self.__ensure_embedding_service_setup()
-        generate_embeddings_coro = [self._embedding_service.generate_embedding(doc) for doc in docs] #type: ignore
-        vectors = await asyncio.gather(*generate_embeddings_coro)
-        LOG.info('Generated embeddings for docs {} ', len(vectors[0].data))
-        data = [{'vector': vector.data[0].embedding, 'uuid': 'UIDHERE', 'text': doc, 'tags': tags} for doc, vector in zip(docs,vectors)]
-        return self.client.insert(collection_name=collection_name, data=data)
+        report = await self.insert_batched(collection_name, docs, [tags] * len(docs))
+        return {'insert_count': report.inserted, 'ids': report.ids}
 
-    async def search_in_collection(self, collection_name: str, docs: list[str], limit = 5, output_fields: list[str] = []) -> list[list[dict[str,Any]]]:
+    async def insert_batch(self, collection_name: str, docs: list[str], tags: list[list[str]], priority: int = Priority.BATCH) -> dict:
+        '''Embed the documents in one request and write them to the collection in one insert'''
+        await self.__ensure_collection(collection_name)
+        self.__ensure_embedding_service_setup()
+        vectors = await self._embedding_service.embed(docs, priority=priority) #type: ignore
+        data = [
+            {'vector': vector, 'uuid': 'UIDHERE', 'text': doc, 'tags': doc_tags}
+            for doc, doc_tags, vector in zip(docs, tags, vectors)
+        ]
+        return await self.backend.insert(collection_name, data)
+
+    async def insert_batched(
+            self,
+            collection_name: str,
+            docs: list[str],
+            tags: list[list[str]] | None = None,
+            batch_size: int = EMBEDDING_BATCH_SIZE,
+            concurrency: int = INSERT_CONCURRENCY,
+            priority: int = Priority.BATCH,
+    ) -> InsertReport:
+        '''Insert documents, each with its own tags, embedding every batch
+        in one request and writing it to the collection in one insert
+        '''
+        await self.__ensure_collection(collection_name)
+        self.__ensure_embedding_service_setup()
+        tags = tags if tags is not None else [[] for _ in docs]
+        limit = asyncio.Semaphore(concurrency)
+        started = time.perf_counter()
+
+        async def insert_batch(batch: tuple[tuple[str, list[str]], ...]):
+            async with limit:
+                return await self.insert_batch(collection_name, [doc for doc, _ in batch], [doc_tags for _, doc_tags in batch], priority)
+
+        results = await asyncio.gather(*[insert_batch(batch) for batch in batched(zip(docs, tags), batch_size)])
+        report = InsertReport(
+            inserted=sum(result['insert_count'] for result in results),
+            batches=len(results),
+            seconds=time.perf_counter() - started,
+            ids=[id for result in results for id in result['ids']],
+        )
+        LOG.info(
+            'Inserted {} docs into {} in {} batches, {:.1f} docs/s',
+            report.inserted, collection_name, report.batches, report.docs_per_second
+        )
+        return report
+
+    async def search_in_collection(
+            self,
+            collection_name: str,
+            docs: list[str],
+            limit = 5,
+            output_fields: list[str] = [],
+            tags: list[str] | None = None,
+    ) -> list[list[dict[str,Any]]]:
         '''Search the collection for matching data
-        Input list of docs to search,
+        Input list of docs to search, optionally only among entries with any of the tags,
         Returns for each doc a list of matched entries in collection
         '''
-        self.__ensure_collection(collection_name)
-        generate_embeddings_coro = [self._embedding_service.generate_embedding(doc) for doc in docs] #type: ignore
-        vectors = await asyncio.gather(*generate_embeddings_coro)
-        return self.client.search(collection_name, [embedding.data[0].embedding for embedding in vectors], limit=limit, output_fields=output_fields) #type: ignore
+        await self.__ensure_collection(collection_name)
+        self.__ensure_embedding_service_setup()
+        vectors = await self._embedding_service.embed(docs) #type: ignore
+        return await self.backend.search(collection_name, vectors, limit=limit, output_fields=output_fields, tags=tags)
 
     async def drop_collection(self, collection_name: str):
-        self.__ensure_collection(collection_name)
-        self.client.drop_collection(collection_name)
+        await self.__ensure_collection(collection_name)
+        await self.backend.drop_collection(collection_name)
+        lexical_indexes.clear(self.database_name, collection_name)
+
+    async def documents(self, collection_name: str) -> list[dict[str, Any]]:
+        '''Id, text and tags of every document in the collection'''
+        await self.__ensure_collection(collection_name)
+        return await self.backend.rows(collection_name, ['text', 'tags'])
 
 
 # TESTS ====
-async def test_create_embedding():
-    embedding_service = EmbeddingService(base_url='http://localhost:11434/v1', model='nomic-embed-text')
-    embedding_response = await embedding_service.generate_embedding('Hello There')
+def _offline(monkeypatch, tmp_path) -> tuple[EmbeddingService, 'VectorService']:
+    '''Services backed by the replay transport and a local collection instead of Ollama and Milvus'''
+    from services.ai.replayTransport import ReplayTransport
+    from services.vectorBackends import LocalBackend
+
+    monkeypatch.setattr(client_registry, '_clients', {})
+    monkeypatch.setattr(client_registry, '_build_transport', lambda provider: ReplayTransport(recordings=None))
+    embedding_service = EmbeddingService(
+        base_url='http://localhost:11434/v1',
+        model='nomic-embed-text',
+        cache=EmbeddingCache('test', str(tmp_path / 'embeddings')),
+    )
+    return embedding_service, VectorService(embedding_service, 'test', backend=LocalBackend(tmp_path / 'vectors'))
+
+def test_create_embedding(monkeypatch, tmp_path):
+    embedding_service, _ = _offline(monkeypatch, tmp_path)
+    embedding_response = asyncio.run(embedding_service.generate_embedding('Hello There'))
     assert embedding_response.model == 'nomic-embed-text'
     assert len(embedding_response.data) > 0
 
-async def test_insert_embeddings():
-    embedding_service = EmbeddingService(base_url='http://localhost:11434/v1', model='nomic-embed-text')
-    vector_service = VectorService(embedding_service, 'test')
-    vector_service.create_collection('test', 768)
-    texts = [
-        'Mary had a little lamb',
-        'Its raining man',
-        'Welcome Home',
-    ]
-    await vector_service.insert_into_collection('test', texts)
-
-async def test_query_embeddings():
-    embedding_service = EmbeddingService(base_url='http://localhost:11434/v1', model='nomic-embed-text')
-    vector_service = VectorService(embedding_service, 'test')
-    resp = await vector_service.search_in_collection('test', ['Who had an animal?', 'What is the weather?'], limit=2, output_fields=['text'])
+TEXTS = [
+    'Mary had a little lamb',
+    'Its raining man',
+    'Welcome Home',
+]
+
+def test_insert_embeddings(monkeypatch, tmp_path):
+    _, vector_service = _offline(monkeypatch, tmp_path)
+
+    async def run():
+        await vector_service.create_collection('test', 768)
+        return await vector_service.insert_into_collection('test', TEXTS)
+
+    resp = asyncio.run(run())
+    assert resp['insert_count'] == 3
+    assert len(set(resp['ids'])) == 3
+
+def test_query_embeddings(monkeypatch, tmp_path):
+    _, vector_service = _offline(monkeypatch, tmp_path)
+
+    async def run():
+        await vector_service.create_collection('test', 768)
+        await vector_service.insert_into_collection('test', TEXTS)
+        # Replayed embeddings of texts sharing words are close, as with the real model
+        return await vector_service.search_in_collection('test', ['Who had a lamb?', 'Is it raining?'], limit=2, output_fields=['text'])
+
+    resp = asyncio.run(run())
     assert 'Mary had a little lamb' == resp[0][0]['entity']['text']
     assert 'Its raining man' == resp[1][0]['entity']['text']
+    assert resp[0][0]['distance'] < 1
 
 # async def test_drop_collection():
 #     vector_service = VectorService(None, 'test')
 #     await vector_service.drop_collection('test')
-
@@ -0,0 +1,323 @@
+import asyncio
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from email.utils import parsedate_to_datetime
+
+import httpx
+from loguru import logger as LOG
+
+from services.ai.singleflight import SingleFlight
+from services.memory.cache_service import FileCacheService
+from services.web.http_pool import http_pool
+
+HTTP_CACHE_ENABLED = os.environ.get('HTTP_CACHE_ENABLED', '1').lower() in ('1', 'true', 'yes')
+# Seconds a stale response is still served while it is revalidated in the background,
+# used when the response has no stale-while-revalidate directive of its own
+HTTP_CACHE_STALE_WHILE_REVALIDATE = float(os.environ.get('HTTP_CACHE_STALE_WHILE_REVALIDATE', 0))
+# Downloads with only a Last-Modified date stay fresh for this share of their age, up to a day.
+# Pages are always revalidated then, a task page like a login form changes without a new date
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_SECONDS = 24 * 3600
+# Query parameters holding credentials, dropped from the cache key, the task key is replaced wherever it is
+SECRET_PARAMS = {'apikey', 'api_key'}
+STORED_HEADERS = ('content-type', 'etag', 'last-modified', 'cache-control', 'expires', 'date', 'age')
+
+
+def parse_cache_control(value: str | None) -> dict[str, str | None]:
+    directives: dict[str, str | None] = {}
+    for part in (value or '').split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def _seconds(value: str | None) -> float | None:
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _http_date(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def cache_key(url: str) -> str:
+    '''The url without credentials, so they never reach the disk and a new key still hits'''
+    parsed = httpx.URL(url)
+    params = [(name, value) for name, value in parsed.params.multi_items() if name.lower() not in SECRET_PARAMS]
+    key = str(parsed.copy_with(params=params) if params else parsed.copy_with(query=None))
+    secret = os.environ.get('AI_DEVS_TASK_KEY')
+    return key.replace(secret, '<apikey>') if secret else key
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    headers: dict[str, str]
+    # Local time the response, or its last revalidation, was received
+    stored: float
+    body: bytes
+
+    @property
+    def cache_control(self) -> dict[str, str | None]:
+        return parse_cache_control(self.headers.get('cache-control'))
+
+    def freshness(self, heuristic: bool = False) -> float:
+        '''Freshness lifetime in seconds, RFC 9111 section 4.2.1,
+        derived from Last-Modified only with `heuristic`
+        '''
+        directives = self.cache_control
+        if 'no-cache' in directives:
+            return 0.0
+        max_age = _seconds(directives.get('max-age'))
+        if max_age is not None:
+            return max_age
+        date = _http_date(self.headers.get('date')) or self.stored
+        if 'expires' in self.headers:
+            # An invalid date means already expired
+            expires = _http_date(self.headers['expires'])
+            return max(expires - date, 0.0) if expires is not None else 0.0
+        last_modified = _http_date(self.headers.get('last-modified'))
+        if heuristic and last_modified is not None:
+            return min(max(date - last_modified, 0.0) * HEURISTIC_FRACTION, HEURISTIC_MAX_SECONDS)
+        return 0.0
+
+    def age(self, now: float) -> float:
+        return (_seconds(self.headers.get('age')) or 0.0) + max(now - self.stored, 0.0)
+
+    def stale_window(self, default: float) -> float:
+        directives = self.cache_control
+        if 'must-revalidate' in directives or 'no-cache' in directives:
+            return 0.0
+        window = _seconds(directives.get('stale-while-revalidate'))
+        return default if window is None else window
+
+    def validators(self) -> dict[str, str]:
+        headers = {}
+        if 'etag' in self.headers:
+            headers['if-none-match'] = self.headers['etag']
+        if 'last-modified' in self.headers:
+            headers['if-modified-since'] = self.headers['last-modified']
+        return headers
+
+    def response(self) -> httpx.Response:
+        return httpx.Response(200, headers=self.headers, content=self.body, request=httpx.Request('GET', self.url))
+
+    def encode(self) -> bytes:
+        return json.dumps({'url': self.url, 'headers': self.headers, 'stored': self.stored}).encode() + b'\n' + self.body
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'CachedResponse':
+        meta, _, body = data.partition(b'\n')
+        return cls(**json.loads(meta), body=body)
+
+
+@dataclass
+class HttpCacheStats:
+    hits: int = 0
+    stale_hits: int = 0
+    revalidated: int = 0
+    misses: int = 0
+    stored: int = 0
+    bytes_saved: int = 0
+
+    def as_dict(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.revalidated + self.misses
+        return {
+            **asdict(self),
+            'hit_ratio': round((self.hits + self.stale_hits + self.revalidated) / lookups, 3) if lookups else 0.0,
+        }
+
+
+class HttpCache:
+    '''Private HTTP cache of GET responses, following RFC 9111.
+
+    Bodies are stored with their validators in the 'http' file cache namespace.
+    Fresh responses are served without a request, stale ones are revalidated with
+    If-None-Match / If-Modified-Since and a 304 only refreshes the stored headers.
+    Within the stale-while-revalidate window the stale body is returned at once
+    and revalidated in the background. Credentials are stripped from the key.
+    '''
+    def __init__(
+            self,
+            file_cache: FileCacheService | None = None,
+            stale_while_revalidate: float = HTTP_CACHE_STALE_WHILE_REVALIDATE,
+            pool=http_pool,
+            enabled: bool = HTTP_CACHE_ENABLED,
+    ) -> None:
+        self._file_cache = file_cache
+        self.stale_while_revalidate = stale_while_revalidate
+        self.pool = pool
+        self.enabled = enabled
+        self.stats = HttpCacheStats()
+        self._flight = SingleFlight('http')
+        self._revalidating: dict[str, asyncio.Task] = {}
+
+    @property
+    def file_cache(self) -> FileCacheService:
+        if self._file_cache is None:
+            self._file_cache = FileCacheService('http')
+        return self._file_cache
+
+    async def _load(self, key: str) -> CachedResponse | None:
+        data = await self.file_cache.aget_bytes(key)
+        return CachedResponse.decode(data) if data is not None else None
+
+    async def get(self, url: str, timeout: float | httpx.Timeout | None = None, heuristic: bool = False) -> httpx.Response:
+        '''`heuristic` lets responses with only a Last-Modified date be reused without
+        a request, for downloads of files that do not change once published
+        '''
+        if not self.enabled:
+            return await self.pool.request('GET', url, timeout=timeout)
+        key = cache_key(url)
+        entry = await self._load(key)
+        if entry is not None:
+            age, lifetime = entry.age(time.time()), entry.freshness(heuristic)
+            if age < lifetime:
+                self.stats.hits += 1
+                self.stats.bytes_saved += len(entry.body)
+                return entry.response()
+            if age < lifetime + entry.stale_window(self.stale_while_revalidate):
+                self.stats.stale_hits += 1
+                self.stats.bytes_saved += len(entry.body)
+                self._revalidate_in_background(key, url, entry, timeout)
+                return entry.response()
+        return await self._flight.do(key, lambda: self._fetch(key, url, entry, timeout))
+
+    async def _fetch(self, key: str, url: str, entry: CachedResponse | None, timeout) -> httpx.Response:
+        headers = entry.validators() if entry is not None else {}
+        response = await self.pool.request('GET', url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and entry is not None:
+            self.stats.revalidated += 1
+            self.stats.bytes_saved += len(entry.body)
+            entry.headers.update({name: response.headers[name] for name in STORED_HEADERS if name in response.headers})
+            entry.stored = time.time()
+            await self.file_cache.asave_bytes(key, entry.encode())
+            return entry.response()
+        self.stats.misses += 1
+        await response.aread()
+        if self._storable(response):
+            stored = CachedResponse(
+                url=key,
+                headers={name: response.headers[name] for name in STORED_HEADERS if name in response.headers},
+                stored=time.time(),
+                body=response.content,
+            )
+            await self.file_cache.asave_bytes(key, stored.encode())
+            self.stats.stored += 1
+        return response
+
+    @staticmethod
+    def _storable(response: httpx.Response) -> bool:
+        '''Only successful responses that can be reused or revalidated are worth the disk space'''
+        directives = parse_cache_control(response.headers.get('cache-control'))
+        if response.status_code != 200 or 'no-store' in directives or response.headers.get('vary') == '*':
+            return False
+        reusable = 'max-age' in directives or 'expires' in response.headers
+        return reusable or 'etag' in response.headers or 'last-modified' in response.headers
+
+    def _revalidate_in_background(self, key: str, url: str, entry: CachedResponse, timeout) -> None:
+        if key in self._revalidating:
+            return
+        task = asyncio.create_task(self._flight.do(key, lambda: self._fetch(key, url, entry, timeout)))
+        self._revalidating[key] = task
+
+        def done(task: asyncio.Task) -> None:
+            self._revalidating.pop(key, None)
+            if not task.cancelled() and task.exception() is not None:
+                LOG.warning('Background revalidation of {} failed: {}', key, task.exception())
+        task.add_done_callback(done)
+
+
+http_cache = HttpCache()
+
+
+# TESTS ====
+class _Upstream:
+    '''Stands in for the pool, answers with the responses built by `respond`'''
+    def __init__(self, respond) -> None:
+        self.respond = respond
+        self.requests: list[dict] = []
+
+    async def request(self, method: str, url: str, headers: dict | None = None, timeout=None) -> httpx.Response:
+        self.requests.append(headers or {})
+        return httpx.Response(**self.respond(len(self.requests), headers or {}), request=httpx.Request(method, url))
+
+
+def test_apikey_is_stripped_from_the_key(monkeypatch):
+    monkeypatch.setenv('AI_DEVS_TASK_KEY', 'secret-key')
+    assert cache_key('https://centrala.ag3nts.org/data/secret-key/json.txt') == 'https://centrala.ag3nts.org/data/<apikey>/json.txt'
+    assert cache_key('https://example.com/page?apikey=abc&page=2') == 'https://example.com/page?page=2'
+    assert cache_key('https://example.com/page?apikey=abc') == 'https://example.com/page'
+    assert cache_key('https://example.com/lookup?key=a') != cache_key('https://example.com/lookup?key=b')
+
+
+def test_last_modified_heuristic_only_for_downloads():
+    entry = CachedResponse(
+        url='https://xyz.ag3nts.org/',
+        headers={'date': 'Sat, 17 Oct 2026 00:00:00 GMT', 'last-modified': 'Sat, 10 Oct 2026 00:00:00 GMT'},
+        stored=time.time(),
+        body=b'',
+    )
+    assert entry.freshness() == 0.0
+    assert entry.freshness(heuristic=True) == 7 * 24 * 3600 * HEURISTIC_FRACTION
+
+
+def test_fresh_responses_are_served_and_stale_ones_revalidated(tmp_path):
+    def respond(count: int, headers: dict) -> dict:
+        if headers.get('if-none-match') == '"v1"':
+            return {'status_code': 304, 'headers': {'cache-control': 'max-age=3600'}}
+        return {'status_code': 200, 'headers': {'etag': '"v1"', 'cache-control': 'max-age=0'}, 'content': b'question'}
+
+    upstream = _Upstream(respond)
+    cache = HttpCache(FileCacheService('http', cache_dir=str(tmp_path), memory=None), pool=upstream)
+
+    async def run():
+        return [(await cache.get('https://centrala.ag3nts.org/data/questions.txt')).text for _ in range(3)]
+
+    assert asyncio.run(run()) == ['question'] * 3
+    assert upstream.requests == [{}, {'if-none-match': '"v1"'}]
+    assert (cache.stats.misses, cache.stats.revalidated, cache.stats.hits) == (1, 1, 1)
+
+
+def test_stale_while_revalidate_serves_stale_body(tmp_path):
+    def respond(count: int, headers: dict) -> dict:
+        cache_control = 'max-age=0, stale-while-revalidate=60'
+        return {'status_code': 200, 'headers': {'etag': f'"v{count}"', 'cache-control': cache_control}, 'content': f'v{count}'.encode()}
+
+    upstream = _Upstream(respond)
+    cache = HttpCache(FileCacheService('http', cache_dir=str(tmp_path), memory=None), pool=upstream)
+
+    async def run():
+        url = 'https://example.com/page'
+        first = (await cache.get(url)).text
+        stale = (await cache.get(url)).text
+        await asyncio.sleep(0.05)
+        refreshed = (await cache.get(url)).text
+        await asyncio.sleep(0.05)
+        return first, stale, refreshed
+
+    assert asyncio.run(run()) == ('v1', 'v1', 'v2')
+    assert upstream.requests[1] == {'if-none-match': '"v1"'}
+    assert cache.stats.stale_hits == 2
+
+
+def test_no_store_responses_are_not_kept(tmp_path):
+    upstream = _Upstream(lambda count, headers: {'status_code': 200, 'headers': {'cache-control': 'no-store', 'etag': '"v"'}, 'content': b'secret'})
+    cache = HttpCache(FileCacheService('http', cache_dir=str(tmp_path), memory=None), pool=upstream)
+
+    async def run():
+        for _ in range(2):
+            await cache.get('https://example.com/flag')
+
+    asyncio.run(run())
+    assert len(upstream.requests) == 2 and cache.stats.stored == 0
@@ -0,0 +1,144 @@
+import os
+
+import httpx
+from loguru import logger as LOG
+
+from services.ai.clientRegistry import ConnectionStats, TrackingTransport
+from services.ai.replayTransport import offline_transport
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+HTTP_POOL_MAX_PER_HOST = int(os.environ.get('HTTP_POOL_MAX_PER_HOST', 10))
+HTTP_POOL_KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_POOL_KEEPALIVE_EXPIRY', 30))
+# HTTP/2 needs the h2 package, from httpx[http2]
+HTTP_POOL_HTTP2 = os.environ.get('HTTP_POOL_HTTP2', '1').lower() in ('1', 'true', 'yes')
+if HTTP_POOL_HTTP2 and h2 is None:
+    LOG.warning('HTTP_POOL_HTTP2 is set but the h2 package is not installed, the HTTP pool falls back to HTTP/1.1')
+    HTTP_POOL_HTTP2 = False
+# Default timeouts, call sites pass their own for slow endpoints
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 30))
+HTTP_DOWNLOAD_TIMEOUT = float(os.environ.get('HTTP_DOWNLOAD_TIMEOUT', 120))
+
+
+class HttpPool:
+    '''Long-lived connection pools for the task and web endpoints, one per origin.
+
+    Every host gets its own keep-alive pool capped at `max_per_host` connections,
+    so a multi step task reuses its connections instead of redoing DNS, TCP and TLS
+    on every hop. Pools are created on first use and closed on application shutdown.
+    Every call gets a client of its own over the shared pool, so cookies a task
+    receives, like a login session, only live for that call, as with a fresh client.
+    '''
+    def __init__(
+            self,
+            max_per_host: int = HTTP_POOL_MAX_PER_HOST,
+            keepalive_expiry: float = HTTP_POOL_KEEPALIVE_EXPIRY,
+            timeout: float = HTTP_TIMEOUT,
+            http2: bool = HTTP_POOL_HTTP2,
+    ) -> None:
+        self.limits = httpx.Limits(
+            max_connections=max_per_host,
+            max_keepalive_connections=max_per_host,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = timeout
+        self.http2 = http2
+        self._transports: dict[tuple[str, bool], httpx.AsyncBaseTransport] = {}
+        self._stats: dict[str, ConnectionStats] = {}
+
+    @staticmethod
+    def origin(url: str | httpx.URL) -> str:
+        url = httpx.URL(url)
+        return f'{url.scheme}://{url.netloc.decode()}'
+
+    def _build_transport(self, origin: str, offline: bool) -> httpx.AsyncBaseTransport:
+        stats = self._stats.setdefault(origin, ConnectionStats())
+        transport: httpx.AsyncBaseTransport = httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2)
+        if offline:
+            transport = offline_transport(transport) or transport
+        LOG.info('Creating pooled HTTP transport for {}', origin)
+        return TrackingTransport(stats, transport)
+
+    def transport(self, url: str, offline: bool = False) -> httpx.AsyncBaseTransport:
+        '''Shared transport for the origin of the url, `offline` ones follow LLM_TRANSPORT_MODE'''
+        key = (self.origin(url), offline)
+        transport = self._transports.get(key)
+        if transport is None:
+            transport = self._build_transport(*key)
+            self._transports[key] = transport
+        return transport
+
+    def get(self, url: str, offline: bool = False) -> httpx.AsyncClient:
+        '''Client with an empty cookie jar over the shared transport of the origin.
+        It is not closed after use, closing it would close the shared connections
+        '''
+        return httpx.AsyncClient(transport=self.transport(url, offline), timeout=self.timeout)
+
+    async def request(
+            self,
+            method: str,
+            url: str,
+            timeout: float | httpx.Timeout | None = None,
+            offline: bool = False,
+            **kwargs,
+    ) -> httpx.Response:
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        return await self.get(url, offline).request(method, url, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            'http2': self.http2,
+            'hosts': {origin: stats.as_dict() for origin, stats in self._stats.items()},
+        }
+
+    async def aclose(self) -> None:
+        for (origin, _), transport in self._transports.items():
+            LOG.info('Closing pooled HTTP transport for {}', origin)
+            await transport.aclose()
+        self._transports.clear()
+
+
+http_pool = HttpPool()
+
+
+# TESTS ====
+def test_requests_to_a_host_share_a_transport():
+    pool = HttpPool()
+    assert pool.transport('https://centrala.ag3nts.org/report') is pool.transport('https://centrala.ag3nts.org/data/x.json')
+    assert pool.transport('https://centrala.ag3nts.org/report') is not pool.transport('https://xyz.ag3nts.org/')
+    assert pool.transport('https://centrala.ag3nts.org/report') is not pool.transport('https://centrala.ag3nts.org/report', offline=True)
+    assert HttpPool.origin('http://localhost:8888/a?b=c') == 'http://localhost:8888'
+
+
+def test_connections_are_reused():
+    import asyncio
+
+    async def handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while head := await reader.readuntil(b'\r\n\r\n'):
+                # A login style session cookie, it must not be sent back by later calls
+                assert b'cookie:' not in head.lower()
+                writer.write(b'HTTP/1.1 200 OK\r\nset-cookie: session=task\r\ncontent-length: 2\r\n\r\nok')
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handler, '127.0.0.1', 0)
+        url = f'http://127.0.0.1:{server.sockets[0].getsockname()[1]}/page'
+        pool = HttpPool(http2=False)
+        try:
+            for _ in range(3):
+                response = await pool.request('GET', url, timeout=5)
+                assert response.text == 'ok'
+        finally:
+            await pool.aclose()
+            server.close()
+        return pool.stats()['hosts'][HttpPool.origin(url)]
+
+    stats = asyncio.run(run())
+    assert (stats['requests'], stats['connections_opened'], stats['connections_reused']) == (3, 1, 2)
@@ -1,31 +1,30 @@
-from httpx import AsyncClient, Response
+import httpx
+from httpx import Response
 from loguru import logger as LOG
 
+from services.web.http_cache import http_cache
+from services.web.http_pool import HTTP_DOWNLOAD_TIMEOUT, http_pool
 
-async def send_form(url: str, form_data: dict, follow=True):
-    async with AsyncClient(follow_redirects=follow) as client:
-        resp = await client.post(url, data=form_data)
-        resp.raise_for_status()
-        return resp.text
 
-async def get_page(url: str) -> str:
+async def send_form(url: str, form_data: dict, follow=True, timeout: float | httpx.Timeout | None = None):
+    resp = await http_pool.request('POST', url, data=form_data, follow_redirects=follow, timeout=timeout)
+    resp.raise_for_status()
+    return resp.text
+
+async def get_page(url: str, timeout: float | httpx.Timeout | None = None) -> str:
     LOG.info('Fetching {} page text', url)
-    async with AsyncClient() as client:
-        resp = await client.get(url)
-        resp.raise_for_status()
-        return resp.text
+    resp = await http_cache.get(url, timeout=timeout)
+    resp.raise_for_status()
+    return resp.text
 
-async def get_http_data(url: str) -> bytes:
+async def get_http_data(url: str, timeout: float | httpx.Timeout | None = HTTP_DOWNLOAD_TIMEOUT) -> bytes:
     LOG.info('Fetching {} page text', url)
-    async with AsyncClient() as client:
-        resp = await client.get(url)
-        resp.raise_for_status()
-        return resp.read()
+    resp = await http_cache.get(url, timeout=timeout, heuristic=True)
+    resp.raise_for_status()
+    return resp.read()
 
-async def send_dict_as_json(url: str, data: dict) -> Response:
+async def send_dict_as_json(url: str, data: dict, timeout: float | httpx.Timeout | None = None) -> Response:
     LOG.info('Sending {} to {}', data, url)
-    async with AsyncClient() as client:
-        resp = await client.post(url, json=data)
-        resp.raise_for_status()
-        return resp
-
+    resp = await http_pool.request('POST', url, json=data, timeout=timeout)
+    resp.raise_for_status()
+    return resp